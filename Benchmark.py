@@ -0,0 +1,226 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+from GcodeParser import parse_lines
+from GcodeSink import GcodeSink, NullSink
+from Toolpath import Move, Command, Stage
+from WindJob import WindJob
+
+"""
+Benchmarks for generating programs with TubeWinder
+Runs a fixed matrix of jobs, from the GUI's defaults out to the extremes (tiny and huge mandrels,
+long tubes, lots of wrap rows, fine filament, thousands of heat gun passes), and measures for each one
+the lines generated per second (best of a few runs), the peak memory while generating, and the
+size of the output. The results are compared against a stored baseline: a case that got slower or
+hungrier by more than the tolerance, or whose output changed at all, is flagged.
+
+test.gcode is kept as the golden reference. It was written before the units, the wrap passes and
+the shrink tape were reworked, so only what hasn't changed since is checked against it: the
+operator prompts, in order, and the moves of the pre wrap, homing and heat gun stages.
+
+usage: python Benchmark.py [--case name ...] [--repeat 3] [--update]
+
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(HERE, "benchmark_baseline.json")
+GOLDEN_PATH = os.path.join(HERE, "test.gcode")
+# how much worse than the baseline a case can get before it's flagged
+DEFAULT_TOLERANCE = .25
+DEFAULT_REPEAT = 3
+# keep running a case until it's been timed for at least this long (s), small jobs are over too quickly to time once
+MIN_SECONDS = .5
+
+# (name, job), in the units of a manifest (see WindJob.from_dict)
+CASES = [
+    ("default", {"wrap": {"rows": [{"layers": 1, "angle": 45, "rpm": 20}, {"layers": 1, "angle": 45, "rpm": 20}]}}),
+    ("small_diameter", {"tube": {"od": .5, "length": 10}}),
+    ("large_diameter", {"tube": {"od": 24, "length": 36}}),
+    ("long_tube", {"tube": {"od": 4, "length": 120}}),
+    ("many_rows", {"tube": {"od": 4, "length": 24}, "wrap": {"rows": [{"layers": 1, "angle": angle, "rpm": 20} for angle in (30, 45, 60, 75) * 6]}}),
+    ("fine_filament", {"tube": {"od": 8, "length": 60}, "wrap": {"filament_width": .01, "rows": [{"layers": 1, "angle": 45, "rpm": 20}]}}),
+    ("heat_gun_passes", {"heat_gun": {"passes": 5000, "rotation_per_pass": 10, "feedrate": 2000}}),
+    ("max_feedrates", {"tube": {"od": 4, "length": 48}, "feedrates": {"mode": "max"}}),
+    ("solved_pattern", {"tube": {"od": 4, "length": 48}, "wrap": {"pattern": "solve", "rows": [{"layers": 2, "angle": 45, "rpm": 20}]}}),
+]
+# the job test.gcode was written for, the GUI's defaults with two rows
+GOLDEN_JOB = dict(CASES)["default"]
+GOLDEN_STAGES = ("Pre Wrap", "Home the machine", "Heat Gun")
+
+
+class HashSink(GcodeSink):
+    """
+        throws the output away, keeping only its hash
+    """
+    def __init__(self):
+        super().__init__()
+        self.digest = hashlib.sha256()
+
+    def write_out(self, data):
+        self.digest.update(data.encode())
+
+
+def generate(job, sink):
+    job.generate(sink, on_report = ignore_report)
+    return sink
+
+
+def ignore_report(name, value):
+    pass
+
+
+"""
+    benchmarks one job
+    @return dictionary of lines_per_second, seconds (best run), peak_bytes, lines, output_bytes and sha256
+"""
+def run_case(job, repeat = DEFAULT_REPEAT):
+    best = None
+    runs = 0
+    total = 0.0
+    while runs < repeat or total < MIN_SECONDS:
+        # cpu time of this process, so other load on the machine counts for less
+        start = time.process_time()
+        sink = generate(job, NullSink())
+        seconds = time.process_time() - start
+        best = seconds if best is None else min(best, seconds)
+        runs += 1
+        total += seconds
+    # a separate run for memory, tracing slows everything down
+    tracemalloc.start()
+    try:
+        hashed = generate(job, HashSink())
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"lines_per_second": round(sink.lines_written / best), "seconds": round(best, 6), "peak_bytes": peak, "lines": sink.lines_written,
+            "output_bytes": sink.bytes_written, "sha256": hashed.digest.hexdigest()}
+
+
+"""
+    compares a result against its baseline
+    @return list of problems, empty when there are none
+"""
+def compare(result, baseline, tolerance = DEFAULT_TOLERANCE):
+    problems = []
+    if result["sha256"] != baseline["sha256"]:
+        problems.append("output changed (" + str(baseline["lines"]) + " -> " + str(result["lines"]) + " lines)")
+    if result["lines_per_second"] < baseline["lines_per_second"] * (1 - tolerance):
+        problems.append("slower, " + str(baseline["lines_per_second"]) + " -> " + str(result["lines_per_second"]) + " lines/s")
+    if result["peak_bytes"] > baseline["peak_bytes"] * (1 + tolerance):
+        problems.append("more memory, " + str(baseline["peak_bytes"]) + " -> " + str(result["peak_bytes"]) + " bytes peak")
+    return problems
+
+
+"""
+    what a program's records say that the golden reference can be held to
+    @return (operator prompts, {stage name: moves}) of the stages in GOLDEN_STAGES
+"""
+def golden_parts(lines):
+    prompts = []
+    moves = {}
+    stage = None
+    for line, record in parse_lines(lines):
+        if isinstance(record, Stage):
+            stage = record.name
+        elif isinstance(record, Command) and record.code == "M0":
+            prompts.append(record.message)
+        elif isinstance(record, Move) and stage in GOLDEN_STAGES:
+            moves.setdefault(stage, []).append(record)
+    return prompts, moves
+
+
+"""
+    checks the default job against test.gcode
+    @return list of problems, empty when it matches
+"""
+def check_golden(path = GOLDEN_PATH):
+    with open(path) as golden_file:
+        golden_prompts, golden_moves = golden_parts(golden_file)
+    job = WindJob.from_dict(GOLDEN_JOB)
+    text = "".join(record.gcode() for record in job.records(job.create_winder(on_report = ignore_report)))
+    prompts, moves = golden_parts(text.splitlines())
+    problems = []
+    if prompts != golden_prompts:
+        problems.append("operator prompts differ from " + os.path.basename(path))
+    for stage in GOLDEN_STAGES:
+        expected = golden_moves.get(stage, [])
+        got = moves.get(stage, [])
+        if got != expected:
+            first = next((i for i, (a, b) in enumerate(zip(expected, got)) if a != b), min(len(expected), len(got)))
+            problems.append(stage + " moves differ from " + os.path.basename(path) + " at move " + str(first + 1))
+    return problems
+
+
+def machine_info():
+    return {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor() or platform.machine()}
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark G-code generation against a stored baseline")
+    parser.add_argument("--case", action = "append", default = None, help = "only run this case (can be given more than once)")
+    parser.add_argument("--repeat", type = int, default = DEFAULT_REPEAT, help = "runs per case, the best one counts (default " + str(DEFAULT_REPEAT) + ")")
+    parser.add_argument("--baseline", default = BASELINE_PATH, help = "baseline file (default " + os.path.basename(BASELINE_PATH) + ")")
+    parser.add_argument("--tolerance", type = float, default = DEFAULT_TOLERANCE, help = "how much worse a case can get before it's flagged (default "
+                        + str(DEFAULT_TOLERANCE) + ")")
+    parser.add_argument("--update", action = "store_true", help = "store the results as the new baseline instead of comparing")
+    parser.add_argument("--json", default = None, help = "also write the results as json to this file")
+    args = parser.parse_args(argv)
+
+    cases = [(name, data) for name, data in CASES if args.case is None or name in args.case]
+    if args.case is not None and len(cases) != len(set(args.case)):
+        print("unknown case, pick from: " + ", ".join(name for name, data in CASES))
+        return 1
+    baseline = None
+    if not args.update and os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["machine"] != machine_info():
+            print("baseline was taken on " + baseline["machine"]["platform"] + " (python " + baseline["machine"]["python"] + "), timings may not compare")
+
+    flagged = 0
+    problems = check_golden()
+    print("golden reference: " + ("ok" if not problems else "; ".join(problems)))
+    flagged += len(problems)
+    results = {}
+    for name, data in cases:
+        result = run_case(WindJob.from_dict(data), args.repeat)
+        results[name] = result
+        line = (name + ": " + str(result["lines_per_second"]) + " lines/s, " + str(result["lines"]) + " lines, " + str(result["output_bytes"])
+                + " bytes, peak " + str(round(result["peak_bytes"] / 1024)) + "KB")
+        if baseline is not None:
+            if name in baseline["cases"]:
+                problems = compare(result, baseline["cases"][name], args.tolerance)
+                change = result["lines_per_second"] / baseline["cases"][name]["lines_per_second"] - 1
+                line += " (" + ("+" if change >= 0 else "") + str(round(change * 100, 1)) + "%)"
+                if problems:
+                    line += "  REGRESSION: " + "; ".join(problems)
+                    flagged += 1
+            else:
+                line += " (no baseline)"
+        print(line)
+
+    report = {"machine": machine_info(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "cases": results}
+    if args.update:
+        if baseline is None and os.path.exists(args.baseline) and args.case is not None:
+            # only some cases were run, keep the rest of the baseline
+            with open(args.baseline) as baseline_file:
+                kept = json.load(baseline_file)["cases"]
+            kept.update(results)
+            report["cases"] = kept
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent = 2, sort_keys = True)
+        print("baseline written to " + args.baseline)
+    if args.json is not None:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent = 2)
+    return 1 if flagged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
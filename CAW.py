@@ -1,19 +1,32 @@
 import sys
 
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QTabWidget, QWidget, QCheckBox,
-                    QHBoxLayout, QLabel, QPushButton, QGroupBox, QFileDialog, QMessageBox)
+                    QHBoxLayout, QLabel, QPushButton, QGroupBox, QFileDialog, QMessageBox, QProgressBar)
 
 from TubeTab import TubeTab
 from PreWrapSettings import PreWrapSettings
 from WrapSettings import WrapSettings
 from HeatShrinkSettings import HeatShrinkSettings
 from HeatGunSettings import HeatGunSettings
-from TubeWinder import TubeWinder
+from GenerationWorker import GenerationWorker, start_worker
+from IncrementalProgram import IncrementalProgram
+from ProgramCache import ProgramCache
+from WindJob import WindJob
+try:
+    from ToolpathPreview import ToolpathPreview
+except ImportError:
+    # the preview needs numpy, the rest of the window doesn't
+    ToolpathPreview = None
 
 class CAW_UI(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("CAW: Computer Aided Winding")
+        # the last program generated, so the next click only redoes the stages that changed
+        self.program = IncrementalProgram(self.program_cache())
+        # background generation, see on_click
+        self.worker = None
+        self.worker_thread = None
         self.initUI()
 
     def initUI(self):
@@ -28,6 +41,7 @@ class CAW_UI(QMainWindow):
         self.setCentralWidget(self.main_widget)
         #self.showMaximized()
         self.wrap_button.clicked.connect(self.on_click)
+        self.preview_button.clicked.connect(self.on_preview_click)
         self.show()
 
 
@@ -43,6 +57,10 @@ class CAW_UI(QMainWindow):
         self.tabs_widget.addTab(self.wrap_tab, "Wrap Settings")
         self.tabs_widget.addTab(self.heat_shrink_tab, "Heat Shrink Settings")
         self.tabs_widget.addTab(self.heat_gun_tab, "Heat Gun Settings")
+        self.preview_tab = None
+        if ToolpathPreview is not None:
+            self.preview_tab = ToolpathPreview(self.main_widget)
+            self.tabs_widget.addTab(self.preview_tab, "Preview")
 
     def init_side_settings_widget(self):
         self.side_group = QGroupBox("Wrap Settings")
@@ -56,18 +74,37 @@ class CAW_UI(QMainWindow):
         self.heat_shrink_checkbox.setChecked(True)
         self.heat_gun_checkbox = QCheckBox("Heat Gun")
         self.heat_gun_checkbox.setChecked(True)
+        self.fastest_feedrates_checkbox = QCheckBox("Fastest Feedrates")
+        self.solve_pattern_checkbox = QCheckBox("Solve Wind Pattern")
         self.wrap_button = QPushButton("Wrap")
+        self.preview_button = QPushButton("Preview")
+        self.preview_button.setEnabled(ToolpathPreview is not None)
+        self.status_label = QLabel("")
+        self.status_label.setWordWrap(True)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setVisible(False)
 
         vbox.addWidget(self.pre_wrap_checkbox)
         vbox.addWidget(self.wrap_checkbox)
         vbox.addWidget(self.heat_shrink_checkbox)
         vbox.addWidget(self.heat_gun_checkbox)
+        vbox.addWidget(self.fastest_feedrates_checkbox)
+        vbox.addWidget(self.solve_pattern_checkbox)
         vbox.addWidget(self.wrap_button)
+        vbox.addWidget(self.preview_button)
+        vbox.addWidget(self.status_label)
+        vbox.addWidget(self.progress_bar)
         vbox.addStretch(1)
         self.side_group.setLayout(vbox)
 
 
     def on_click(self):
+        if self.worker is not None:
+            # already going, the button cancels it
+            self.worker.cancel()
+            self.wrap_button.setEnabled(False)
+            self.status_label.setText("Cancelling...")
+            return
         # Yay! Wrap!
         # ask for a file
         name = QFileDialog.getSaveFileName(self, 'Save File')[0]
@@ -76,23 +113,117 @@ class CAW_UI(QMainWindow):
             return
         if name.find(".") < 0:
             name += ".gcode"
-        file = open(name,'w')
-        tubeWrapper = TubeWinder(file,float(self.tube_tab.od_input.text()) * 25.4,float(self.tube_tab.length_input.text())*25.4,float(self.tube_tab.start_offset_input.text())*25.4,float(self.tube_tab.head_offset_input.text()) * 25.4)
+        self.start_generation(name)
+
+    def on_preview_click(self):
+        # generates the program without saving it, to look it over before it goes to the machine
+        self.start_generation(None)
+
+    """
+        generates the program on a worker thread, the preview is updated too when there is one
+        @param path: file to save the program to, None to only preview it
+    """
+    def start_generation(self, path):
+        # the job is a snapshot of the form, it can be edited while this one generates
+        job = self.build_job()
+        worker = GenerationWorker(self.program, job, path, preview = self.preview_tab is not None)
+        worker.stage_started.connect(self.on_stage_started)
+        worker.pass_started.connect(self.on_pass_started)
+        worker.preview_ready.connect(self.on_preview_ready)
+        worker.finished.connect(self.on_generation_finished)
+        worker.failed.connect(self.on_generation_failed)
+        worker.cancelled.connect(self.on_generation_cancelled)
+        self.worker_thread, self.worker = start_worker(worker)
+        self.wrap_button.setText("Cancel")
+        self.preview_button.setEnabled(False)
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.setVisible(True)
+
+    def closeEvent(self, event):
+        # don't leave a thread running behind the window
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker_thread.wait()
+        super().closeEvent(event)
+
+    def on_stage_started(self, index, count, name):
+        self.status_label.setText("Stage " + str(index + 1) + " of " + str(count) + ": " + name)
+        # busy until a wrap reports its passes
+        self.progress_bar.setRange(0, 0)
+
+    def on_pass_started(self, number, passes):
+        self.progress_bar.setRange(0, passes)
+        self.progress_bar.setValue(number)
+
+    def on_preview_ready(self, lod):
+        self.preview_tab.set_toolpath(lod)
+        self.tabs_widget.setCurrentWidget(self.preview_tab)
+
+    def on_generation_finished(self, path):
+        stages = str(len(self.program.regenerated)) + " of " + str(len(self.program.segments)) + " stages generated"
+        if path == "":
+            self.generation_done("Previewed (" + stages + ")")
+        else:
+            self.generation_done("Saved " + path + " (" + stages + ")")
+
+    def on_generation_failed(self, message):
+        self.generation_done("Failed")
+        self.showError("Wrap", "Couldn't generate the program", message)
+
+    def on_generation_cancelled(self):
+        self.generation_done("Cancelled")
+
+    def generation_done(self, status):
+        self.worker_thread.wait()
+        self.worker = None
+        self.worker_thread = None
+        self.wrap_button.setText("Wrap")
+        self.wrap_button.setEnabled(True)
+        self.preview_button.setEnabled(ToolpathPreview is not None)
+        self.progress_bar.setVisible(False)
+        self.status_label.setText(status)
+
+    """
+        the cache of stages generated before, None if it can't be made (ie no home directory to put it in)
+    """
+    def program_cache(self):
+        try:
+            return ProgramCache()
+        except OSError:
+            return None
+
+    """
+        reads every setting out of the tabs into a WindJob
+        unchecked stages are left out of the job
+    """
+    def build_job(self):
+        tube = {"od": float(self.tube_tab.od_input.text()), "length": float(self.tube_tab.length_input.text()),
+                "start_offset": float(self.tube_tab.start_offset_input.text()), "head_offset": float(self.tube_tab.head_offset_input.text())}
+        pre_wrap = None
+        wrap = None
+        heat_shrink = None
+        heat_gun = None
         if(self.pre_wrap_checkbox.isChecked()):
-            # do a pre wrap!
             # TODO check settingsS
-            tubeWrapper.pre_wrap(self.pre_wrap_tab.home_checkbox.isChecked(), self.pre_wrap_tab.manual_home_checkbox.isChecked(), self.pre_wrap_tab.check_locations_checkbox.isChecked(),int(self.pre_wrap_tab.feedrate_input.text()))
+            pre_wrap = {"home": self.pre_wrap_tab.home_checkbox.isChecked(), "manual_home": self.pre_wrap_tab.manual_home_checkbox.isChecked(),
+                        "check_locations": self.pre_wrap_tab.check_locations_checkbox.isChecked(), "feedrate": int(self.pre_wrap_tab.feedrate_input.text())}
         if(self.wrap_checkbox.isChecked()):
-            # first execute the tie down wrap
-            tubeWrapper.tie_down_wrap(float(self.wrap_tab.extension_input.text()) * 25.4,float(self.wrap_tab.start_wrap_rotations_input.text()),float(self.wrap_tab.tie_down_wrap_feedrate_input.text()))
-            # now go and handle each row
+            rows = []
             for i in range(0, self.wrap_tab.table.rowCount()):
-                tubeWrapper.wrap(float(self.wrap_tab.filament_width_input.text()) * 25.4,float(self.wrap_tab.filament_overlap_input.text()),float(self.wrap_tab.table.cellWidget(i,1).text()),float(self.wrap_tab.table.cellWidget(i,0).text()),int(self.wrap_tab.table.cellWidget(i,2).text()),float(self.wrap_tab.extension_input.text())*25.4)
+                rows.append({"layers": float(self.wrap_tab.table.cellWidget(i,0).text()), "angle": float(self.wrap_tab.table.cellWidget(i,1).text()),
+                             "rpm": int(self.wrap_tab.table.cellWidget(i,2).text())})
+            wrap = {"filament_width": float(self.wrap_tab.filament_width_input.text()), "filament_overlap": float(self.wrap_tab.filament_overlap_input.text()),
+                    "extension": float(self.wrap_tab.extension_input.text()), "start_wrap_rotations": float(self.wrap_tab.start_wrap_rotations_input.text()),
+                    "tie_down_feedrate": float(self.wrap_tab.tie_down_wrap_feedrate_input.text()), "rows": rows,
+                    "pattern": "solve" if self.solve_pattern_checkbox.isChecked() else "heuristic"}
         if(self.heat_shrink_checkbox.isChecked()):
-            tubeWrapper.shrink_tape(float(self.heat_shrink_tab.heat_shrink_width_input.text())*25.4,float(self.heat_shrink_tab.heat_shrink_overlap_input.text()), int(self.heat_shrink_tab.feedrate_input.text()))
+            heat_shrink = {"width": float(self.heat_shrink_tab.heat_shrink_width_input.text()), "overlap": float(self.heat_shrink_tab.heat_shrink_overlap_input.text()),
+                           "feedrate": int(self.heat_shrink_tab.feedrate_input.text())}
         if(self.heat_gun_checkbox.isChecked()):
-            tubeWrapper.heat_gun(float(self.heat_gun_tab.rotation_per_pass_input.text()), int(self.heat_gun_tab.passes_input.text()), int(self.heat_gun_tab.feedrate_input.text()))
-        file.close()
+            heat_gun = {"rotation_per_pass": float(self.heat_gun_tab.rotation_per_pass_input.text()), "passes": int(self.heat_gun_tab.passes_input.text()),
+                        "feedrate": int(self.heat_gun_tab.feedrate_input.text())}
+        feedrates = {"mode": "max" if self.fastest_feedrates_checkbox.isChecked() else "rpm"}
+        return WindJob(tube, pre_wrap, wrap, heat_shrink, heat_gun, feedrates = feedrates)
 
 
     def showError(self, title, message, more_info = None):
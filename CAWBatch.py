@@ -0,0 +1,191 @@
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+from CycleTimeEstimator import estimate_job, format_duration
+from GcodeSink import open_sink
+from ProgramCache import ProgramCache, DEFAULT_CACHE_DIR
+from ProgramIndex import ProgramIndexer, index_file, index_path
+from WindJob import WindJob, load_manifest, INCH
+
+"""
+Headless batch generation of G-code for many tubes at once
+Takes a json manifest of jobs (see WindJob.load_manifest) and generates every job across a
+pool of worker processes, one TubeWinder per worker, without needing PyQt.
+
+usage: python CAWBatch.py manifest.json -o output_dir -j 8
+
+"""
+
+def ignore_report(name, value):
+    pass
+
+
+"""
+    generates a single job, run inside a worker process
+    @param task: tuple of (index, job dictionary, output path, quiet, options). An output path of None is a dry run,
+        options is a dictionary of the extras to run (see run_batch)
+    @return a summary dictionary for the job
+"""
+def run_job(task):
+    index, job_data, path, quiet, options = task
+    optimize = options.get("optimize", False)
+    cache = ProgramCache(options["cache"]) if options.get("cache") else None
+    # there's nothing to resume from a dry run, and resuming copies G-code text so it can't start from a binary toolpath
+    indexer = ProgramIndexer() if options.get("index") and path is not None and not path.endswith(".cawtp") else None
+    job = WindJob.from_dict(job_data)
+    # keep the workers from flooding the console with the winder's calculations, None prints them
+    on_report = ignore_report if quiet else None
+    result = {"index": index, "name": job.name, "output": path}
+    start = time.perf_counter()
+    try:
+        with open_sink(path) as sink:
+            if options.get("estimate"):
+                # time the program on the way out to the file
+                result["estimate"] = estimate_job(job, sink, optimize = optimize, on_report = on_report).report()
+            else:
+                job.generate(sink, optimize, cache, indexer, on_report)
+        result["bytes"] = sink.bytes_written
+        result["lines"] = sink.lines_written
+        if cache is not None:
+            result["cache"] = cache.stats
+        if indexer is not None:
+            # the estimate writes the program itself, index what it wrote
+            program_index = indexer.index if not options.get("estimate") else index_file(path)
+            program_index.write(index_path(path))
+            result["checkpoints"] = len(program_index.checkpoints)
+        if options.get("coverage"):
+            from CoverageMap import coverage_job
+
+            result["coverage"] = coverage_job(job, on_report = on_report)
+        result["ok"] = True
+        if options.get("validate"):
+            from GcodeValidator import validate_file, validate_job
+
+            if path is None:
+                validator = validate_job(job)
+            else:
+                # check what actually went out to the file
+                validator = validate_file(path, float(job.tube["od"]) * INCH)
+            result["validation"] = validator.report()
+            if not validator.ok():
+                result["ok"] = False
+                result["error"] = "program goes past the winder's limits, " + str(validator.violations[0])
+    except Exception as e:
+        result["ok"] = False
+        result["error"] = type(e).__name__ + ": " + str(e)
+    result["seconds"] = round(time.perf_counter() - start, 4)
+    return result
+
+
+"""
+    picks the output file for a job, either given by the manifest or made from the job name
+"""
+def output_path(job, index, output_dir, compress = False):
+    name = job.get("output")
+    if name is None:
+        name = job.get("name") or ("job_" + str(index + 1))
+    if name.find(".") < 0:
+        name += ".gcode"
+    # binary toolpaths are memory mapped, they stay uncompressed
+    if compress and not name.endswith((".gz", ".cawtp")):
+        name += ".gz"
+    return os.path.join(output_dir, name)
+
+
+"""
+    generates every job in the list across a process pool
+    @param jobs: list of WindJobs
+    @param output_dir: directory to write the G-code files to
+    @param workers: number of worker processes, defaults to the number of cores
+    @param compress: gzip the output files
+    @param dry_run: generate everything but throw the output away
+    @param estimate: also estimate the machine time of every job
+    @param optimize: run every program through the peephole optimizer
+    @param coverage: also work out the filament coverage of every wrap (needs numpy)
+    @param cache: directory of a ProgramCache to reuse stages from earlier runs, None generates everything
+    @param index: write a checkpoint index next to every program, to resume interrupted runs from (see ProgramIndex)
+    @param validate: check every program against the winder's limits (see GcodeValidator), a job that goes past them fails
+    @return list of per job summaries, in manifest order
+"""
+def run_batch(jobs, output_dir, workers = None, quiet = True, compress = False, dry_run = False, estimate = False, optimize = False,
+              coverage = False, cache = None, validate = False, index = False):
+    options = {"estimate": estimate, "optimize": optimize, "coverage": coverage, "cache": cache, "validate": validate, "index": index}
+    if not dry_run:
+        os.makedirs(output_dir, exist_ok = True)
+    tasks = []
+    for i, job in enumerate(jobs):
+        data = job.to_dict()
+        path = None if dry_run else output_path(data, i, output_dir, compress)
+        tasks.append((i, data, path, quiet, options))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(tasks)))
+    if workers == 1:
+        return [run_job(task) for task in tasks]
+    with Pool(workers) as pool:
+        # jobs are independent and roughly the same size, hand them out one at a time
+        return pool.map(run_job, tasks, chunksize = 1)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Generate winding G-code for a manifest of tubes")
+    parser.add_argument("manifest", help = "json manifest of jobs")
+    parser.add_argument("-o", "--output-dir", default = ".", help = "directory to write the G-code files to")
+    parser.add_argument("-j", "--jobs", type = int, default = None, help = "number of worker processes (default: all cores)")
+    parser.add_argument("--summary", default = None, help = "also write the summary as json to this file")
+    parser.add_argument("-z", "--gzip", action = "store_true", help = "gzip the output files")
+    parser.add_argument("-n", "--dry-run", action = "store_true", help = "generate every job without writing any G-code")
+    parser.add_argument("-e", "--estimate", action = "store_true", help = "estimate the machine time of every job")
+    parser.add_argument("-O", "--optimize", action = "store_true", help = "remove redundant moves, feedrates and resets from the output")
+    parser.add_argument("-c", "--coverage", action = "store_true", help = "check the filament coverage of every wrap")
+    parser.add_argument("--cache", nargs = "?", const = DEFAULT_CACHE_DIR, default = None,
+                        help = "reuse stages generated before from this cache directory (default " + DEFAULT_CACHE_DIR + ")")
+    parser.add_argument("--validate", action = "store_true", help = "check every program against the winder's speed, acceleration and travel limits")
+    parser.add_argument("-i", "--index", action = "store_true", help = "write a checkpoint index next to every program, to resume from")
+    parser.add_argument("-v", "--verbose", action = "store_true", help = "show the winder's calculation output")
+    args = parser.parse_args(argv)
+
+    jobs = load_manifest(args.manifest)
+    start = time.perf_counter()
+    results = run_batch(jobs, args.output_dir, args.jobs, quiet = not args.verbose, compress = args.gzip, dry_run = args.dry_run, estimate = args.estimate, optimize = args.optimize,
+                        coverage = args.coverage, cache = args.cache, validate = args.validate,
+                        index = args.index)
+    elapsed = time.perf_counter() - start
+
+    failed = 0
+    for result in results:
+        label = result["output"] or result["name"] or ("job " + str(result["index"] + 1))
+        if result["ok"]:
+            line = label + ": " + str(result["lines"]) + " lines, " + str(result["bytes"]) + " bytes, " + str(result["seconds"]) + "s"
+            if "estimate" in result:
+                line += ", machine time " + format_duration(result["estimate"]["seconds"])
+            if "cache" in result:
+                line += ", " + str(result["cache"]["hits"]) + " cached stages"
+            if "checkpoints" in result:
+                line += ", " + str(result["checkpoints"]) + " checkpoints"
+            if "coverage" in result:
+                layers = result["coverage"]["layers"]
+                if layers:
+                    worst = min(layers, key = lambda layer: layer["coverage"])
+                    line += ", coverage " + str(round(worst["coverage"] * 100, 2)) + "% (" + worst["name"] + ")"
+            print(line)
+        else:
+            failed += 1
+            print(label + ": FAILED " + result["error"])
+            if "validation" in result:
+                hidden = sum(result["validation"]["counts"].values()) - 1
+                if hidden:
+                    print("    ... and " + str(hidden) + " more, the --summary has them")
+    print(str(len(results) - failed) + " of " + str(len(results)) + " jobs generated in " + str(round(elapsed, 2)) + "s")
+    if args.summary is not None:
+        with open(args.summary, 'w') as summary_file:
+            json.dump({"seconds": round(elapsed, 4), "jobs": results}, summary_file, indent = 2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
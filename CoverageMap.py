@@ -0,0 +1,299 @@
+import sys
+from math import ceil
+
+import numpy as np
+
+from MachineSimulator import MachineSimulator, MOVE
+from Toolpath import Command, Stage
+
+"""
+Filament coverage of a wrap, worked out on the unrolled surface of the mandrel
+The tube is cut open along its length and laid flat: columns run along the tube (x), rows around it
+(e, which is already mm of surface). Every move of a wrap lays a band of filament along its path,
+filament_width wide, and each band is rasterized onto the grid with numpy, counting how many times
+every cell gets covered. From the counts come the gaps (cells nothing landed on), how thick the
+filament is piled up, and per layer coverage.
+
+Moves are followed in the machine's own e coordinates, so the G92 E0 at the start of every wrap
+doesn't lose track of where around the tube each pass lands. x stays in the program's coordinates,
+the same ones the tube's start offset is given in.
+
+usage: python CoverageMap.py manifest.json [cell size in mm]
+
+"""
+
+# size of a grid cell (mm), along the tube. Around the tube it's stretched a little so the circumference is a whole number of cells
+DEFAULT_CELL = 0.5
+# (band, column) pairs rasterized at once, keeps memory down on big tubes
+CHUNK_PAIRS = 1 << 22
+# histogram buckets for how many times a cell is covered, the last one is that many or more
+HISTOGRAM_BUCKETS = 5
+
+
+class CoverageMap:
+    """
+        @param circumference: circumference of the tube (mm), the e distance of one turn
+        @param x_start: x of the start of the tube
+        @param length: length of the tube (mm)
+        @param cell: grid cell size (mm)
+    """
+    def __init__(self, circumference, x_start, length, cell = DEFAULT_CELL):
+        self.circumference = circumference
+        self.x_start = x_start
+        self.length = length
+        self.columns = max(1, int(ceil(length / cell)))
+        self.rows = max(1, int(round(circumference / cell)))
+        self.cell_x = length / self.columns
+        self.cell_e = circumference / self.rows
+        self.counts = np.zeros((self.columns, self.rows), dtype = np.int32)
+        self.bands = 0
+
+    """
+        lays a band of filament along every segment from (x0, e0) to (x1, e1)
+        all arguments are arrays (or scalars) of the same length, in mm
+    """
+    def add_bands(self, x0, e0, x1, e1, width):
+        x0, e0, x1, e1 = (np.atleast_1d(np.asarray(a, dtype = float)) for a in (x0, e0, x1, e1))
+        width = np.broadcast_to(np.asarray(width, dtype = float), x0.shape)
+        self.bands += x0.size
+        # columns each band crosses
+        dx = x1 - x0
+        de = e1 - e0
+        along = dx != 0
+        half = width / 2
+        low = np.where(along, np.minimum(x0, x1), x0 - half)
+        high = np.where(along, np.maximum(x0, x1), x0 + half)
+        first = np.maximum(np.ceil((low - self.x_start) / self.cell_x - .5), 0).astype(np.int64)
+        last = np.minimum(np.floor((high - self.x_start) / self.cell_x - .5), self.columns - 1).astype(np.int64)
+        spans = np.maximum(last - first + 1, 0)
+        # do the bands in chunks of about CHUNK_PAIRS (band, column) pairs
+        ends = np.cumsum(spans)
+        start = 0
+        while start < x0.size:
+            done = ends[start - 1] if start > 0 else 0
+            stop = int(np.searchsorted(ends, done + CHUNK_PAIRS, side = "right"))
+            stop = max(stop, start + 1)
+            band = slice(start, stop)
+            self.rasterize(x0[band], e0[band], dx[band], de[band], half[band], along[band], first[band], spans[band])
+            start = stop
+
+    def rasterize(self, x0, e0, dx, de, half, along, first, spans):
+        total = int(spans.sum())
+        if total == 0:
+            return
+        # one entry per (band, column) pair
+        band = np.repeat(np.arange(spans.size), spans)
+        offsets = np.cumsum(spans) - spans
+        column = first[band] + np.arange(total) - offsets[band]
+        x = self.x_start + (column + .5) * self.cell_x
+        slope = np.divide(de, dx, out = np.zeros_like(de), where = along)
+        length = np.hypot(dx, de)
+        # e range the band covers in this column. Across the band's direction it's filament_width wide,
+        # so straight up the column it's that much wider the steeper the band is
+        e_half = np.divide(half * length, np.abs(dx), out = np.zeros_like(half), where = along)
+        center = e0[band] + (x - x0[band]) * slope[band]
+        low = np.where(along[band], center - e_half[band], np.minimum(e0, e0 + de)[band])
+        high = np.where(along[band], center + e_half[band], np.maximum(e0, e0 + de)[band])
+        # cells whose centers are inside the band
+        low = np.ceil(low / self.cell_e - .5).astype(np.int64)
+        high = np.floor(high / self.cell_e - .5).astype(np.int64)
+        count = np.maximum(high - low + 1, 0)
+        rows = self.rows
+        # going all the way around covers the whole column
+        turns = count // rows
+        rest = count % rows
+        begin = np.mod(low, rows)
+        end = begin + rest
+        wraps = end > rows
+        # difference array along each column, one wider than the column for bands ending at the last row
+        width = rows + 1
+        size = self.columns * width
+        plus = np.concatenate((column * width + begin, column[wraps] * width))
+        minus = np.concatenate((column * width + np.where(wraps, rows, end), column[wraps] * width + end[wraps] - rows))
+        difference = np.bincount(plus, minlength = size) - np.bincount(minus, minlength = size)
+        difference = difference.reshape(self.columns, width)[:, :rows]
+        self.counts += np.cumsum(difference, axis = 1).astype(np.int32)
+        self.counts += np.bincount(column, weights = turns, minlength = self.columns).astype(np.int32)[:, None]
+
+    """
+        fraction of the tube covered at least once
+    """
+    def coverage(self):
+        return float(np.count_nonzero(self.counts)) / self.counts.size
+
+    """
+        longest stretch (mm) around the tube with nothing on it, in any column
+    """
+    def largest_gap(self):
+        longest = 0
+        step = max(1, (1 << 22) // (2 * self.rows))
+        index = np.arange(2 * self.rows)
+        for start in range(0, self.columns, step):
+            empty = self.counts[start:start + step] == 0
+            if not empty.any():
+                continue
+            if empty.all(axis = 1).any():
+                return self.circumference
+            # runs around the seam count as one, so look at two turns
+            doubled = np.concatenate((empty, empty), axis = 1)
+            last_covered = np.maximum.accumulate(np.where(doubled, -1, index), axis = 1)
+            longest = max(longest, int((index - last_covered).max()))
+        return min(longest, self.rows) * self.cell_e
+
+    def histogram(self):
+        counts = np.bincount(np.minimum(self.counts, HISTOGRAM_BUCKETS - 1).ravel(), minlength = HISTOGRAM_BUCKETS)
+        return [round(float(count) / self.counts.size, 4) for count in counts]
+
+    def report(self):
+        gaps = int(self.counts.size - np.count_nonzero(self.counts))
+        return {"coverage": round(self.coverage(), 4), "gap_area": round(gaps * self.cell_x * self.cell_e, 1),
+                "largest_gap": round(self.largest_gap(), 2), "mean_count": round(float(self.counts.mean()), 3),
+                "max_count": int(self.counts.max()), "histogram": self.histogram(), "bands": self.bands}
+
+
+class LayerBands:
+    """
+        the bands laid by one layer of a wrap, one per move, and which pass each came from
+    """
+    def __init__(self, name, width):
+        self.name = name
+        self.width = width
+        self.segments = []
+        self.pass_numbers = []
+        self.passes = 0
+
+    def add(self, x0, e0, x1, e1):
+        self.segments.append((x0, e0, x1, e1))
+        self.pass_numbers.append(self.passes)
+
+    """
+        rasterizes the first passes of the layer
+        @param passes: how many passes to lay, all of them by default
+    """
+    def coverage_map(self, circumference, x_start, length, cell = DEFAULT_CELL, passes = None):
+        coverage = CoverageMap(circumference, x_start, length, cell)
+        if self.segments:
+            segments = np.array(self.segments)
+            if passes is not None:
+                segments = segments[np.array(self.pass_numbers) <= passes]
+            coverage.add_bands(segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3], self.width)
+        return coverage
+
+    """
+        fewest passes that cover as much of the tube as the whole layer does
+    """
+    def passes_needed(self, circumference, x_start, length, cell = DEFAULT_CELL, full = None):
+        if full is None:
+            full = self.coverage_map(circumference, x_start, length, cell).coverage()
+        low = 0
+        high = self.passes
+        while low < high:
+            middle = (low + high) // 2
+            if self.coverage_map(circumference, x_start, length, cell, middle).coverage() >= full - 1e-6:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+
+"""
+    follows a program and collects the bands of every layer
+    @param records: records of the program (see Toolpath)
+    @param width: filament width (mm), or a function of the layer name giving it
+    @param layer_stages: names of the stages that lay filament, every one of those that has passes is a layer
+    @return list of LayerBands
+"""
+def collect_bands(records, width, layer_stages = ("Wrap",)):
+    simulator = MachineSimulator()
+    layers = []
+    current = None
+    for record in records:
+        if isinstance(record, Stage):
+            if record.name in layer_stages:
+                # the tie down is marked as a wrap too, a stage is only a layer once it starts a pass
+                name = record.name + " " + str(len(layers) + 1)
+                current = LayerBands(name, width(name) if callable(width) else width)
+            else:
+                current = None
+        state = simulator.step(record)
+        if current is None:
+            continue
+        if state.kind == MOVE and simulator.last_length > 0:
+            # the tube is placed in the program's x, but e has to keep counting through the G92 E0s
+            x1 = simulator.position["X"]
+            e1 = simulator.machine_position("E")
+            current.add(x1 - simulator.last_delta["X"], e1 - simulator.last_delta["E"], x1, e1)
+        elif isinstance(record, Command) and record.text.startswith("M117 Pass"):
+            if current.passes == 0:
+                layers.append(current)
+            current.passes += 1
+    return layers
+
+
+"""
+    coverage of every layer of a program, and of all of them together
+    @param circumference: e distance of one turn of the tube (mm)
+    @param x_start: x where the tube starts
+    @param length: length of the tube (mm)
+    @param passes_needed: also work out how many passes each layer really needs, a handful of extra rasterizations per layer
+    @return dictionary with a "layers" list and a "total"
+"""
+def coverage_records(records, circumference, x_start, length, width, cell = DEFAULT_CELL, passes_needed = True):
+    return coverage_layers(collect_bands(records, width), circumference, x_start, length, cell, passes_needed)
+
+
+"""
+    coverage of layers already collected with collect_bands, see coverage_records
+"""
+def coverage_layers(layer_bands, circumference, x_start, length, cell = DEFAULT_CELL, passes_needed = True):
+    total = CoverageMap(circumference, x_start, length, cell)
+    layers = []
+    for bands in layer_bands:
+        coverage = bands.coverage_map(circumference, x_start, length, cell)
+        total.counts += coverage.counts
+        total.bands += coverage.bands
+        report = coverage.report()
+        report["name"] = bands.name
+        report["passes"] = bands.passes
+        if passes_needed:
+            report["passes_needed"] = bands.passes_needed(circumference, x_start, length, cell, coverage.coverage())
+        layers.append(report)
+    return {"layers": layers, "total": total.report(), "cell": [round(total.cell_x, 4), round(total.cell_e, 4)]}
+
+
+"""
+    coverage of a WindJob's wrap
+    @param on_report: see TubeWinder
+"""
+def coverage_job(job, cell = DEFAULT_CELL, passes_needed = True, on_report = None):
+    winder = job.create_winder(on_report = on_report)
+    width = float(job.wrap["filament_width"]) * 25.4 if job.wrap is not None else 0
+    layer_bands = collect_bands(job.records(winder), width)
+    # a manual home moves the start of the tube to x 0, only known once the program has been through
+    return coverage_layers(layer_bands, winder.e_circumference, winder.start_offset, winder.length, cell, passes_needed)
+
+
+def main(argv = None):
+    from WindJob import load_manifest
+
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) not in (1, 2):
+        print("usage: python CoverageMap.py manifest.json [cell size in mm]")
+        return 1
+    cell = float(argv[1]) if len(argv) > 1 else DEFAULT_CELL
+    for i, job in enumerate(load_manifest(argv[0])):
+        report = coverage_job(job, cell, on_report = lambda name, value: None)
+        print((job.name or ("job " + str(i + 1))) + ":")
+        for layer in report["layers"] + [dict(report["total"], name = "Total")]:
+            line = "    " + layer["name"] + ": " + str(round(layer["coverage"] * 100, 2)) + "% covered"
+            line += ", largest gap " + str(layer["largest_gap"]) + "mm, mean count " + str(layer["mean_count"])
+            if "passes" in layer:
+                line += ", " + str(layer["passes"]) + " passes"
+            if "passes_needed" in layer:
+                line += " (" + str(layer["passes_needed"]) + " needed)"
+            print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+import sys
+
+from MachineSimulator import MachineSimulator, DEFAULT_HOMING_SECONDS, MOVE, HOME, PROMPT
+from Toolpath import Stage
+
+"""
+Machine time estimation for generated programs
+Runs the records of a program (see Toolpath) through a MachineSimulator and adds up how long the
+winder will take, in total and per stage. The simulator uses the max feedrates (M203) and
+accelerations (M201) the program itself sets, and times every move with a trapezoidal speed
+profile from rest to rest. The firmware blends some moves together, so this errs on the long side.
+
+usage: python CycleTimeEstimator.py manifest.json
+       python CycleTimeEstimator.py program.gcode
+
+"""
+
+class StageTime:
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.moves = 0
+        self.homes = 0
+        self.prompts = 0
+
+    def to_dict(self):
+        return {"name": self.name, "seconds": round(self.seconds, 3), "moves": self.moves, "homes": self.homes, "prompts": self.prompts}
+
+
+class CycleTimeEstimator:
+    """
+        @param homing_seconds: time counted for every G28
+    """
+    def __init__(self, homing_seconds = DEFAULT_HOMING_SECONDS):
+        self.simulator = MachineSimulator(homing_seconds)
+        self.stages = []
+        self.stage_counts = {}
+        self.current = None
+
+    """
+        starts timing a new stage, repeated names get numbered (Wrap 1, Wrap 2, ...)
+    """
+    def begin_stage(self, name):
+        count = self.stage_counts.get(name, 0) + 1
+        self.stage_counts[name] = count
+        if count == 2:
+            # there's more than one, go back and number the first one too
+            for stage in self.stages:
+                if stage.name == name:
+                    stage.name = name + " 1"
+        if count > 1:
+            name = name + " " + str(count)
+        self.current = StageTime(name)
+        self.stages.append(self.current)
+
+    """
+        adds a record to the estimate
+        @param use_stage_markers: start a new stage on Stage records
+        @param line: line number of the record, if it came from a file
+    """
+    def add(self, record, use_stage_markers = True, line = None):
+        if isinstance(record, Stage) and use_stage_markers:
+            self.begin_stage(record.name)
+        elif self.current is None:
+            self.begin_stage("Start")
+        state = self.simulator.step(record, line)
+        self.current.seconds += state.duration
+        if state.kind == MOVE:
+            self.current.moves += 1
+        elif state.kind == HOME:
+            self.current.homes += 1
+        elif state.kind == PROMPT:
+            # waiting on the operator isn't machine time, just count it
+            self.current.prompts += 1
+
+    def total_seconds(self):
+        return sum(stage.seconds for stage in self.stages)
+
+    def report(self):
+        return {"seconds": round(self.total_seconds(), 3), "stages": [stage.to_dict() for stage in self.stages]}
+
+
+"""
+    estimates a stream of records, splitting stages on the Stage records
+"""
+def estimate_records(records, homing_seconds = DEFAULT_HOMING_SECONDS):
+    estimator = CycleTimeEstimator(homing_seconds)
+    for record in records:
+        estimator.add(record)
+    return estimator
+
+
+"""
+    estimates a G-code file, streaming it, splitting stages on its comments
+"""
+def estimate_file(path, homing_seconds = DEFAULT_HOMING_SECONDS):
+    from GcodeParser import parse_file
+
+    estimator = CycleTimeEstimator(homing_seconds)
+    for line, record in parse_file(path):
+        estimator.add(record, line = line)
+    return estimator
+
+
+"""
+    estimates a WindJob, with one stage per job stage (pre_wrap, tie_down_wrap, wrap 1, wrap 2, ...)
+    @param job: WindJob to estimate
+    @param sink: optionally also write the G-code here while going through it
+    @param optimize: run the program through the peephole optimizer first (see GcodeOptimizer)
+    @param on_report: see TubeWinder
+"""
+def estimate_job(job, sink = None, homing_seconds = DEFAULT_HOMING_SECONDS, optimize = False, on_report = None):
+    from GcodeOptimizer import PeepholeOptimizer
+
+    estimator = CycleTimeEstimator(homing_seconds)
+    winder = job.create_winder(sink, on_report = on_report)
+    optimizer = PeepholeOptimizer() if optimize else None
+    stages = job.stages()
+    for i, (name, method, args) in enumerate(stages):
+        estimator.begin_stage(name)
+        records = getattr(winder, method)(*args)
+        if optimizer is not None:
+            records = optimizer.optimize(records, last = i == len(stages) - 1)
+        for record in records:
+            estimator.add(record, use_stage_markers = False)
+            if sink is not None:
+                sink.write(record.gcode())
+    if sink is not None:
+        winder.flush()
+    return estimator
+
+
+"""
+    formats seconds as h:mm:ss
+"""
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return str(seconds // 3600) + ":" + str(seconds // 60 % 60).zfill(2) + ":" + str(seconds % 60).zfill(2)
+
+
+def main(argv = None):
+    from WindJob import load_manifest
+
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print("usage: python CycleTimeEstimator.py manifest.json|program.gcode")
+        return 1
+    if argv[0].endswith(".json"):
+        estimates = []
+        for i, job in enumerate(load_manifest(argv[0])):
+            estimates.append((job.name or ("job " + str(i + 1)), estimate_job(job, on_report = lambda name, value: None)))
+    else:
+        estimates = [(argv[0], estimate_file(argv[0]))]
+    for name, estimator in estimates:
+        print(name + ": " + format_duration(estimator.total_seconds()))
+        for stage in estimator.stages:
+            print("    " + stage.name + ": " + format_duration(stage.seconds) + " (" + str(stage.moves) + " moves, "
+                  + str(stage.prompts) + " prompts)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+import argparse
+import copy
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from math import floor
+from multiprocessing import Pool
+
+from CycleTimeEstimator import estimate_records, format_duration
+from WindJob import WindJob, WRAP_DEFAULTS, INCH
+try:
+    from CoverageMap import collect_bands, coverage_layers
+    from FilamentModel import records_use
+except ImportError:
+    # coverage and filament need numpy, sweep on time only
+    collect_bands = None
+    records_use = None
+
+"""
+Sweeps wrap settings for a tube and reports the ones worth winding with
+Every combination of the swept settings (filament width, overlap, wind angle, rpm, extension, ...)
+is generated across a pool of worker processes, without writing any G-code, and scored on machine
+time (see CycleTimeEstimator), filament used (see FilamentModel) and coverage (see CoverageMap). The settings nothing
+else beats on all three at once make up the Pareto front, the ones to pick production settings from.
+
+The sweep is a json file with the job to start from, in the form of a manifest entry, and the
+values to try for each setting, either as a list or as a range:
+
+    {"job": {"tube": {"od": 2.7, "length": 12}, "heat_shrink": null, "heat_gun": null},
+     "sweep": {"filament_overlap": {"from": 0.8, "to": 1, "step": 0.05}, "angle": [30, 45, 60], "rpm": [20, 30],
+               "extension": [1, 1.5], "turnaround": ["dwell", "blend"]}}
+
+Settings are in the units of a manifest (inches). angle, rpm and layers are set on every wrap row.
+
+usage: python DesignSweep.py sweep.json [-j 8] [--min-coverage .99] [--csv results.csv] [--json results.json]
+
+"""
+
+# settings that go on every wrap row, the rest go on the wrap section
+ROW_SETTINGS = ("angle", "rpm", "layers")
+WRAP_SETTINGS = tuple(key for key in WRAP_DEFAULTS if key != "rows")
+# what the Pareto front trades off: (result key, True when bigger is better)
+OBJECTIVES = (("seconds", False), ("filament_m", False), ("coverage", True))
+
+
+"""
+    the values to try for a setting
+    @param values: a list, a single value, or a dictionary of from, to and step
+"""
+def setting_values(values):
+    if isinstance(values, dict):
+        start, stop, step = float(values["from"]), float(values["to"]), float(values["step"])
+        if step <= 0:
+            raise ValueError("A sweep range needs a positive step")
+        # a hair of slack so the end of the range isn't lost to rounding
+        count = int(floor((stop - start) / step + 1e-9)) + 1
+        return [round(start + i * step, 10) for i in range(count)]
+    if isinstance(values, list):
+        return values
+    return [values]
+
+
+"""
+    every combination of the swept settings
+    @param sweep: dictionary of setting name: values (see setting_values)
+    @return list of dictionaries of setting name: value
+"""
+def combinations(sweep):
+    for name in sweep:
+        if name not in ROW_SETTINGS and name not in WRAP_SETTINGS:
+            raise ValueError("Can't sweep " + str(name) + ", pick from: " + ", ".join(ROW_SETTINGS + WRAP_SETTINGS))
+    names = list(sweep)
+    return [dict(zip(names, values)) for values in itertools.product(*(setting_values(sweep[name]) for name in names))]
+
+
+"""
+    the job with some wrap settings changed
+    @param job_data: job in the form of a manifest entry
+    @return new job dictionary
+"""
+def apply_settings(job_data, settings):
+    data = copy.deepcopy(job_data)
+    wrap = data.setdefault("wrap", {})
+    if wrap is None or wrap is False:
+        raise ValueError("The job has to wrap to sweep its wrap settings")
+    rows = wrap.setdefault("rows", copy.deepcopy(WRAP_DEFAULTS["rows"]))
+    for name, value in settings.items():
+        if name in ROW_SETTINGS:
+            for row in rows:
+                row[name] = value
+        else:
+            wrap[name] = value
+    return data
+
+
+"""
+    scores one combination of settings, run inside a worker process
+    @param task: tuple of (index, job dictionary, settings)
+    @return dictionary of the settings and their scores: seconds of machine time, filament_m and coverage
+        (of all the layers together), or the error that stopped it. Filament and coverage are None without numpy
+"""
+def evaluate(task):
+    index, job_data, settings = task
+    result = {"index": index, "settings": settings}
+    try:
+        job = WindJob.from_dict(apply_settings(job_data, settings))
+        winder = job.create_winder(on_report = lambda name, value: None)
+        records = list(job.records(winder))
+        result["seconds"] = round(estimate_records(records).total_seconds(), 3)
+        result["filament_m"] = None
+        result["coverage"] = None
+        if collect_bands is not None:
+            result["filament_m"] = round(records_use(records).total() / 1000, 3)
+            width = float(job.wrap["filament_width"]) * INCH
+            report = coverage_layers(collect_bands(records, width), winder.e_circumference, winder.start_offset, winder.length,
+                                     passes_needed = False)
+            result["coverage"] = report["total"]["coverage"]
+        result["ok"] = True
+    except Exception as e:
+        result["ok"] = False
+        result["error"] = type(e).__name__ + ": " + str(e)
+    return result
+
+
+"""
+    whether result a is at least as good as b on every objective and better on one
+"""
+def dominates(a, b, objectives = OBJECTIVES):
+    better = False
+    for key, bigger in objectives:
+        if a[key] is None or b[key] is None:
+            continue
+        if a[key] == b[key]:
+            continue
+        if (a[key] > b[key]) != bigger:
+            return False
+        better = True
+    return better
+
+
+"""
+    the results nothing else beats on every objective
+    going through them fastest first, anything that beats a result comes before it, and whatever
+    beats it is itself beaten by (or is) something already on the front
+    @return list of results on the front, fastest first
+"""
+def pareto_front(results, objectives = OBJECTIVES):
+    ordered = sorted(results, key = lambda result: tuple((-result[key] if bigger else result[key]) if result[key] is not None else 0
+                                                          for key, bigger in objectives))
+    front = []
+    for result in ordered:
+        if not any(dominates(other, result, objectives) for other in front):
+            front.append(result)
+    return front
+
+
+class DesignSweep:
+    """
+        @param job_data: job to start from, in the form of a manifest entry
+        @param sweep: dictionary of setting name: values to try (see setting_values)
+        @param min_coverage: settings covering less than this are left off the front
+    """
+    def __init__(self, job_data, sweep, min_coverage = 0):
+        self.job_data = job_data
+        self.sweep = sweep
+        self.min_coverage = min_coverage
+        self.results = []
+        self.front = []
+
+    """
+        scores every combination and works out the front
+        @param workers: number of worker processes, defaults to the number of cores
+    """
+    def run(self, workers = None):
+        tasks = [(i, self.job_data, settings) for i, settings in enumerate(combinations(self.sweep))]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(tasks)))
+        if workers == 1:
+            self.results = [evaluate(task) for task in tasks]
+        else:
+            with Pool(workers) as pool:
+                # lots of small tasks, hand them out a few at a time
+                self.results = pool.map(evaluate, tasks, chunksize = max(1, len(tasks) // (workers * 16)))
+        candidates = [result for result in self.results if result["ok"] and (result["coverage"] is None or result["coverage"] >= self.min_coverage)]
+        self.front = pareto_front(candidates)
+        for result in self.results:
+            result["pareto"] = False
+        for result in self.front:
+            result["pareto"] = True
+        return self.front
+
+    def report(self):
+        return {"job": self.job_data, "sweep": self.sweep, "min_coverage": self.min_coverage, "results": self.results,
+                "front": [result["index"] for result in self.front]}
+
+    def write_json(self, path):
+        with open(path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent = 2)
+
+    """
+        one row per combination, the settings first
+    """
+    def write_csv(self, path):
+        names = list(self.sweep)
+        with open(path, 'w', newline = "") as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(names + ["seconds", "filament_m", "coverage", "pareto", "error"])
+            for result in self.results:
+                writer.writerow([result["settings"][name] for name in names] + [result.get("seconds"), result.get("filament_m"), result.get("coverage"),
+                                                                               result["pareto"], result.get("error", "")])
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Sweep wrap settings and report the Pareto front of time, filament and coverage")
+    parser.add_argument("sweep", help = "json file with the job to start from and the settings to sweep")
+    parser.add_argument("-j", "--jobs", type = int, default = None, help = "number of worker processes (default: all cores)")
+    parser.add_argument("--min-coverage", type = float, default = None, help = "leave settings covering less than this (0-1) off the front")
+    parser.add_argument("--csv", default = None, help = "write every combination and its scores to this csv file")
+    parser.add_argument("--json", default = None, help = "write the results as json to this file")
+    args = parser.parse_args(argv)
+
+    with open(args.sweep) as sweep_file:
+        data = json.load(sweep_file)
+    min_coverage = args.min_coverage if args.min_coverage is not None else data.get("min_coverage", 0)
+    sweep = DesignSweep(data.get("job", {}), data["sweep"], min_coverage)
+    start = time.perf_counter()
+    front = sweep.run(args.jobs)
+    elapsed = time.perf_counter() - start
+
+    failed = [result for result in sweep.results if not result["ok"]]
+    print(str(len(sweep.results)) + " combinations in " + str(round(elapsed, 2)) + "s, " + str(len(failed)) + " failed, "
+          + str(len(front)) + " on the front")
+    if collect_bands is None:
+        print("numpy isn't installed, filament and coverage were left out")
+    for result in front:
+        line = ", ".join(name + " " + str(value) for name, value in result["settings"].items())
+        line += ": " + format_duration(result["seconds"])
+        if result["filament_m"] is not None:
+            line += ", " + str(result["filament_m"]) + "m of filament"
+        if result["coverage"] is not None:
+            line += ", " + str(round(result["coverage"] * 100, 2)) + "% covered"
+        print("    " + line)
+    for result in failed[:5]:
+        print("failed " + json.dumps(result["settings"]) + ": " + result["error"])
+    if args.json is not None:
+        sweep.write_json(args.json)
+    if args.csv is not None:
+        sweep.write_csv(args.csv)
+    return 0 if front else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+import asyncio
+import os
+import time
+import tty
+from collections import deque
+
+from GcodeParser import parse_line
+from GcodeSender import checksum
+from MachineSimulator import MachineSimulator, command_words, MOVE
+
+"""
+Emulates the winder's Marlin style controller on a pty, so GcodeSender can be run without hardware
+The sender opens port_name like any serial port. Lines are checked the way Marlin checks them (line
+number, checksum) and go into a command buffer of buffer_size lines. Commands are taken off the
+buffer one at a time: moves go into a planner of planner_size blocks, and each one is answered with
+an advanced ok ("ok N12 P15 B3", the last line number, free planner blocks and free buffer slots).
+
+Moves are timed with a MachineSimulator and the planner plays them out at time_scale times real
+time (0 runs everything straight away). While a program is streaming the emulator keeps track of
+every time the planner runs dry waiting on the next move, and for how long.
+
+halt_after has it stop dead partway through, the way Marlin does on a kill(): it says so once and
+doesn't answer anything after that, until it's started again.
+
+"""
+
+DEFAULT_BUFFER_SIZE = 4
+DEFAULT_PLANNER_SIZE = 16
+# how often "busy" is sent while a command keeps the controller tied up (Marlin's host keepalive)
+KEEPALIVE_SECONDS = 2
+
+
+class FakeController:
+    """
+        @param buffer_size: command buffer size, lines taken but not yet processed
+        @param planner_size: planner blocks
+        @param time_scale: speed of the emulated machine, 1 is real time, 0 doesn't wait at all
+        @param error_every: pretend every nth line came through garbled, to exercise resends
+        @param halt_after: halt once this many lines have come in, 0 never halts
+    """
+    def __init__(self, buffer_size = DEFAULT_BUFFER_SIZE, planner_size = DEFAULT_PLANNER_SIZE, time_scale = 0.0, error_every = 0, halt_after = 0):
+        self.buffer_size = buffer_size
+        self.planner_size = planner_size
+        self.time_scale = time_scale
+        self.error_every = error_every
+        self.halt_after = halt_after
+        self.halted = False
+        self.simulator = MachineSimulator()
+        self.master = None
+        self.slave = None
+        self.port_name = None
+        self.last_line = 0
+        self.received = 0
+        self.commands = None
+        self.planner = deque()
+        self.planner_changed = None
+        self.tasks = []
+        self.buffer = b""
+        # when the planner last ran dry, None while it has moves or the machine has been told to stop
+        self.empty_since = None
+        self.syncing = False
+        self.stats = {"lines": 0, "commands": 0, "moves": 0, "checksum_errors": 0, "line_errors": 0,
+                      "underruns": 0, "underrun_seconds": 0.0, "machine_seconds": 0.0}
+
+    """
+        opens the pty and starts answering on it
+    """
+    async def start(self):
+        self.master, self.slave = os.openpty()
+        # the sender sets its end raw too, but it has to be raw before anything is written
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+        os.set_blocking(self.master, False)
+        self.commands = asyncio.Queue()
+        self.planner_changed = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.master, self.on_readable)
+        self.tasks = [asyncio.ensure_future(self.process()), asyncio.ensure_future(self.play())]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        for task in self.tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self.tasks = []
+        if self.master is not None:
+            asyncio.get_running_loop().remove_reader(self.master)
+            os.close(self.master)
+            os.close(self.slave)
+            self.master = None
+
+    def on_readable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        self.buffer += data
+        while b"\n" in self.buffer:
+            line, self.buffer = self.buffer.split(b"\n", 1)
+            self.receive(line.decode("ascii", "replace").strip())
+
+    def send(self, text):
+        data = (text + "\n").encode("ascii")
+        while data:
+            try:
+                data = data[os.write(self.master, data):]
+            except BlockingIOError:
+                # nobody's reading, a real controller would drop it too
+                return
+
+    """
+        checks a line the way Marlin does and queues its command
+    """
+    def receive(self, line):
+        if not line or self.halted:
+            return
+        self.stats["lines"] += 1
+        self.received += 1
+        if self.halt_after and self.received >= self.halt_after:
+            self.halted = True
+            self.send("Error:Printer halted. kill() called!")
+            return
+        text = line
+        if line.startswith("N"):
+            if "*" not in line:
+                return self.reject("No Checksum with line number, Last Line: " + str(self.last_line))
+            body, _, sent = line.rpartition("*")
+            number_end = body.find(" ")
+            number = int(body[1:number_end]) if number_end > 0 else int(body[1:])
+            text = body[number_end + 1:] if number_end > 0 else ""
+            code, words = command_words(text)
+            if code == "M110":
+                # line numbers start over, no matter what they were
+                self.last_line = number
+                self.commands.put_nowait((number, text))
+                return
+            if number != self.last_line + 1:
+                self.stats["line_errors"] += 1
+                return self.reject("Line Number is not Last Line Number+1, Last Line: " + str(self.last_line))
+            if not sent.strip().isdigit() or int(sent) != checksum(body) or (self.error_every and self.received % self.error_every == 0):
+                self.stats["checksum_errors"] += 1
+                return self.reject("checksum mismatch, Last Line: " + str(self.last_line))
+            self.last_line = number
+        self.commands.put_nowait((self.last_line, text))
+
+    def reject(self, message):
+        self.send("Error:" + message)
+        self.send("Resend: " + str(self.last_line + 1))
+        self.send("ok")
+
+    """
+        takes commands off the buffer one at a time
+    """
+    async def process(self):
+        while True:
+            number, text = await self.commands.get()
+            self.stats["commands"] += 1
+            record = parse_line(text)
+            if record is None:
+                self.ok(number)
+                continue
+            code, words = command_words(text)
+            if code in ("M400", "G28", "M0", "M1", "M18", "M84"):
+                # wait for the machine to stop, a dry planner isn't an underrun then
+                self.syncing = True
+                await self.busy(self.wait_planner_empty())
+            state = self.simulator.step(record)
+            if state.kind == MOVE and state.duration > 0:
+                await self.busy(self.wait_planner_room())
+                self.planner.append(state.duration)
+                self.planner_changed.set()
+                self.stats["moves"] += 1
+                self.stats["machine_seconds"] += state.duration
+            elif state.duration > 0:
+                # homing
+                await self.busy(asyncio.sleep(state.duration * self.time_scale))
+                self.stats["machine_seconds"] += state.duration
+            self.syncing = False
+            self.ok(number)
+
+    def ok(self, number):
+        if self.halted:
+            return
+        self.send("ok N" + str(number) + " P" + str(self.planner_size - len(self.planner)) + " B"
+                  + str(max(0, self.buffer_size - self.commands.qsize())))
+
+    """
+        waits on something, telling the host the controller is busy every so often like Marlin does
+    """
+    async def busy(self, awaitable):
+        task = asyncio.ensure_future(awaitable)
+        while True:
+            done, pending = await asyncio.wait([task], timeout = KEEPALIVE_SECONDS)
+            if done:
+                return task.result()
+            self.send("echo:busy: processing")
+
+    async def wait_planner_room(self):
+        while len(self.planner) >= self.planner_size:
+            await self.wait_planner()
+
+    async def wait_planner_empty(self):
+        while self.planner:
+            await self.wait_planner()
+
+    async def wait_planner(self):
+        self.planner_changed.clear()
+        await self.planner_changed.wait()
+
+    """
+        plays the planner out
+    """
+    async def play(self):
+        while True:
+            if not self.planner:
+                if self.empty_since is None and not self.syncing:
+                    self.empty_since = time.perf_counter()
+                await self.wait_planner()
+                continue
+            if self.empty_since is not None:
+                if self.time_scale > 0 and self.stats["moves"] > 1:
+                    self.stats["underruns"] += 1
+                    self.stats["underrun_seconds"] += (time.perf_counter() - self.empty_since) / self.time_scale
+                self.empty_since = None
+            duration = self.planner[0]
+            if self.time_scale > 0:
+                await asyncio.sleep(duration * self.time_scale)
+            else:
+                # let the rest of the controller run
+                await asyncio.sleep(0)
+            self.planner.popleft()
+            self.planner_changed.set()
@@ -0,0 +1,251 @@
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from Toolpath import Command, Stage
+from ToolpathBinary import ToolpathFile, record_array, positions, MOVE, STAGE, COMMAND, EXTENSION
+
+"""
+Filament used by a program, integrated over the moves it actually makes
+TubeWinder's "Estimated Winding Length" only counts a straight run along the tube and a turn of it
+per pass, whatever the wind angle, extension, turnarounds and re-indexing. Here every move of the
+tie down and the wraps is measured on the unrolled surface of the mandrel, where a helix is a
+straight line: sqrt(dx^2 + de^2), e already being mm of surface. The positions come from
+ToolpathBinary (G92 and G28 included), so the whole program is measured in a few array operations,
+and a .cawtp file is measured straight off its memory map.
+
+Filament piles up one layer per wrap row. Given its thickness, every row after the first is
+measured at the radius it lays at, the e distances growing with it.
+
+Lengths are kept per pass, per stage (the tie down and every wrap row) and per job. spool_plan
+works out which spools to stage for a run and where to change them. A stage can't be stopped
+halfway to change a spool, so a spool that won't last through a stage is changed before it starts.
+Only a stage longer than a whole spool gets spliced, at the start of a pass.
+
+usage: python FilamentModel.py manifest.json|program.gcode|program.cawtp [--spool 500] [--loaded 120] [--thickness .005]
+
+"""
+
+# the stages that lay filament, the tie down is marked as a wrap too
+LAYING_STAGES = ("Wrap",)
+PASS_PREFIX = "M117 Pass "
+
+
+class StageUse:
+    """
+        @param layer: layer the stage lays on, 1 being the mandrel
+    """
+    def __init__(self, name, layer):
+        self.name = name
+        self.layer = layer
+        # mm
+        self.length = 0.0
+        self.passes = []
+
+    def to_dict(self):
+        return {"name": self.name, "layer": self.layer, "m": round(self.length / 1000, 3), "passes": len(self.passes),
+                "pass_m": [round(length / 1000, 4) for length in self.passes]}
+
+
+class FilamentUse:
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+
+    """
+        filament (mm) the whole program uses
+    """
+    def total(self):
+        return sum(stage.length for stage in self.stages)
+
+    def to_dict(self):
+        return {"name": self.name, "m": round(self.total() / 1000, 3), "stages": [stage.to_dict() for stage in self.stages]}
+
+
+"""
+    filament used by a program
+    @param records: RECORD_DTYPE array of the program (see ToolpathBinary)
+    @param marks: list of (index, stage name or pass number) for the records that start a stage or a pass
+    @param radius: radius (mm) of the mandrel, only needed with a thickness
+    @param thickness: thickness (mm) of the filament
+    @return FilamentUse
+"""
+def filament_use(records, marks, radius = None, thickness = 0, name = None, stages = LAYING_STAGES):
+    if thickness and not radius:
+        raise ValueError("The mandrel's radius is needed to account for the filament's thickness")
+    use = FilamentUse(name)
+    if len(records) == 0:
+        return use
+    at = positions(records)
+    moving = records["kind"] == MOVE
+    # how far x and e went on every record, nothing for anything but a move (a G92 jumps without moving)
+    dx = np.where(moving, np.diff(at[:, 0], prepend = at[0, 0]), 0.0)
+    de = np.where(moving, np.diff(at[:, 3], prepend = at[0, 3]), 0.0)
+    marks = sorted(marks, key = lambda mark: mark[0])
+    bounds = [mark[0] for mark in marks] + [len(records)]
+    stage = None
+    wraps = 0
+    scale = 1.0
+    for i, (index, mark) in enumerate(marks):
+        if isinstance(mark, str):
+            stage = None
+            if mark in stages:
+                # the tie down is the wrap without any passes
+                has_passes = i + 1 < len(marks) and not isinstance(marks[i + 1][1], str)
+                if mark == "Wrap" and not has_passes:
+                    mark = "Tie Down Wrap"
+                elif mark == "Wrap":
+                    wraps += 1
+                    mark = "Wrap " + str(wraps)
+                stage = StageUse(mark, max(1, wraps))
+                use.stages.append(stage)
+                # e is mm of the mandrel's surface, a layer further out goes further around
+                scale = 1 + thickness * (stage.layer - .5) / radius if thickness else 1.0
+        if stage is None:
+            continue
+        end = bounds[i + 1]
+        length = float(np.hypot(dx[index:end], de[index:end] * scale).sum())
+        stage.length += length
+        if not isinstance(mark, str):
+            stage.passes.append(length)
+        elif stage.passes:
+            # anything between the passes belongs to the one before
+            stage.passes[-1] += length
+    return use
+
+
+"""
+    filament used by a stream of records (see Toolpath)
+"""
+def records_use(records, radius = None, thickness = 0, name = None):
+    records = list(records)
+    marks = []
+    for index, record in enumerate(records):
+        if isinstance(record, Stage):
+            marks.append((index, record.name))
+        elif isinstance(record, Command) and record.text.startswith(PASS_PREFIX):
+            marks.append((index, len(marks)))
+    return filament_use(record_array(records), marks, radius, thickness, name)
+
+
+"""
+    filament used by a WindJob
+    @param thickness: thickness (mm) of the filament
+"""
+def job_use(job, thickness = 0, name = None):
+    winder = job.create_winder(on_report = lambda name, value: None)
+    records = list(job.records(winder))
+    return records_use(records, winder.diameter / 2, thickness, name or job.name)
+
+
+"""
+    filament used by a G-code or .cawtp file
+"""
+def file_use(path, radius = None, thickness = 0):
+    if not path.endswith(EXTENSION):
+        from GcodeParser import parse_file
+
+        return records_use((record for line, record in parse_file(path)), radius, thickness, path)
+    with ToolpathFile(path) as program:
+        marks = [(int(index), program.text(index)) for index in program.indexes(STAGE)]
+        for index in program.indexes(COMMAND):
+            if program.text(index).startswith(PASS_PREFIX):
+                marks.append((int(index), int(index)))
+        return filament_use(program.records, marks, radius, thickness, path)
+
+
+"""
+    works out the spools a run takes and when to change them
+    a spool is changed before any stage it won't last through. A stage that takes more than a whole
+    spool has to be spliced, at the start of every pass a spool runs out on. Filament with no pass to
+    splice before (a tie down, or a single pass longer than a spool) is spliced right where the spool runs out
+    @param uses: FilamentUse of every job, in the order they run
+    @param spool: filament (mm) on a full spool
+    @param loaded: filament (mm) left on the spool that's loaded, None to start with a full one
+    @return dictionary of spools (full spools used) and changes, a list of where to change spools. at_m is
+        how far into the stage a splice that isn't at the start of a pass comes, None for every other change
+"""
+def spool_plan(uses, spool, loaded = None):
+    if spool <= 0:
+        raise ValueError("A spool has to hold some filament")
+    remaining = spool if loaded is None else loaded
+    spools = 1 if loaded is None else 0
+    changes = []
+    for use in uses:
+        for stage in use.stages:
+            if stage.length <= remaining:
+                remaining -= stage.length
+                continue
+            if stage.length <= spool:
+                changes.append({"job": use.name, "stage": stage.name, "pass": None, "at_m": None, "left_m": round(remaining / 1000, 3)})
+                spools += 1
+                remaining = spool - stage.length
+                continue
+            # more than a whole spool, it's spliced anyway, so use up what's loaded and splice wherever it runs out.
+            # The filament before the first pass goes first, with no pass to splice before
+            pieces = [(None, stage.length - sum(stage.passes))] + [(number + 1, length) for number, length in enumerate(stage.passes)]
+            laid = 0.0
+            for number, length in pieces:
+                if number is not None and remaining < length <= spool:
+                    changes.append({"job": use.name, "stage": stage.name, "pass": number, "at_m": None, "left_m": round(remaining / 1000, 3)})
+                    spools += 1
+                    remaining = spool
+                while length > remaining:
+                    laid += remaining
+                    length -= remaining
+                    changes.append({"job": use.name, "stage": stage.name, "pass": number, "at_m": round(laid / 1000, 3), "left_m": 0.0})
+                    spools += 1
+                    remaining = spool
+                remaining -= length
+                laid += length
+    return {"spools": spools, "changes": changes, "left_m": round(remaining / 1000, 3)}
+
+
+def main(argv = None):
+    from WindJob import load_manifest, INCH
+
+    parser = argparse.ArgumentParser(description = "Work out the filament a program uses and the spools it takes")
+    parser.add_argument("program", help = "json manifest of jobs, or a G-code or .cawtp file")
+    parser.add_argument("--spool", type = float, default = None, help = "filament on a full spool (m), to plan the spools")
+    parser.add_argument("--loaded", type = float, default = None, help = "filament left on the loaded spool (m), default a full one")
+    parser.add_argument("--thickness", type = float, default = 0, help = "thickness of the filament (in), to account for the layers building up")
+    parser.add_argument("--od", type = float, default = None, help = "outer diameter of the mandrel (in), for a thickness with a G-code file")
+    parser.add_argument("--json", default = None, help = "also write the report as json to this file")
+    args = parser.parse_args(argv)
+
+    thickness = args.thickness * INCH
+    if args.program.endswith(".json"):
+        uses = [job_use(job, thickness, job.name or ("job " + str(i + 1))) for i, job in enumerate(load_manifest(args.program))]
+    else:
+        if thickness and not args.od:
+            parser.error("--thickness needs the mandrel's --od with a G-code file")
+        uses = [file_use(args.program, args.od * INCH / 2 if args.od else None, thickness)]
+    for use in uses:
+        print(use.name + ": " + str(round(use.total() / 1000, 2)) + "m")
+        for stage in use.stages:
+            line = "    " + stage.name + ": " + str(round(stage.length / 1000, 2)) + "m"
+            if stage.passes:
+                line += " over " + str(len(stage.passes)) + " passes (" + str(round(min(stage.passes) / 1000, 3)) + "-" + str(round(max(stage.passes) / 1000, 3)) + "m)"
+            print(line)
+    report = {"jobs": [use.to_dict() for use in uses], "m": round(sum(use.total() for use in uses) / 1000, 3)}
+    if args.spool is not None:
+        plan = spool_plan(uses, args.spool * 1000, args.loaded * 1000 if args.loaded is not None else None)
+        report["spools"] = plan
+        print(str(plan["spools"]) + " full spools, " + str(plan["left_m"]) + "m left on the last one")
+        for change in plan["changes"]:
+            where = change["stage"] + (" pass " + str(change["pass"]) if change["pass"] is not None else "")
+            if change["at_m"] is not None:
+                print("    splice " + change["job"] + " " + where + " where the spool runs out, " + str(change["at_m"]) + "m into the stage")
+                continue
+            print("    " + ("splice" if change["pass"] is not None else "change the spool") + " before " + change["job"] + " " + where
+                  + " (" + str(change["left_m"]) + "m left)")
+    if args.json is not None:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent = 2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
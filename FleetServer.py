@@ -0,0 +1,643 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+
+from GcodeSender import GcodeSender, SerialPort, SenderError, load_records, DEFAULT_BAUDRATE, DEFAULT_WINDOW, PASS_PATTERN
+from Toolpath import Command, Stage
+
+"""
+Local job server that keeps a fleet of winders busy
+Holds a queue of programs (G-code files, or jobs out of a manifest, generated as they go out) and
+streams them to every machine at once, each through its own GcodeSender. Machines take the next job
+off the one queue as soon as they're idle, so the work spreads itself over the fleet and no machine
+waits while there's anything queued.
+
+A machine that faults partway (the controller halts, stops answering or the port goes away) hands
+its job back to the front of the queue, for the next idle machine to wind from the start, and sits
+out retry_seconds before it tries to connect again. A job goes to a machine it already faulted on
+only once it's faulted on all of them, and fails for good after attempts tries. The stage and pass
+it got to are kept, for ProgramIndex to resume the half wound tube from.
+
+M0/M1 prompts hold their machine until an operator answers them ("continue"), unless the server
+was started to carry on through them.
+
+The server is run and talked to over a local socket, one line of json each way:
+
+    {"command": "submit", "program": "/path/to/tube.gcode"}      a manifest without a "job" queues every job in it
+    {"command": "status"}
+    {"command": "continue", "machine": "winder1"}
+    {"command": "shutdown"}                                      stop taking jobs, exit once the running ones are done
+
+--fake N runs the whole fleet against emulated controllers (see FakeController) on this machine.
+
+usage: python FleetServer.py serve --machine winder1=/dev/ttyACM0 --machine winder2=/dev/ttyACM1 [programs]
+       python FleetServer.py serve --fake 3 -y --time-scale .01 --halt fake2:400 --exit-when-done a.gcode b.gcode c.gcode
+       python FleetServer.py submit tube.gcode manifest.json
+       python FleetServer.py status
+       python FleetServer.py continue winder1
+
+"""
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# tries a job gets before it's failed
+DEFAULT_ATTEMPTS = 3
+# seconds a faulted machine sits out before connecting again
+DEFAULT_RETRY_SECONDS = 30
+
+# job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# machine states
+IDLE = "idle"
+BUSY = "busy"
+PROMPT = "prompt"
+FAULTED = "faulted"
+
+
+class FleetJob:
+    """
+        @param program: G-code file or json manifest
+        @param job: name or index of the job in a manifest (see GcodeSender.load_records)
+    """
+    def __init__(self, number, program, job = None, name = None):
+        self.number = number
+        self.program = program
+        self.job = job
+        self.name = name or (os.path.basename(program) + (" " + job if job is not None else ""))
+        self.state = QUEUED
+        self.machine = None
+        self.attempts = 0
+        # machines it faulted on
+        self.faulted_on = set()
+        self.error = None
+        # lines of the program, when it's known up front
+        self.lines = None
+        # where the job has got to, as far as the controller has acknowledged: the line of the program,
+        # the stage (numbered from its second time, ie "Wrap 2") and the last pass started in it
+        self.lines_done = 0
+        self.stage = None
+        self.status = None
+        # (sender line, program line, stage, status) after every record handed to the sender, until it's acknowledged
+        self.in_flight = deque()
+        self.sender = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    """
+        the records of the program, noting the line, stage and pass each one leaves the program at
+        @param sender: GcodeSender the records go out through, its acknowledged lines move the job along
+    """
+    def records(self, sender):
+        self.lines_done = 0
+        self.stage = None
+        self.status = None
+        self.in_flight = deque()
+        self.sender = sender
+        occurrences = {}
+        stage = None
+        status = None
+        for line, record in self.numbered_records():
+            if isinstance(record, Stage):
+                occurrences[record.name] = occurrences.get(record.name, 0) + 1
+                stage = record.name + (" " + str(occurrences[record.name]) if occurrences[record.name] > 1 else "")
+                status = None
+            elif isinstance(record, Command) and record.text.startswith("M117") and PASS_PATTERN.search(record.text):
+                status = record.text[5:].strip()
+            yield record
+            # the sender has sent the record (or passed over it) by the time it asks for the next one
+            self.in_flight.append((sender.stats["lines"], line, stage, status))
+            self.acknowledge()
+
+    """
+        the records with the line of the program they're on. A file's come with their own, a generated
+        program's are numbered the way they're written (see ProgramIndexer.index_records)
+    """
+    def numbered_records(self):
+        if not self.program.endswith(".json"):
+            from GcodeParser import parse_file
+
+            yield from parse_file(self.program)
+            return
+        line = 0
+        # the winder's calculations would only clutter the server's log
+        for record in load_records(self.program, self.job, on_report = lambda name, value: None):
+            # a stage is written after two blank lines
+            line += 3 if isinstance(record, Stage) else 1
+            yield line, record
+
+    """
+        moves the job along to the last record the controller has answered every line of
+    """
+    def acknowledge(self):
+        if self.sender is None:
+            return
+        acknowledged = self.sender.stats["lines"] - self.sender.outstanding
+        while self.in_flight and self.in_flight[0][0] <= acknowledged:
+            sent, self.lines_done, self.stage, self.status = self.in_flight.popleft()
+
+    """
+        fraction of the program the controller has acknowledged, None when its length isn't known
+    """
+    def progress(self):
+        if self.state == DONE:
+            return 1.0
+        if not self.lines:
+            return None
+        self.acknowledge()
+        return min(1.0, self.lines_done / self.lines)
+
+    """
+        where the job got to, ie "Wrap 2 pass 12 of 55"
+    """
+    def checkpoint(self):
+        self.acknowledge()
+        if self.stage is None:
+            return None
+        return self.stage + (" " + self.status.lower() if self.status else "")
+
+    def to_dict(self):
+        progress = self.progress()
+        return {"number": self.number, "name": self.name, "program": self.program, "job": self.job, "state": self.state, "machine": self.machine,
+                "attempts": self.attempts, "progress": round(progress, 4) if progress is not None else None, "checkpoint": self.checkpoint(),
+                "error": self.error, "submitted": self.submitted, "started": self.started, "finished": self.finished}
+
+
+class Machine:
+    """
+        @param port: serial port of the controller
+        @param window: lines kept in flight (see GcodeSender)
+        @param fake: dictionary of FakeController arguments to emulate the controller with, None for a real one
+    """
+    def __init__(self, name, port = None, baudrate = DEFAULT_BAUDRATE, window = DEFAULT_WINDOW, fake = None):
+        if port is None and fake is None:
+            raise ValueError("Machine " + name + " needs a port")
+        self.name = name
+        self.port = port
+        self.baudrate = baudrate
+        self.window = window
+        self.fake = fake
+        self.controller = None
+        self.state = IDLE
+        self.job = None
+        self.prompt = None
+        self.answered = None
+        self.error = None
+        self.busy_since = None
+        self.stats = {"jobs": 0, "faults": 0, "lines": 0, "busy_seconds": 0.0}
+
+    """
+        opens the port to the controller, starting an emulated one (again, after it halted) when the machine is fake
+    """
+    async def open(self):
+        if self.fake is None:
+            return SerialPort(self.port, self.baudrate)
+        if self.controller is None or self.controller.halted:
+            from FakeController import FakeController
+
+            if self.controller is not None:
+                await self.controller.stop()
+                # a halt is a one off, the restarted controller keeps going
+                self.fake = dict(self.fake, halt_after = 0)
+            self.controller = FakeController(**self.fake)
+            await self.controller.start()
+        return SerialPort(self.controller.port_name)
+
+    async def close(self):
+        if self.controller is not None:
+            await self.controller.stop()
+            self.controller = None
+
+    """
+        seconds spent on jobs, including the one running
+    """
+    def busy_seconds(self):
+        seconds = self.stats["busy_seconds"]
+        if self.busy_since is not None:
+            seconds += time.perf_counter() - self.busy_since
+        return seconds
+
+    def to_dict(self, uptime):
+        return {"name": self.name, "port": self.port if self.fake is None else "fake", "state": self.state,
+                "job": self.job.number if self.job is not None else None, "prompt": self.prompt, "error": self.error,
+                "jobs": self.stats["jobs"], "faults": self.stats["faults"], "lines": self.stats["lines"],
+                "utilization": round(self.busy_seconds() / uptime, 4) if uptime > 0 else 0.0}
+
+
+class FleetServer:
+    """
+        @param machines: list of Machines
+        @param attempts: tries a job gets before it's failed
+        @param retry_seconds: seconds a faulted machine sits out
+        @param auto_continue: carry on through M0/M1 prompts instead of waiting for an operator
+        @param on_event: called with a line of text for everything that happens to a job or machine
+    """
+    def __init__(self, machines, attempts = DEFAULT_ATTEMPTS, retry_seconds = DEFAULT_RETRY_SECONDS, auto_continue = False, on_event = None):
+        if not machines:
+            raise ValueError("A fleet needs at least one machine")
+        self.machines = {machine.name: machine for machine in machines}
+        if len(self.machines) != len(machines):
+            raise ValueError("Every machine needs its own name")
+        self.attempts = attempts
+        self.retry_seconds = retry_seconds
+        self.auto_continue = auto_continue
+        self.on_event = on_event
+        self.jobs = []
+        self.queue = []
+        self.changed = None
+        self.closing = False
+        self.started = time.perf_counter()
+
+    def event(self, text):
+        if self.on_event is not None:
+            self.on_event(text)
+
+    """
+        queues a program
+        @param program: G-code file, or a json manifest. A manifest without a job queues every job in it
+        @return list of the FleetJobs queued
+    """
+    def submit(self, program, job = None, name = None):
+        if not os.path.exists(program):
+            raise ValueError("No such program " + program)
+        if program.endswith(".json") and job is None:
+            from WindJob import load_manifest
+
+            manifest = load_manifest(program)
+            entries = [(str(i), manifest_job.name) for i, manifest_job in enumerate(manifest)]
+        else:
+            entries = [(job, name)]
+        queued = []
+        for entry_job, entry_name in entries:
+            fleet_job = FleetJob(len(self.jobs) + 1, program, entry_job, entry_name)
+            if not program.endswith(".json"):
+                from ProgramIndex import load_index
+
+                # also leaves the index next to the program, to resume from after a fault
+                fleet_job.lines = load_index(program).lines
+            self.jobs.append(fleet_job)
+            self.queue.append(fleet_job)
+            queued.append(fleet_job)
+            self.event("queued job " + str(fleet_job.number) + " " + fleet_job.name)
+        return queued
+
+    """
+        wakes up the machines waiting on the queue, after anything that could give one of them a job
+    """
+    async def notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    """
+        the next job for a machine, a job isn't given back to a machine it faulted on while another can take it
+    """
+    def next_job(self, machine):
+        for job in self.queue:
+            if machine.name not in job.faulted_on or len(job.faulted_on) >= len(self.machines):
+                return job
+        return None
+
+    def finished(self):
+        return not self.queue and all(machine.job is None for machine in self.machines.values())
+
+    async def run_machine(self, machine):
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: self.closing or self.next_job(machine) is not None)
+                if self.closing:
+                    return
+                job = self.next_job(machine)
+                self.queue.remove(job)
+            await self.dispatch(machine, job)
+            await self.notify()
+
+    """
+        winds a job on a machine
+    """
+    async def dispatch(self, machine, job):
+        job.state = RUNNING
+        job.machine = machine.name
+        job.attempts += 1
+        job.started = time.time()
+        machine.state = BUSY
+        machine.job = job
+        machine.error = None
+        machine.busy_since = time.perf_counter()
+        self.event(machine.name + ": started job " + str(job.number) + " " + job.name)
+
+        error = None
+        try:
+            port = await machine.open()
+            sender = GcodeSender(port, machine.window, prompt = lambda message: self.operator_prompt(machine, message))
+            try:
+                await sender.connect()
+                await sender.send_records(job.records(sender))
+            finally:
+                machine.stats["lines"] += sender.stats["lines"]
+                await sender.close()
+        except (SenderError, OSError) as e:
+            error = e
+            machine.state = FAULTED
+        except Exception as e:
+            # the program itself is at fault (ie a manifest job that can't be generated), not the machine
+            job.state = FAILED
+            job.error = type(e).__name__ + ": " + str(e)
+            self.event(machine.name + ": job " + str(job.number) + " failed, " + job.error)
+        else:
+            job.state = DONE
+            machine.stats["jobs"] += 1
+            self.event(machine.name + ": finished job " + str(job.number) + " " + job.name)
+        finally:
+            machine.stats["busy_seconds"] = machine.busy_seconds()
+            machine.busy_since = None
+            machine.job = None
+            machine.prompt = None
+            if machine.state != FAULTED:
+                machine.state = IDLE
+        if error is not None:
+            await self.fault(machine, job, error)
+            return
+        job.finished = time.time()
+
+    """
+        hands a job back to the queue after its machine faulted, and sits the machine out for a while
+    """
+    async def fault(self, machine, job, error):
+        machine.error = str(error)
+        machine.stats["faults"] += 1
+        job.faulted_on.add(machine.name)
+        job.error = machine.name + ": " + str(error)
+        where = (" at " + job.checkpoint()) if job.checkpoint() else ""
+        if job.attempts < self.attempts:
+            job.state = QUEUED
+            job.machine = None
+            # to the front, it's waited longest
+            self.queue.insert(0, job)
+            self.event(machine.name + ": faulted" + where + " (" + str(error) + "), job " + str(job.number) + " requeued")
+        else:
+            job.state = FAILED
+            job.finished = time.time()
+            self.event(machine.name + ": faulted" + where + " (" + str(error) + "), job " + str(job.number) + " failed after "
+                       + str(job.attempts) + " tries")
+        async with self.changed:
+            # let another machine pick the job up straight away
+            self.changed.notify_all()
+            try:
+                # a shut down doesn't wait the time out
+                await asyncio.wait_for(self.changed.wait_for(lambda: self.closing), self.retry_seconds)
+            except asyncio.TimeoutError:
+                pass
+        machine.state = IDLE
+        self.event(machine.name + ": back after a fault")
+
+    """
+        holds a machine at an M0/M1 until someone answers it (see answer)
+    """
+    async def operator_prompt(self, machine, message):
+        if self.auto_continue:
+            return
+        machine.state = PROMPT
+        machine.prompt = message
+        machine.answered = asyncio.Event()
+        self.event(machine.name + ": waiting on \"" + message + "\"")
+        await machine.answered.wait()
+        machine.state = BUSY
+        machine.prompt = None
+
+    """
+        carries on past a machine's prompt
+    """
+    def answer(self, name):
+        machine = self.machines.get(name)
+        if machine is None:
+            raise ValueError("No machine " + str(name))
+        if machine.state != PROMPT:
+            raise ValueError(name + " isn't waiting on anything")
+        machine.answered.set()
+
+    def status(self):
+        uptime = time.perf_counter() - self.started
+        return {"uptime": round(uptime, 3), "queued": len(self.queue), "closing": self.closing, "machines": [machine.to_dict(uptime) for machine in self.machines.values()],
+                "jobs": [job.to_dict() for job in self.jobs]}
+
+    """
+        answers one request from a client
+        @param request: dictionary with a "command" and its arguments
+    """
+    async def handle(self, request):
+        command = request.get("command")
+        if command == "submit":
+            jobs = self.submit(request["program"], request.get("job"), request.get("name"))
+            await self.notify()
+            return {"ok": True, "jobs": [job.number for job in jobs]}
+        if command == "status":
+            return dict(self.status(), ok = True)
+        if command == "continue":
+            self.answer(request.get("machine"))
+            return {"ok": True}
+        if command == "shutdown":
+            self.closing = True
+            await self.notify()
+            return {"ok": True}
+        raise ValueError("Unknown command " + str(command))
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    answer = await self.handle(json.loads(line))
+                except Exception as e:
+                    answer = {"ok": False, "error": type(e).__name__ + ": " + str(e)}
+                writer.write((json.dumps(answer) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    """
+        runs the fleet until it's shut down
+        @param host, port: where to listen for clients, a port of None doesn't listen
+        @param exit_when_done: shut down once nothing is queued or running
+    """
+    async def run(self, host = DEFAULT_HOST, port = DEFAULT_PORT, exit_when_done = False):
+        self.changed = asyncio.Condition()
+        self.started = time.perf_counter()
+        server = None
+        if port is not None:
+            server = await asyncio.start_server(self.handle_client, host, port)
+            self.event("listening on " + host + ":" + str(port))
+        workers = [asyncio.ensure_future(self.run_machine(machine)) for machine in self.machines.values()]
+        try:
+            async with self.changed:
+                await self.changed.wait_for(lambda: self.closing or (exit_when_done and self.finished()))
+                self.closing = True
+                self.changed.notify_all()
+            # running jobs are finished first
+            await asyncio.gather(*workers, return_exceptions = True)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+            for machine in self.machines.values():
+                await machine.close()
+
+
+"""
+    sends one request to a running server
+    @return the server's answer
+"""
+async def request(message, host = DEFAULT_HOST, port = DEFAULT_PORT):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write((json.dumps(message) + "\n").encode())
+        await writer.drain()
+        line = await reader.readline()
+    finally:
+        writer.close()
+    if not line:
+        raise ConnectionError("The server closed the connection")
+    return json.loads(line)
+
+
+"""
+    parses a machine, ie "winder1=/dev/ttyACM0"
+"""
+def parse_machine(text):
+    if "=" not in text:
+        raise argparse.ArgumentTypeError("machines go as <name>=<port>, not " + text)
+    return tuple(text.split("=", 1))
+
+
+"""
+    parses where to halt an emulated machine, ie "fake2:400"
+"""
+def parse_halt(text):
+    name, _, lines = text.rpartition(":")
+    if not name or not lines.isdigit():
+        raise argparse.ArgumentTypeError("halts go as <machine>:<lines>, not " + text)
+    return name, int(lines)
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return host or DEFAULT_HOST, int(port)
+
+
+def print_event(text):
+    print(time.strftime("%H:%M:%S") + " " + text, flush = True)
+
+
+def print_status(status):
+    print("up " + str(status["uptime"]) + "s, " + str(status["queued"]) + " queued" + (", shutting down" if status["closing"] else ""))
+    for machine in status["machines"]:
+        line = "    " + machine["name"] + ": " + machine["state"]
+        if machine["job"] is not None:
+            line += " job " + str(machine["job"])
+        if machine["prompt"] is not None:
+            line += " waiting on \"" + machine["prompt"] + "\""
+        line += ", " + str(machine["jobs"]) + " jobs, " + str(machine["faults"]) + " faults, " + str(round(machine["utilization"] * 100, 1)) + "% busy"
+        print(line)
+    for job in status["jobs"]:
+        line = "    job " + str(job["number"]) + " " + job["name"] + ": " + job["state"]
+        if job["machine"] is not None:
+            line += " on " + job["machine"]
+        if job["state"] == RUNNING and job["progress"] is not None:
+            line += " " + str(round(job["progress"] * 100, 1)) + "%"
+        if job["checkpoint"] is not None and job["state"] != DONE:
+            line += " at " + job["checkpoint"]
+        if job["error"] is not None and job["state"] != DONE:
+            line += " (" + job["error"] + ")"
+        print(line)
+
+
+def serve(args):
+    halts = dict(args.halt or [])
+    machines = [Machine(name, port, args.baud, args.window) for name, port in args.machine or []]
+    for i in range(args.fake):
+        name = "fake" + str(i + 1)
+        machines.append(Machine(name, window = args.window, fake = {"time_scale": args.time_scale, "error_every": args.error_every,
+                                                                     "halt_after": halts.get(name, 0)}))
+    fleet = FleetServer(machines, args.attempts, args.retry, auto_continue = args.yes,
+                        on_event = print_event)
+    for program in args.programs:
+        fleet.submit(os.path.abspath(program))
+    host, port = parse_address(args.listen)
+    try:
+        asyncio.run(fleet.run(host, None if args.no_listen else port, args.exit_when_done))
+    except KeyboardInterrupt:
+        pass
+    status = fleet.status()
+    print_status(status)
+    return 0 if all(job["state"] == DONE for job in status["jobs"]) else 1
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Queue programs and wind them on a fleet of winders")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    serve_parser = commands.add_parser("serve", help = "run the server")
+    serve_parser.add_argument("programs", nargs = "*", help = "programs to queue straight away")
+    serve_parser.add_argument("-m", "--machine", type = parse_machine, action = "append", help = "a machine, as <name>=<port>, can be given more than once")
+    serve_parser.add_argument("--fake", type = int, default = 0, help = "add this many emulated machines")
+    serve_parser.add_argument("--time-scale", type = float, default = 0.0, help = "how fast the emulated machines run, 1 is real time")
+    serve_parser.add_argument("--error-every", type = int, default = 0, help = "have the emulated controllers garble every nth line")
+    serve_parser.add_argument("--halt", type = parse_halt, action = "append", help = "halt an emulated machine after this many lines, ie fake2:400")
+    serve_parser.add_argument("-b", "--baud", type = int, default = DEFAULT_BAUDRATE)
+    serve_parser.add_argument("-w", "--window", type = int, default = DEFAULT_WINDOW, help = "lines kept in flight")
+    serve_parser.add_argument("--attempts", type = int, default = DEFAULT_ATTEMPTS, help = "tries a job gets before it's failed")
+    serve_parser.add_argument("--retry", type = float, default = DEFAULT_RETRY_SECONDS, help = "seconds a faulted machine sits out")
+    serve_parser.add_argument("-y", "--yes", action = "store_true", help = "carry on through M0 prompts without waiting for an operator")
+    serve_parser.add_argument("--exit-when-done", action = "store_true", help = "shut down once nothing is queued or running")
+    serve_parser.add_argument("--no-listen", action = "store_true", help = "don't take requests from clients")
+    submit_parser = commands.add_parser("submit", help = "queue programs on a running server")
+    submit_parser.add_argument("programs", nargs = "+", help = "G-code files or json manifests")
+    submit_parser.add_argument("--job", default = None, help = "name or index of the one job to queue from a manifest")
+    commands.add_parser("status", help = "show the machines and jobs of a running server")
+    continue_parser = commands.add_parser("continue", help = "carry on past the prompt a machine is waiting on")
+    continue_parser.add_argument("machine")
+    commands.add_parser("shutdown", help = "stop a running server once its running jobs are done")
+    for command_parser in commands.choices.values():
+        command_parser.add_argument("--listen", default = DEFAULT_HOST + ":" + str(DEFAULT_PORT), help = "address of the server")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        if not args.machine and not args.fake:
+            parser.error("a --machine or --fake is needed")
+        return serve(args)
+    host, port = parse_address(args.listen)
+    if args.command == "submit":
+        messages = [{"command": "submit", "program": os.path.abspath(program), "job": args.job} for program in args.programs]
+    elif args.command == "continue":
+        messages = [{"command": "continue", "machine": args.machine}]
+    else:
+        messages = [{"command": args.command}]
+    try:
+        for message in messages:
+            answer = asyncio.run(request(message, host, port))
+            if not answer["ok"]:
+                print("Error: " + answer["error"])
+                return 1
+            if args.command == "status":
+                print_status(answer)
+            elif args.command == "submit":
+                print(message["program"] + ": queued as job " + ", ".join(str(number) for number in answer["jobs"]))
+    except OSError as e:
+        print("Error: can't reach the server at " + args.listen + ", " + str(e))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+import sys
+from math import sqrt
+
+from MachineSimulator import MachineSimulator, command_words, AXES, MOVE, STAGE, SET_POSITION
+from Toolpath import Move, Command, Stage
+
+"""
+Peephole optimizer for generated programs
+Takes a stream of records (see Toolpath) and gives back a shorter stream that moves the machine
+along exactly the same path:
+    - moves that don't go anywhere are dropped (their feedrate is kept for the next move)
+    - axes a move names but that are already in place are left off
+    - back to back moves in the same direction at the same feedrate are merged into one
+    - F words that don't change the feedrate are left off
+    - G92s that set an axis to where it already is are dropped
+
+Nothing is moved across a command (prompts, homing, unit changes, status messages) or a stage
+comment. same_trajectory checks two programs against each other with a MachineSimulator.
+
+usage: python GcodeOptimizer.py in.gcode out.gcode
+
+"""
+
+# how far apart (mm) two moves can be from a straight line and still get merged
+DEFAULT_TOLERANCE = 1e-6
+
+class HeldMove:
+    """
+        a move held back in case the next one can be merged into it
+    """
+    __slots__ = ("start", "end", "feedrate")
+
+    def __init__(self, start, end, feedrate):
+        self.start = start
+        self.end = end
+        self.feedrate = feedrate
+
+
+class PeepholeOptimizer:
+    def __init__(self, tolerance = DEFAULT_TOLERANCE):
+        self.tolerance = tolerance
+        # where the program has put each axis, None when it isn't known (ie after homing)
+        self.position = {axis: None for axis in AXES}
+        # the feedrate the program asked for, and the one actually sent to the machine
+        self.wanted_feedrate = None
+        self.sent_feedrate = None
+        self.held = None
+        self.stats = {"records_in": 0, "records_out": 0, "dropped_moves": 0, "merged_moves": 0, "dropped_words": 0,
+                      "dropped_feedrates": 0, "dropped_resets": 0}
+
+    """
+        optimizes a stream of records, lazily
+        @param last: this is the end of the program. A program fed in a piece at a time (ie stage by stage)
+            should leave this off for all but the last piece, so the optimizer can carry on into the next one
+    """
+    def optimize(self, records, last = True):
+        for record in records:
+            self.stats["records_in"] += 1
+            if isinstance(record, Move):
+                out = self.add_move(record)
+            elif isinstance(record, Stage):
+                out = self.flush() + [record]
+            else:
+                out = self.add_command(record)
+            for item in out:
+                self.stats["records_out"] += 1
+                yield item
+        for item in (self.finish() if last else self.flush()):
+            self.stats["records_out"] += 1
+            yield item
+
+    def add_move(self, move):
+        if move.feedrate is not None:
+            self.wanted_feedrate = move.feedrate
+        start = {}
+        end = {}
+        for axis, value in (("X", move.x), ("Y", move.y), ("Z", move.z), ("E", move.e)):
+            if value is None:
+                continue
+            if self.position[axis] is not None and value == self.position[axis]:
+                # already there
+                self.stats["dropped_words"] += 1
+                continue
+            start[axis] = self.position[axis]
+            end[axis] = value
+        if not end:
+            # doesn't go anywhere, the feedrate carries over to the next move
+            self.stats["dropped_moves"] += 1
+            return []
+        for axis, value in end.items():
+            self.position[axis] = value
+        if self.held is not None and self.can_merge(start, end):
+            self.held.end.update(end)
+            self.stats["merged_moves"] += 1
+            return []
+        out = self.flush()
+        self.held = HeldMove(start, end, self.wanted_feedrate)
+        return out
+
+    """
+        true when the move from start to end carries straight on from the held move at the same feedrate
+    """
+    def can_merge(self, start, end):
+        held = self.held
+        if held.feedrate != self.wanted_feedrate:
+            return False
+        if any(value is None for value in held.start.values()) or any(value is None for value in start.values()):
+            return False
+        first = [held.end[axis] - held.start[axis] if axis in held.end else 0.0 for axis in AXES]
+        second = [end[axis] - start[axis] if axis in end else 0.0 for axis in AXES]
+        first_length = sqrt(sum(delta * delta for delta in first))
+        if first_length == 0:
+            return False
+        # how far along the held move's direction the new move goes, it has to keep going forwards
+        along = sum(a * b for a, b in zip(first, second)) / first_length
+        if along <= 0:
+            return False
+        # and it can't stray off that line
+        for a, b in zip(first, second):
+            if abs(b - a / first_length * along) > self.tolerance:
+                return False
+        return True
+
+    def add_command(self, command):
+        code, words = command_words(command.text)
+        if code == "G92":
+            values = {axis: (0.0 if value is None else value) for axis, value in words.items() if axis in AXES}
+            if not values:
+                values = {axis: 0.0 for axis in AXES}
+            if all(self.position[axis] is not None and self.position[axis] == value for axis, value in values.items()):
+                # every axis is already there
+                self.stats["dropped_resets"] += 1
+                return []
+            out = self.flush() + [command]
+            self.position.update(values)
+            return out
+        out = self.flush() + [command]
+        if code == "G28":
+            # the machine decides where homed axes end up
+            for axis in [axis for axis in words if axis in AXES and axis != "E"] or ["X", "Y", "Z"]:
+                self.position[axis] = None
+        elif code == "M92":
+            # new units move the numbers under the program's feet
+            for axis in [axis for axis in words if axis in AXES] or AXES:
+                self.position[axis] = None
+        elif code in ("M18", "M84"):
+            # the axes can be moved by hand now
+            self.position = {axis: None for axis in AXES}
+        return out
+
+    """
+        sends the held move, if there is one
+    """
+    def flush(self):
+        held = self.held
+        if held is None:
+            return []
+        self.held = None
+        feedrate = None
+        if held.feedrate is not None and held.feedrate != self.sent_feedrate:
+            feedrate = held.feedrate
+            self.sent_feedrate = feedrate
+        elif held.feedrate is not None:
+            self.stats["dropped_feedrates"] += 1
+        end = held.end
+        return [Move(end.get("X"), end.get("Y"), end.get("Z"), end.get("E"), feedrate)]
+
+    def finish(self):
+        out = self.flush()
+        if self.wanted_feedrate is not None and self.wanted_feedrate != self.sent_feedrate:
+            # leave the machine with the feedrate the program left it with
+            out.append(Move(feedrate = self.wanted_feedrate))
+            self.sent_feedrate = self.wanted_feedrate
+        return out
+
+
+"""
+    optimizes a stream of records, see PeepholeOptimizer
+"""
+def optimize(records, tolerance = DEFAULT_TOLERANCE):
+    return PeepholeOptimizer(tolerance).optimize(records)
+
+
+"""
+    the path a program takes the machine along, in the machine's own coordinates
+    straight runs are reduced to their end points, and every command that isn't a motion
+    (other than G92, status messages and comments) is kept in between as a marker
+"""
+def trajectory(records, tolerance = DEFAULT_TOLERANCE):
+    simulator = MachineSimulator()
+    path = []
+    points = []
+    for state in simulator.timeline(records):
+        if state.kind == MOVE:
+            if simulator.last_length == 0:
+                # only a feedrate
+                continue
+            point = tuple(simulator.machine_position(axis) for axis in AXES)
+            if not points:
+                # start from wherever the machine was
+                points.append(tuple(simulator.machine_position(axis) - simulator.last_delta[axis] for axis in AXES))
+            if points and point == points[-1]:
+                continue
+            if len(points) >= 2 and on_line(points[-2], points[-1], point, tolerance):
+                points[-1] = point
+            else:
+                points.append(point)
+        elif state.kind in (STAGE, SET_POSITION) or state.message.startswith("M117"):
+            continue
+        else:
+            if points:
+                path.append(("path", points))
+                points = []
+            path.append((state.kind, state.message))
+    if points:
+        path.append(("path", points))
+    return path
+
+
+"""
+    true when b lies on the straight line from a to c, between them
+"""
+def on_line(a, b, c, tolerance):
+    first = [y - x for x, y in zip(a, b)]
+    whole = [y - x for x, y in zip(a, c)]
+    length = sqrt(sum(delta * delta for delta in whole))
+    if length == 0:
+        return False
+    along = sum(x * y for x, y in zip(first, whole)) / length
+    if along < 0 or along > length:
+        return False
+    return all(abs(x - y / length * along) <= tolerance for x, y in zip(first, whole))
+
+
+"""
+    checks two programs take the machine along the same path, with the same commands in between
+    @return (True, None) or (False, description of the first difference)
+"""
+def same_trajectory(first, second, tolerance = 1e-6):
+    a = trajectory(first, tolerance)
+    b = trajectory(second, tolerance)
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x[0] != y[0]:
+            return False, "step " + str(i) + ": " + str(x[0]) + " vs " + str(y[0])
+        if x[0] != "path":
+            if x[1] != y[1]:
+                return False, "step " + str(i) + ": " + str(x[1]) + " vs " + str(y[1])
+            continue
+        if len(x[1]) != len(y[1]):
+            return False, "step " + str(i) + ": path of " + str(len(x[1])) + " points vs " + str(len(y[1]))
+        for p, q in zip(x[1], y[1]):
+            if any(abs(u - v) > tolerance for u, v in zip(p, q)):
+                return False, "step " + str(i) + ": " + str(p) + " vs " + str(q)
+    if len(a) != len(b):
+        return False, "programs have " + str(len(a)) + " and " + str(len(b)) + " steps"
+    return True, None
+
+
+def main(argv = None):
+    from GcodeParser import file_records
+    from GcodeSink import open_sink
+    from Toolpath import write_records
+
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print("usage: python GcodeOptimizer.py in.gcode out.gcode")
+        return 1
+    optimizer = PeepholeOptimizer()
+    with open_sink(argv[1]) as sink:
+        write_records(optimizer.optimize(file_records(argv[0])), sink)
+    for name, value in optimizer.stats.items():
+        print(name + ": " + str(value))
+    # output is rounded, check against what was actually written
+    same, difference = same_trajectory(file_records(argv[0]), file_records(argv[1]), 1e-3)
+    print("Trajectory unchanged" if same else "TRAJECTORY CHANGED: " + difference)
+    return 0 if same else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+import gzip
+
+from Toolpath import Move, Command, Stage
+
+"""
+Streaming parser for the G-code this project writes
+Turns lines back into the same Move/Command/Stage records TubeWinder generates (see Toolpath), one
+line at a time, so any size of file can be read in constant memory.
+
+G0/G1 lines become Moves, "; name" comment lines become Stages, and everything else that isn't
+blank becomes a Command (comments in brackets are kept, they're part of the command text).
+
+"""
+
+MOVE_CODES = ("G1", "G0", "G01", "G00")
+
+"""
+    parses a single line
+    @return the record for the line, or None for blank lines
+"""
+def parse_line(line):
+    line = line.strip()
+    if not line:
+        return None
+    if line[0] == ";":
+        name = line[1:].strip()
+        return Stage(name) if name else None
+    code_end = line.find(" ")
+    code = line if code_end < 0 else line[:code_end]
+    if code.upper() in MOVE_CODES:
+        return parse_move(line)
+    return Command(line)
+
+
+def parse_move(line):
+    # anything after a ; is a comment
+    comment = line.find(";")
+    if comment >= 0:
+        line = line[:comment]
+    move = Move()
+    for word in line.split()[1:]:
+        letter = word[0].upper()
+        try:
+            value = float(word[1:])
+        except ValueError:
+            continue
+        if letter == "X":
+            move.x = value
+        elif letter == "Y":
+            move.y = value
+        elif letter == "Z":
+            move.z = value
+        elif letter == "E":
+            move.e = value
+        elif letter == "F":
+            move.feedrate = value
+    return move
+
+
+"""
+    parses lines one after the other
+    @param lines: any iterable of lines, ie an open file
+    @return generator of (line number, record), starting at line 1. Blank lines are skipped
+"""
+def parse_lines(lines):
+    for number, line in enumerate(lines, 1):
+        record = parse_line(line)
+        if record is not None:
+            yield number, record
+
+
+"""
+    opens a G-code file, '.gz' files are decompressed on the fly
+    @param newline: passed to open, "" keeps the line endings exactly as they are in the file
+"""
+def open_gcode(path, newline = None):
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rt', newline = newline)
+    return open(path, newline = newline)
+
+
+"""
+    parses a G-code file, streaming it line by line
+    binary toolpaths (.cawtp, see ToolpathBinary) are read too, numbered by the lines they come out on as G-code
+    @return generator of (line number, record)
+"""
+def parse_file(path):
+    if path.endswith(".cawtp"):
+        from ToolpathBinary import ToolpathFile
+
+        with ToolpathFile(path) as toolpath:
+            lines = toolpath.line_numbers()
+            for index in range(len(toolpath)):
+                record = toolpath.record(index)
+                if record is not None:
+                    yield int(lines[index]), record
+        return
+    with open_gcode(path) as file:
+        yield from parse_lines(file)
+
+
+"""
+    just the records of a file, without line numbers
+"""
+def file_records(path):
+    for number, record in parse_file(path):
+        yield record
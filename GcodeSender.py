@@ -0,0 +1,482 @@
+import argparse
+import asyncio
+import inspect
+import os
+import re
+import sys
+import termios
+import time
+import tty
+from collections import deque
+
+from MachineSimulator import command_words
+from Toolpath import Move, Command, Stage
+
+"""
+Streams G-code to the winder's Marlin style controller over serial
+Every line goes out numbered and checksummed ("N12 G1 X10*85"). The controller answers every line
+with an "ok" once it has taken it, or with "Resend: N" when a line came through garbled, so up to
+window lines are kept in flight at once. That keeps the controller's command buffer, and through it
+the planner, topped up so short fast moves don't leave the machine waiting on the host.
+
+M0/M1 prompts are handled here rather than by the controller: the sender waits for the machine to
+finish every move before it (M400), then asks the operator through the prompt callback and carries
+on once they answer. "M117 Pass i of n" status lines are reported through the progress callback.
+
+Nothing outside the standard library is needed, the port is opened with termios. FakeController
+emulates a controller on a pty so all of this can be run without the winder.
+
+usage: python GcodeSender.py program.gcode --port /dev/ttyACM0
+       python GcodeSender.py manifest.json --fake
+
+"""
+
+DEFAULT_BAUDRATE = 115200
+# lines in flight, this should match the controller's command buffer (Marlin's BUFSIZE)
+DEFAULT_WINDOW = 4
+# seconds to wait for the controller to say anything before giving up. Marlin sends "busy" every
+# couple of seconds while it's working on something long (homing, M400), so this doesn't have to cover those
+DEFAULT_TIMEOUT = 30
+# numbered lines kept around for resends
+HISTORY_SIZE = 256
+
+PASS_PATTERN = re.compile(r"Pass (\d+) of (\d+)")
+
+
+class SenderError(Exception):
+    pass
+
+
+"""
+    checksum of a line, xor of all its bytes, as Marlin expects it after the *
+"""
+def checksum(text):
+    value = 0
+    for byte in text.encode("ascii", "replace"):
+        value ^= byte
+    return value
+
+
+"""
+    numbers and checksums a line, ie frame(12, "G1 X10") -> b"N12 G1 X10*85\n"
+"""
+def frame(number, text):
+    line = "N" + str(number) + " " + text
+    return (line + "*" + str(checksum(line)) + "\n").encode("ascii", "replace")
+
+
+"""
+    the part of a line that goes to the controller, without comments and whitespace
+"""
+def strip_line(text):
+    comment = text.find(";")
+    if comment >= 0:
+        text = text[:comment]
+    return text.strip()
+
+
+class SerialPort:
+    """
+        a serial port (or pty) in raw mode, read and written through the asyncio loop
+        @param path: device, ie /dev/ttyACM0
+        @param baudrate: ignored by ptys
+    """
+    def __init__(self, path, baudrate = DEFAULT_BAUDRATE):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        self.reader = None
+        try:
+            self.configure(baudrate)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def configure(self, baudrate):
+        speed = getattr(termios, "B" + str(baudrate), None)
+        if speed is None:
+            raise ValueError("Unsupported baudrate " + str(baudrate))
+        tty.setraw(self.fd)
+        attributes = termios.tcgetattr(self.fd)
+        # no modem control lines, and turn the receiver on
+        attributes[2] |= termios.CLOCAL | termios.CREAD
+        attributes[4] = speed
+        attributes[5] = speed
+        termios.tcsetattr(self.fd, termios.TCSANOW, attributes)
+
+    """
+        starts reading the port in the background, has to be called from inside the running loop
+    """
+    def start(self):
+        self.reader = asyncio.StreamReader()
+        asyncio.get_running_loop().add_reader(self.fd, self.on_readable)
+
+    def on_readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            # the other end went away (a pty gives EIO)
+            data = b""
+        if data:
+            self.reader.feed_data(data)
+        else:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            self.reader.feed_eof()
+
+    """
+        the next line from the port, without the line ending
+    """
+    async def readline(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError(self.path + " closed")
+        return line.decode("ascii", "replace").strip()
+
+    async def write(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                written = os.write(self.fd, view)
+                view = view[written:]
+            except BlockingIOError:
+                await self.writable()
+
+    async def writable(self):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_writer(self.fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_writer(self.fd)
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.reader is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+
+class GcodeSender:
+    """
+        @param port: SerialPort, or anything with the same start/readline/write/close
+        @param window: lines to keep in flight, the controller's command buffer size
+        @param prompt: called with the message of every M0/M1 once the machine has stopped, the program
+            carries on when it returns (it can be a coroutine). None carries on straight away
+        @param progress: called with (pass number, passes, text) for every "M117 Pass i of n"
+        @param on_message: called with anything the controller says that isn't part of the flow control
+        @param timeout: seconds to wait for the controller before giving up
+    """
+    def __init__(self, port, window = DEFAULT_WINDOW, prompt = None, progress = None, on_message = None, timeout = DEFAULT_TIMEOUT):
+        if window < 1:
+            raise ValueError("window has to be at least 1")
+        self.port = port
+        self.window = window
+        self.prompt = prompt
+        self.progress = progress
+        self.on_message = on_message
+        self.timeout = timeout
+        self.line_number = 0
+        self.history = {}
+        # lines sent that the controller hasn't answered yet
+        self.outstanding = 0
+        self.resend_queue = deque()
+        # a resend throws away every line sent after the bad one, and each of those gets its own
+        # "Resend: N" for the same line. Those are counted off here instead of resending again
+        self.last_resend = None
+        self.stale_resends = 0
+        self.error = None
+        # true while a program is going out, the planner running empty then means the machine is starved
+        self.streaming = False
+        self.heard = asyncio.Event()
+        self.listener = None
+        self.started = None
+        self.stats = {"lines": 0, "resends": 0, "resent_lines": 0, "prompts": 0, "errors": 0, "waits": 0,
+                      "planner_empty": 0, "lowest_planner_free": None, "seconds": 0.0}
+        # planner size, as the biggest number of free blocks the controller has reported
+        self.planner_size = 0
+        self.planner_busy = False
+
+    """
+        starts listening to the controller and resets its line numbers
+    """
+    async def connect(self):
+        self.port.start()
+        self.listener = asyncio.ensure_future(self.listen())
+        self.started = time.perf_counter()
+        self.line_number = -1
+        await self.send_line("M110 N0")
+        await self.wait_idle()
+
+    async def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.listener = None
+        self.port.close()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def listen(self):
+        try:
+            while True:
+                self.handle(await self.port.readline())
+                self.heard.set()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+            self.heard.set()
+
+    """
+        deals with one line from the controller
+    """
+    def handle(self, line):
+        if line.startswith("ok"):
+            self.outstanding = max(0, self.outstanding - 1)
+            self.read_ok(line)
+        elif line.startswith("Resend:") or line.startswith("rs "):
+            self.request_resend(int(re.sub(r"[^0-9]", "", line.split(":" if ":" in line else " ", 1)[1])))
+        elif line.startswith("Error:"):
+            self.stats["errors"] += 1
+            if "halted" in line or "kill" in line:
+                self.error = SenderError("Controller stopped: " + line)
+            elif self.on_message is not None:
+                self.on_message(line)
+        elif line.startswith("echo:busy") or line.startswith("wait"):
+            # still working, the timeout starts over
+            pass
+        elif self.on_message is not None and line:
+            self.on_message(line)
+
+    """
+        picks the buffer levels out of an advanced ok ("ok N12 P15 B3")
+    """
+    def read_ok(self, line):
+        words = dict((word[0], word[1:]) for word in line.split()[1:] if len(word) > 1)
+        if "P" in words and words["P"].isdigit():
+            free = int(words["P"])
+            self.planner_size = max(self.planner_size, free)
+            lowest = self.stats["lowest_planner_free"]
+            self.stats["lowest_planner_free"] = free if lowest is None else min(lowest, free)
+            if free < self.planner_size:
+                self.planner_busy = True
+            elif self.planner_busy:
+                self.planner_busy = False
+                if self.streaming:
+                    # the machine ran out of moves while there were more to send, it's waiting on us
+                    self.stats["planner_empty"] += 1
+
+    def request_resend(self, number):
+        if self.stale_resends > 0 and number == self.last_resend:
+            self.stale_resends -= 1
+            return
+        if number not in self.history:
+            self.error = SenderError("Controller asked for line " + str(number) + " which is no longer kept")
+            return
+        self.stats["resends"] += 1
+        self.last_resend = number
+        self.stale_resends = self.line_number - number
+        self.resend_queue = deque(range(number, self.line_number + 1))
+
+    """
+        waits for the controller to answer something
+    """
+    async def wait_for_controller(self):
+        if self.error is not None:
+            raise SenderError(str(self.error)) from self.error
+        self.heard.clear()
+        self.stats["waits"] += 1
+        try:
+            await asyncio.wait_for(self.heard.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            raise SenderError("No answer from the controller in " + str(self.timeout) + "s") from None
+        if self.error is not None:
+            raise SenderError(str(self.error)) from self.error
+
+    """
+        sends any lines the controller asked for again, keeping to the window
+    """
+    async def resend(self):
+        while self.resend_queue:
+            while self.outstanding >= self.window:
+                await self.wait_for_controller()
+            if not self.resend_queue:
+                break
+            number = self.resend_queue.popleft()
+            self.outstanding += 1
+            self.stats["resent_lines"] += 1
+            await self.port.write(self.history[number])
+
+    """
+        sends one line, waiting for room in the window first
+    """
+    async def send_line(self, text):
+        while self.outstanding >= self.window or self.resend_queue:
+            if self.resend_queue:
+                await self.resend()
+            else:
+                await self.wait_for_controller()
+        self.line_number += 1
+        data = frame(self.line_number, text)
+        self.history[self.line_number] = data
+        self.history.pop(self.line_number - HISTORY_SIZE, None)
+        self.outstanding += 1
+        self.stats["lines"] += 1
+        await self.port.write(data)
+
+    """
+        waits until every line sent has been answered
+    """
+    async def wait_idle(self):
+        while self.outstanding > 0 or self.resend_queue:
+            if self.resend_queue:
+                await self.resend()
+            else:
+                await self.wait_for_controller()
+
+    """
+        waits until the machine has finished every move sent so far
+    """
+    async def drain(self):
+        # M400 is only answered once the planner is empty
+        await self.send_line("M400")
+        await self.wait_idle()
+
+    """
+        sends a stream of records (see Toolpath), ie WindJob.records or GcodeParser.file_records
+    """
+    async def send_records(self, records):
+        self.streaming = True
+        try:
+            for record in records:
+                if isinstance(record, Stage):
+                    continue
+                if isinstance(record, Move):
+                    await self.send_line(record.gcode().strip())
+                    continue
+                text = strip_line(record.text)
+                code, words = command_words(text)
+                if code in ("M0", "M1"):
+                    await self.operator_prompt(text.split(" ", 1)[1] if " " in text else "")
+                    continue
+                if code == "M117" and self.progress is not None:
+                    match = PASS_PATTERN.search(text)
+                    if match:
+                        self.progress(int(match.group(1)), int(match.group(2)), text[5:])
+                if text:
+                    await self.send_line(text)
+            self.streaming = False
+            await self.drain()
+        finally:
+            self.streaming = False
+            self.stats["seconds"] = round(time.perf_counter() - self.started, 3) if self.started else 0.0
+
+    """
+        sends G-code text, a line at a time
+    """
+    async def send_lines(self, lines):
+        from GcodeParser import parse_line
+
+        await self.send_records(record for record in (parse_line(line) for line in lines) if record is not None)
+
+    async def operator_prompt(self, message):
+        self.stats["prompts"] += 1
+        self.streaming = False
+        await self.drain()
+        if self.prompt is not None:
+            answer = self.prompt(message)
+            if inspect.isawaitable(answer):
+                await answer
+        self.streaming = True
+
+
+"""
+    asks on the console, without blocking the loop
+"""
+async def console_prompt(message):
+    await asyncio.get_running_loop().run_in_executor(None, input, message + " [enter to continue] ")
+
+
+def print_progress(number, passes, text):
+    print(text)
+
+
+"""
+    records of a G-code file, or of a job in a manifest
+    @param job: name or index (from 0) of the job in the manifest, the first one by default
+    @param on_report: where the winder reports its calculations, see TubeWinder
+"""
+def load_records(path, job = None, on_report = None):
+    if path.endswith(".json"):
+        from WindJob import load_manifest
+
+        jobs = load_manifest(path)
+        chosen = jobs[0]
+        if job is not None:
+            chosen = jobs[int(job)] if job.isdigit() else [j for j in jobs if j.name == job][0]
+        # generated as it goes out
+        return chosen.records(chosen.create_winder(on_report = on_report))
+    from GcodeParser import file_records
+    return file_records(path)
+
+
+async def run(args):
+    controller = None
+    if args.fake:
+        from FakeController import FakeController
+        controller = FakeController(time_scale = args.time_scale, error_every = args.error_every)
+        await controller.start()
+        port = SerialPort(controller.port_name)
+    else:
+        port = SerialPort(args.port, args.baud)
+    prompt = None if args.yes or args.fake else console_prompt
+    sender = GcodeSender(port, window = args.window, prompt = prompt, progress = print_progress, on_message = print)
+    try:
+        await sender.connect()
+        await sender.send_records(load_records(args.program, args.job))
+    finally:
+        await sender.close()
+        if controller is not None:
+            await controller.stop()
+    for name, value in sender.stats.items():
+        print(name + ": " + str(value))
+    if controller is not None:
+        for name, value in controller.stats.items():
+            print("controller " + name + ": " + str(value))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Stream G-code to the winder")
+    parser.add_argument("program", help = "G-code file (.gcode or .gcode.gz) or json manifest")
+    parser.add_argument("--job", help = "name or index of the job to send from a manifest, the first by default")
+    parser.add_argument("-p", "--port", help = "serial port of the controller")
+    parser.add_argument("-b", "--baud", type = int, default = DEFAULT_BAUDRATE)
+    parser.add_argument("-w", "--window", type = int, default = DEFAULT_WINDOW, help = "lines kept in flight")
+    parser.add_argument("-y", "--yes", action = "store_true", help = "carry on through M0 prompts without asking")
+    parser.add_argument("--fake", action = "store_true", help = "send to an emulated controller instead of a port")
+    parser.add_argument("--time-scale", type = float, default = 0.0, help = "how fast the emulated machine runs, 1 is real time")
+    parser.add_argument("--error-every", type = int, default = 0, help = "have the emulated controller garble every nth line")
+    args = parser.parse_args(argv)
+    if not args.fake and not args.port:
+        parser.error("a --port or --fake is needed")
+    try:
+        asyncio.run(run(args))
+    except SenderError as e:
+        print("Error: " + str(e))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
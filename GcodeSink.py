@@ -0,0 +1,186 @@
+import abc
+import gzip
+import io
+
+"""
+Output sinks for generated G-code
+Every sink collects what it is given in a large in memory buffer and only hands it to the
+backend (file, memory, gzip, or nothing at all) once the buffer fills up or the sink is flushed,
+so generating a long program doesn't turn into one system call per line.
+
+"""
+
+DEFAULT_BUFFER_SIZE = 1 << 18
+
+"""
+    formats a number with a fixed number of decimals, dropping trailing zeros
+    38.1 -> "38.1", 0 -> "0", 12.3456 -> "12.346"
+    @param value: number to format
+    @param digits: number of decimals to keep
+"""
+def format_number(value, digits = 3):
+    text = "%.*f" % (digits, value)
+    if digits > 0:
+        text = text.rstrip("0").rstrip(".")
+    if text == "-0":
+        text = "0"
+    return text
+
+
+"""
+    builds a G1 line, axes that are None are left out
+    z is expected to already be in machine units (mm of the head gear)
+"""
+def format_move(x = None, y = None, z = None, e = None, feedrate = None):
+    line = "G1"
+    if x is not None:
+        line += " X" + format_number(x)
+    if y is not None:
+        line += " Y" + format_number(y)
+    if z is not None:
+        line += " Z" + format_number(z)
+    if e is not None:
+        line += " E" + format_number(e)
+    if feedrate is not None:
+        line += " F" + str(int(feedrate))
+    return line + "\n"
+
+
+class GcodeSink(abc.ABC):
+    def __init__(self, buffer_size = DEFAULT_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.bytes_written = 0
+        self.lines_written = 0
+        self.closed = False
+
+    """
+        adds text to the output
+        @param text: text to write, lines must already contain their newline
+    """
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    """
+        adds a G1 move to the output, see format_move
+    """
+    def write_move(self, x = None, y = None, z = None, e = None, feedrate = None):
+        self.write(format_move(x, y, z, e, feedrate))
+
+    """
+        hands everything buffered to the backend
+    """
+    def flush(self):
+        if not self.buffer:
+            return
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.bytes_written += len(data)
+        self.lines_written += data.count("\n")
+        self.write_out(data)
+
+    """
+        number of characters written so far, including what is still buffered
+    """
+    def tell(self):
+        return self.bytes_written + self.buffered
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.close_out()
+        self.closed = True
+
+    # backends implement write_out, and close_out when they have something to close
+    @abc.abstractmethod
+    def write_out(self, data):
+        pass
+
+    def close_out(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class FileSink(GcodeSink):
+    """
+        @param file: path to open, or an already open text file. A file that is passed in is only flushed
+            on close, closing it is left to whoever opened it
+    """
+    def __init__(self, file, buffer_size = DEFAULT_BUFFER_SIZE):
+        super().__init__(buffer_size)
+        if isinstance(file, str):
+            self.file = open(file, 'w')
+            self.owns_file = True
+        else:
+            self.file = file
+            self.owns_file = False
+
+    def write_out(self, data):
+        self.file.write(data)
+
+    def close_out(self):
+        if self.owns_file:
+            self.file.close()
+        elif hasattr(self.file, "flush"):
+            self.file.flush()
+
+
+class MemorySink(GcodeSink):
+    def __init__(self, buffer_size = DEFAULT_BUFFER_SIZE):
+        super().__init__(buffer_size)
+        self.output = io.StringIO()
+
+    def write_out(self, data):
+        self.output.write(data)
+
+    def getvalue(self):
+        self.flush()
+        return self.output.getvalue()
+
+
+class GzipSink(GcodeSink):
+    def __init__(self, path, buffer_size = DEFAULT_BUFFER_SIZE, compresslevel = 6):
+        super().__init__(buffer_size)
+        self.file = gzip.open(path, 'wt', compresslevel = compresslevel)
+
+    def write_out(self, data):
+        self.file.write(data)
+
+    def close_out(self):
+        self.file.close()
+
+
+class NullSink(GcodeSink):
+    """
+        throws everything away, but still counts lines and bytes. Useful for dry runs
+    """
+    def write_out(self, data):
+        pass
+
+
+"""
+    opens the appropriate sink for a path
+    @param path: file to write to, '.gz' files are compressed and '.cawtp' files are binary toolpaths
+        (see ToolpathBinary, needs numpy). None gives a NullSink
+"""
+def open_sink(path, buffer_size = DEFAULT_BUFFER_SIZE):
+    if path is None:
+        return NullSink(buffer_size)
+    if path.endswith(".cawtp"):
+        from ToolpathBinary import ToolpathSink
+
+        return ToolpathSink(path, buffer_size)
+    if path.endswith(".gz"):
+        return GzipSink(path, buffer_size)
+    return FileSink(path, buffer_size)
@@ -0,0 +1,274 @@
+import argparse
+import json
+import sys
+
+from MachineSimulator import MachineSimulator, AXES, MOVE, STAGE, STATUS
+
+"""
+Checks a program against what the winder can physically do, in one streaming pass
+Every move is run through a MachineSimulator, so the limits checked are the ones the program itself
+sets (M203 max feedrates, M201 accelerations), and is checked for:
+
+    speed: an axis asked to go faster than its max feedrate. The firmware would quietly slow the
+        whole move down, and the tube would no longer turn at the rpm the pass was planned for
+    acceleration: an axis that can't get up to its speed, or back down, within the move. Moves
+        with nothing but status messages between them are taken to run into each other, so an axis
+        going on the same way at the same speed from one move to the next doesn't need to slow down
+    travel: an axis past the end of its travel, in the machine's own coordinates (ie negative, past
+        the home switch). Only checked once the axis is homed, before that nothing says where it is
+    mandrel: the head closer in than the surface of the mandrel (when its diameter is known)
+
+Violations are kept with the line they're on. Only MAX_VIOLATIONS are kept, the rest are counted.
+
+usage: python GcodeValidator.py program.gcode|program.cawtp [--od 2.7] [--travel X0:1500]
+       python GcodeValidator.py manifest.json
+
+"""
+
+# y (mm) of the mandrel's axis, the head sits this far out less the radius and head offset (see TubeWinder.iter_pre_wrap)
+MANDREL_Y = 4.5 * 25.4
+# range (mm) of every axis from its home, in the machine's coordinates. None for no end
+DEFAULT_TRAVEL = {"X": (0.0, None), "Y": (0.0, None)}
+# how far over a limit a move has to go to count, limits are written rounded
+DEFAULT_TOLERANCE = .01
+MAX_VIOLATIONS = 100
+
+
+class Violation:
+    """
+        @param kind: "speed", "acceleration", "travel" or "mandrel"
+        @param value: what the move asks for, in mm/s, mm/s^2 or mm
+        @param limit: what it's allowed
+    """
+    def __init__(self, line, kind, axis, value, limit):
+        self.line = line
+        self.kind = kind
+        self.axis = axis
+        self.value = value
+        self.limit = limit
+
+    def message(self):
+        if self.kind == "speed":
+            return self.axis + " at " + str(round(self.value, 2)) + "mm/s, over its max feedrate of " + str(round(self.limit, 2)) + "mm/s"
+        if self.kind == "acceleration":
+            return self.axis + " needs " + str(round(self.value, 1)) + "mm/s^2, over its acceleration of " + str(round(self.limit, 1)) + "mm/s^2"
+        if self.kind == "mandrel":
+            return "head at Y" + str(round(self.value, 3)) + ", past the mandrel's surface at Y" + str(round(self.limit, 3))
+        return self.axis + " at " + str(round(self.value, 3)) + ", past the end of its travel at " + str(round(self.limit, 3))
+
+    def to_dict(self):
+        return {"line": self.line, "kind": self.kind, "axis": self.axis, "value": round(self.value, 4), "limit": round(self.limit, 4),
+                "message": self.message()}
+
+    def __str__(self):
+        return "line " + str(self.line) + ": " + self.message()
+
+
+class PendingMove:
+    """
+        a move waiting on the next one, to know how fast it can end
+    """
+    def __init__(self, line, deltas, velocities, entry, accelerations):
+        self.line = line
+        self.deltas = deltas
+        self.velocities = velocities
+        self.entry = entry
+        self.accelerations = accelerations
+
+
+class GcodeValidator:
+    """
+        @param travel: {axis: (low, high)} in mm from home, see DEFAULT_TRAVEL
+        @param mandrel_od: diameter (mm) of the mandrel, None to not check the head against it
+        @param tolerance: fraction a move can go over a limit by without it counting
+        @param max_violations: violations kept, the rest are only counted
+    """
+    def __init__(self, travel = None, mandrel_od = None, tolerance = DEFAULT_TOLERANCE, max_violations = MAX_VIOLATIONS):
+        self.travel = dict(DEFAULT_TRAVEL if travel is None else travel)
+        self.mandrel_y = MANDREL_Y - mandrel_od / 2 if mandrel_od is not None else None
+        self.tolerance = tolerance
+        self.max_violations = max_violations
+        self.simulator = MachineSimulator()
+        self.violations = []
+        # violations by kind, all of them
+        self.counts = {}
+        self.pending = None
+
+    def add(self, line, kind, axis, value, limit):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        if len(self.violations) < self.max_violations:
+            self.violations.append(Violation(line, kind, axis, value, limit))
+
+    def over(self, value, limit):
+        return value > limit * (1 + self.tolerance) + 1e-9
+
+    """
+        checks a record
+        @param line: line number of the record, counts up on its own when not given
+    """
+    def check(self, record, line = None):
+        simulator = self.simulator
+        state = simulator.step(record, line)
+        if state.kind == MOVE:
+            if simulator.last_length > 0:
+                self.check_move(state.line)
+            return
+        if state.kind not in (STAGE, STATUS):
+            # anything else waits for the moves before it to finish
+            self.settle(None)
+
+    """
+        checks every record of a stream
+        @param records: iterable of records, or of (line number, record) as GcodeParser gives them
+        @return self
+    """
+    def check_all(self, records):
+        for item in records:
+            if isinstance(item, tuple):
+                self.check(item[1], item[0])
+            else:
+                self.check(item)
+        self.finish()
+        return self
+
+    """
+        checks the last move against the one before it, call once every record is in
+    """
+    def finish(self):
+        self.settle(None)
+
+    def check_move(self, line):
+        simulator = self.simulator
+        deltas = dict(simulator.last_delta)
+        speed = simulator.feedrate / 60 / simulator.last_length if simulator.feedrate else 0.0
+        velocities = {axis: delta * speed for axis, delta in deltas.items()}
+        for axis in AXES:
+            if deltas[axis] != 0 and self.over(abs(velocities[axis]), simulator.max_feedrate[axis]):
+                self.add(line, "speed", axis, abs(velocities[axis]), simulator.max_feedrate[axis])
+        for axis, (low, high) in self.travel.items():
+            if deltas[axis] == 0 or axis not in simulator.homed:
+                continue
+            position = simulator.machine_position(axis)
+            if low is not None and position < low - 1e-6:
+                self.add(line, "travel", axis, position, low)
+            elif high is not None and position > high + 1e-6:
+                self.add(line, "travel", axis, position, high)
+        if self.mandrel_y is not None and deltas["Y"] != 0 and "Y" in simulator.homed and simulator.machine_position("Y") > self.mandrel_y + 1e-6:
+            self.add(line, "mandrel", "Y", simulator.machine_position("Y"), self.mandrel_y)
+        entry = self.settle(velocities)
+        # less than a step is rounding, not a move the axis has to make
+        steps = {axis: abs(deltas[axis]) * simulator.steps_per_unit[axis] >= 1 for axis in AXES}
+        self.pending = PendingMove(line, {axis: deltas[axis] if steps[axis] else 0.0 for axis in AXES}, velocities, entry,
+                                   dict(simulator.acceleration))
+
+    """
+        checks the acceleration of the move waiting on this one
+        @param velocities: per axis velocity the next move starts at, None when the machine stops first
+        @return per axis velocity the next move can start with, what the waiting move carries into it
+    """
+    def settle(self, velocities):
+        pending = self.pending
+        self.pending = None
+        carried = {axis: 0.0 for axis in AXES}
+        if pending is None:
+            return carried
+        for axis in AXES:
+            distance = abs(pending.deltas[axis])
+            if distance == 0:
+                continue
+            speed = pending.velocities[axis]
+            exit_speed = 0.0
+            if velocities is not None and velocities[axis] * speed > 0:
+                # going on the same way, it only has to get down to the next move's speed
+                exit_speed = min(abs(velocities[axis]), abs(speed))
+                carried[axis] = speed if abs(speed) < abs(velocities[axis]) else velocities[axis]
+            entry_speed = abs(pending.entry[axis])
+            # distance to speed up from how fast it came in, and to slow down to how fast it leaves
+            needed = max(0.0, speed * speed - entry_speed * entry_speed) + max(0.0, speed * speed - exit_speed * exit_speed)
+            accel = needed / (2 * distance)
+            if self.over(accel, pending.accelerations[axis]):
+                self.add(pending.line, "acceleration", axis, accel, pending.accelerations[axis])
+        return carried
+
+    def ok(self):
+        return not self.counts
+
+    def report(self):
+        return {"ok": self.ok(), "counts": dict(self.counts), "violations": [violation.to_dict() for violation in self.violations]}
+
+
+"""
+    validates a G-code or .cawtp file, streaming it
+    @param mandrel_od: diameter (mm) of the mandrel, to check the head against it
+"""
+def validate_file(path, mandrel_od = None, travel = None):
+    from GcodeParser import parse_file
+
+    return GcodeValidator(travel, mandrel_od).check_all(parse_file(path))
+
+
+"""
+    validates a WindJob as it's generated, nothing is written
+"""
+def validate_job(job, travel = None):
+    validator = GcodeValidator(travel, float(job.tube["od"]) * 25.4)
+    line = 0
+    winder = job.create_winder(on_report = lambda name, value: None)
+    for record in job.records(winder):
+        # number the records by the lines they come out on, stages start with blank lines
+        line += record.gcode().count("\n")
+        validator.check(record, line)
+    validator.finish()
+    return validator
+
+
+"""
+    parses a travel range, ie "X0:1500", "Y:120" or "X-5:"
+    @return (axis, (low, high))
+"""
+def parse_travel(text):
+    axis = text[:1].upper()
+    if axis not in AXES or ":" not in text:
+        raise argparse.ArgumentTypeError("travel goes as <axis><low>:<high>, ie X0:1500, not " + text)
+    low, high = text[1:].split(":", 1)
+    try:
+        return axis, (float(low) if low else None, float(high) if high else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError("travel goes as <axis><low>:<high>, ie X0:1500, not " + text)
+
+
+def main(argv = None):
+    from WindJob import load_manifest, INCH
+
+    parser = argparse.ArgumentParser(description = "Check a program against the winder's speed, acceleration and travel limits")
+    parser.add_argument("program", help = "G-code or .cawtp file, or a json manifest of jobs")
+    parser.add_argument("--od", type = float, default = None, help = "outer diameter of the mandrel (in), to check the head against it")
+    parser.add_argument("--travel", type = parse_travel, action = "append", default = None,
+                        help = "travel of an axis from home (mm), ie X0:1500, can be given more than once")
+    parser.add_argument("--json", default = None, help = "also write the report as json to this file")
+    args = parser.parse_args(argv)
+
+    travel = dict(DEFAULT_TRAVEL)
+    travel.update(args.travel or [])
+    if args.program.endswith(".json"):
+        validators = [(job.name or ("job " + str(i + 1)), validate_job(job, travel)) for i, job in enumerate(load_manifest(args.program))]
+    else:
+        validators = [(args.program, validate_file(args.program, args.od * INCH if args.od else None, travel))]
+    for name, validator in validators:
+        if validator.ok():
+            print(name + ": ok (" + str(validator.simulator.line) + " lines)")
+            continue
+        print(name + ": " + ", ".join(str(count) + " " + kind for kind, count in sorted(validator.counts.items())))
+        for violation in validator.violations:
+            print("    " + str(violation))
+        hidden = sum(validator.counts.values()) - len(validator.violations)
+        if hidden:
+            print("    ... and " + str(hidden) + " more")
+    if args.json is not None:
+        with open(args.json, 'w') as report_file:
+            json.dump({name: validator.report() for name, validator in validators}, report_file, indent = 2)
+    return 0 if all(validator.ok() for name, validator in validators) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
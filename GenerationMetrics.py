@@ -0,0 +1,166 @@
+import csv
+import json
+import platform
+import sys
+import time
+
+from MachineSimulator import MachineSimulator, DEFAULT_HOMING_SECONDS, MOVE
+from ProgramCache import SOURCE_HASH, json_default
+from Toolpath import Move
+
+"""
+Where generation time goes, stage by stage
+Generates a job one stage at a time and records, for every stage, the wall time spent making its
+records and G-code, the lines and bytes it came to, how many moves drove each combination of axes
+(ie "XE" for a helical pass, "E" for a re-index), and the machine time it comes to (see
+MachineSimulator). The values the winder works out along the way (units, passes per layer, ...)
+are kept with the stage they came up in, instead of being printed.
+
+Reports carry a hash of the generating code, so runs can be compared across releases. Hooks are
+called with every stage as it finishes, ie to feed a dashboard.
+
+usage: python GenerationMetrics.py manifest.json [--json report.json] [--csv report.csv]
+
+"""
+
+class StageMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.wall_seconds = 0.0
+        self.lines = 0
+        self.bytes = 0
+        # move counts by the axes they drive, "F" for a move that only sets the feedrate
+        self.moves = {}
+        self.machine_seconds = 0.0
+        # values the winder reported while making the stage
+        self.values = {}
+
+    def to_dict(self):
+        return {"name": self.name, "wall_seconds": round(self.wall_seconds, 6), "lines": self.lines, "bytes": self.bytes,
+                "moves": dict(sorted(self.moves.items())), "machine_seconds": round(self.machine_seconds, 3), "values": self.values}
+
+
+class JobMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        # values reported while setting the winder up, before any stage
+        self.values = {}
+
+    def total(self, attribute):
+        return sum(getattr(stage, attribute) for stage in self.stages)
+
+    def to_dict(self):
+        return {"name": self.name, "wall_seconds": round(self.total("wall_seconds"), 6), "lines": self.total("lines"), "bytes": self.total("bytes"),
+                "machine_seconds": round(self.total("machine_seconds"), 3), "values": self.values, "stages": [stage.to_dict() for stage in self.stages]}
+
+
+class GenerationMetrics:
+    """
+        @param hooks: callables called with (JobMetrics, StageMetrics) as every stage finishes
+    """
+    def __init__(self, homing_seconds = DEFAULT_HOMING_SECONDS, hooks = None):
+        self.homing_seconds = homing_seconds
+        self.hooks = list(hooks) if hooks is not None else []
+        self.jobs = []
+        self.values = None
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    """
+        on_report for the winder, keeps the value with whatever is being measured
+    """
+    def on_report(self, name, value):
+        if self.values is not None:
+            self.values[name] = value if isinstance(value, (int, float, str)) else str(value)
+
+    """
+        generates a job stage by stage, measuring each one
+        @param sink: also write the G-code here, None only measures
+        @return JobMetrics
+    """
+    def measure_job(self, job, sink = None, name = None):
+        metrics = JobMetrics(name or job.name or ("job " + str(len(self.jobs) + 1)))
+        self.jobs.append(metrics)
+        self.values = metrics.values
+        winder = job.create_winder(on_report = self.on_report)
+        simulator = MachineSimulator(self.homing_seconds)
+        for stage_name, method, args in job.stages():
+            stage = StageMetrics(stage_name)
+            self.values = stage.values
+            # only making the records and the text counts as generation, the rest is measuring it
+            start = time.perf_counter()
+            records = list(getattr(winder, method)(*args))
+            text = "".join(record.gcode() for record in records)
+            stage.wall_seconds = time.perf_counter() - start
+            stage.lines = text.count("\n")
+            stage.bytes = len(text)
+            start_time = simulator.time
+            for record in records:
+                state = simulator.step(record)
+                if state.kind == MOVE and isinstance(record, Move):
+                    combination = record.axes() or "F"
+                    stage.moves[combination] = stage.moves.get(combination, 0) + 1
+            stage.machine_seconds = simulator.time - start_time
+            if sink is not None:
+                sink.write(text)
+            metrics.stages.append(stage)
+            for hook in self.hooks:
+                hook(metrics, stage)
+        self.values = None
+        if sink is not None:
+            sink.flush()
+        return metrics
+
+    def report(self):
+        return {"source": SOURCE_HASH, "python": platform.python_version(), "platform": platform.platform(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "jobs": [job.to_dict() for job in self.jobs]}
+
+    def write_json(self, path):
+        with open(path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent = 2, default = json_default)
+
+    """
+        one row per stage, with a moves_ column for every axis combination any stage used
+    """
+    def write_csv(self, path):
+        combinations = sorted(set(combination for job in self.jobs for stage in job.stages for combination in stage.moves))
+        with open(path, 'w', newline = "") as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(["job", "stage", "wall_seconds", "lines", "bytes", "machine_seconds"] + ["moves_" + combination for combination in combinations])
+            for job in self.jobs:
+                for stage in job.stages:
+                    writer.writerow([job.name, stage.name, round(stage.wall_seconds, 6), stage.lines, stage.bytes, round(stage.machine_seconds, 3)]
+                                    + [stage.moves.get(combination, 0) for combination in combinations])
+
+
+def main(argv = None):
+    import argparse
+    from CycleTimeEstimator import format_duration
+    from WindJob import load_manifest
+
+    parser = argparse.ArgumentParser(description = "Measure where generation time goes, stage by stage")
+    parser.add_argument("manifest", help = "json manifest of jobs")
+    parser.add_argument("--json", default = None, help = "write the report as json to this file")
+    parser.add_argument("--csv", default = None, help = "write a row per stage to this csv file")
+    args = parser.parse_args(argv)
+
+    metrics = GenerationMetrics()
+    for job in load_manifest(args.manifest):
+        job_metrics = metrics.measure_job(job)
+        print(job_metrics.name + ": " + str(round(job_metrics.total("wall_seconds") * 1000, 2)) + "ms, " + str(job_metrics.total("lines")) + " lines, "
+              + "machine time " + format_duration(job_metrics.total("machine_seconds")))
+        for stage in job_metrics.stages:
+            lines_per_second = stage.lines / stage.wall_seconds if stage.wall_seconds > 0 else 0
+            print("    " + stage.name + ": " + str(round(stage.wall_seconds * 1000, 2)) + "ms, " + str(stage.lines) + " lines ("
+                  + str(int(lines_per_second)) + "/s), moves " + " ".join(k + "=" + str(v) for k, v in sorted(stage.moves.items())))
+    if args.json is not None:
+        metrics.write_json(args.json)
+    if args.csv is not None:
+        metrics.write_csv(args.csv)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import threading
+
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
+
+from Toolpath import Command
+
+"""
+Generates a program on a background thread so the window stays responsive
+The worker brings an IncrementalProgram up to date with a job and writes it to a file, reporting
+every stage and every wrap pass back through Qt signals as it goes. It can also work out the
+ToolpathLOD the preview draws, which takes long enough to want off the GUI thread too. The job is built from the form
+before the worker starts, so the form can be changed while it runs without affecting it.
+
+"""
+
+class GenerationCancelled(Exception):
+    pass
+
+
+class GenerationWorker(QObject):
+    # (stage index, number of stages, stage name)
+    stage_started = pyqtSignal(int, int, str)
+    # (pass, passes) of the wrap being generated
+    pass_started = pyqtSignal(int, int)
+    # path of the file written, empty when there wasn't one
+    finished = pyqtSignal(str)
+    # ToolpathLOD of the program, before finished
+    preview_ready = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    """
+        @param program: IncrementalProgram to update, only one worker should use it at a time
+        @param job: WindJob to generate, it shouldn't be changed while the worker runs
+        @param path: file to write the program to, it isn't touched until the program is done. None to not write one
+        @param preview: whether to build the preview of the program
+    """
+    def __init__(self, program, job, path, preview = False):
+        super(QObject, self).__init__()
+        self.program = program
+        self.job = job
+        self.path = path
+        self.preview = preview
+        # set from the GUI thread, checked on every record on the worker's
+        self.cancel_requested = threading.Event()
+
+    """
+        asks the worker to stop, it does at the next record
+    """
+    def cancel(self):
+        self.cancel_requested.set()
+
+    def run(self):
+        try:
+            winder = self.program.update(self.job, self.on_stage, self.on_record)
+            self.check_cancelled()
+            if self.preview:
+                # numpy only gets pulled in for the preview
+                from ToolpathLOD import program_lod
+                self.preview_ready.emit(program_lod(self.program.text(), winder))
+            if self.path is not None:
+                with open(self.path, 'w') as file:
+                    self.program.write(file)
+        except GenerationCancelled:
+            self.cancelled.emit()
+            return
+        except Exception as e:
+            self.failed.emit(type(e).__name__ + ": " + str(e))
+            return
+        self.finished.emit(self.path or "")
+
+    def check_cancelled(self):
+        if self.cancel_requested.is_set():
+            raise GenerationCancelled()
+
+    def on_stage(self, index, count, name):
+        self.check_cancelled()
+        self.stage_started.emit(index, count, name)
+
+    def on_record(self, record):
+        self.check_cancelled()
+        if isinstance(record, Command) and record.text.startswith("M117 Pass "):
+            # "M117 Pass i of n"
+            words = record.text.split()
+            if len(words) == 5 and words[2].isdigit() and words[4].isdigit():
+                self.pass_started.emit(int(words[2]), int(words[4]))
+
+
+"""
+    starts a worker on its own thread
+    @return (thread, worker), keep hold of both until the worker is done
+"""
+def start_worker(worker):
+    thread = QThread()
+    worker.moveToThread(thread)
+    thread.started.connect(worker.run)
+    for signal in (worker.finished, worker.failed, worker.cancelled):
+        signal.connect(thread.quit)
+    thread.start()
+    return thread, worker
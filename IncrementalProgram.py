@@ -0,0 +1,108 @@
+import json
+
+from ProgramCache import json_default
+
+"""
+A program kept around between generations, so only what changed gets worked out again
+The program is held as one segment per stage of the job. Each segment knows the stage and its
+parameters, the part of the winder's state the stage started from (TubeWinder.stage_inputs) and the
+state it left behind (TubeWinder.stage_outputs). When the job changes, every stage whose parameters
+and entry state still match a segment is spliced back in as it is; only the edited stages, and any
+after them whose entry state moved, are run again.
+
+Every wrap row resets e and moves to an absolute spot before winding, so editing one row of a wrap
+table only regenerates that row.
+
+"""
+
+class Segment:
+    def __init__(self, name, method, args, inputs, outputs, text):
+        self.name = name
+        self.method = method
+        self.args = args
+        # state the stage started from and the state it set
+        self.inputs = inputs
+        self.outputs = outputs
+        self.text = text
+
+    """
+        what has to match for the segment to be reused
+    """
+    def key(self):
+        return segment_key(self.method, self.args, self.inputs)
+
+
+"""
+    passes records through, showing each one to on_record on the way
+"""
+def watch(records, on_record):
+    if on_record is None:
+        return records
+    return (record for record in records if on_record(record) or True)
+
+
+def segment_key(method, args, inputs):
+    return json.dumps([method, list(args), inputs], sort_keys = True, default = json_default)
+
+
+class IncrementalProgram:
+    """
+        @param cache: optional ProgramCache to look stages up in before running them
+    """
+    def __init__(self, cache = None):
+        self.cache = cache
+        self.settings = None
+        self.segments = []
+        self.stats = {"reused": 0, "generated": 0}
+        # names of the stages the last update had to run
+        self.regenerated = []
+
+    """
+        brings the program up to date with a job. If a callback raises, the program is left as it was
+        @param job: WindJob
+        @param on_stage: called with (index, number of stages, name) as each stage starts
+        @param on_record: called with every record of the stages that have to be run again
+        @param on_report: see TubeWinder
+        @return the TubeWinder the program was made with, in its final state
+    """
+    def update(self, job, on_stage = None, on_record = None, on_report = None):
+        winder = job.create_winder(on_report = on_report)
+        previous = {}
+        # on another tube nothing carries over
+        for segment in self.segments if winder.settings == self.settings else []:
+            previous.setdefault(segment.key(), segment)
+        segments = []
+        regenerated = []
+        stages = job.stages()
+        for index, (name, method, args) in enumerate(stages):
+            if on_stage is not None:
+                on_stage(index, len(stages), name)
+            inputs = winder.stage_inputs(method)
+            segment = previous.get(segment_key(method, args, inputs))
+            if segment is not None:
+                winder.set_state(segment.outputs)
+                self.stats["reused"] += 1
+            else:
+                if self.cache is not None:
+                    text = self.cache.stage(winder, method, args, on_record)
+                else:
+                    text = "".join(record.gcode() for record in watch(getattr(winder, method)(*args), on_record))
+                segment = Segment(name, method, args, inputs, winder.stage_outputs(method), text)
+                regenerated.append(name)
+                self.stats["generated"] += 1
+            segments.append(segment)
+        self.settings = winder.settings
+        self.segments = segments
+        self.regenerated = regenerated
+        return winder
+
+    """
+        writes the whole program
+        @param file: file or GcodeSink
+    """
+    def write(self, file):
+        for segment in self.segments:
+            file.write(segment.text)
+
+    def text(self):
+        return "".join(segment.text for segment in self.segments)
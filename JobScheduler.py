@@ -0,0 +1,343 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import sys
+
+from CycleTimeEstimator import estimate_job, format_duration
+from GcodeSink import open_sink
+from MachineSimulator import MachineSimulator, DEFAULT_HOMING_SECONDS, command_words
+from Toolpath import Command
+from WindJob import WindJob, load_manifest
+
+"""
+Orders a queue of tubes for a production run so the winder gets set up as little as possible
+Every program on its own sets the units for its tube (M92/M203/M201), homes the machine and walks
+the head over the holders so the operator can check them. Run back to back, most of that is
+redundant: the units only change with the mandrel's diameter, the machine stays homed from one tube
+to the next unless a program disables the motors or shifts X with a manual home, and the holders
+only move when the mandrel setup (diameter, length and offsets) does. A setup change always homes
+again, so the head is pulled back (G28 Y) before the new mandrel sees any motion.
+
+The scheduler groups the queue by diameter and then by setup, keeping the manifest order within a
+group, and follows the machine through the whole run with a MachineSimulator, so every program
+leaves out the homing, unit commands and holder check that the ones before it already took care of.
+Jobs with a manual home are left as they are, the operator zeroes X on the tube every time.
+
+The report compares the run against the manifest order with every program as it was: machine time,
+operator prompts and mandrel changes, split up into shifts.
+
+usage: python JobScheduler.py manifest.json -o output_dir [--shift-hours 8]
+       python JobScheduler.py --check      checks the trimming on a few small schedules
+
+"""
+
+# rough time (s) the operator takes to answer an M0 prompt
+PROMPT_SECONDS = 20
+# time (s) to swap to another mandrel setup and move the holders
+SETUP_CHANGE_SECONDS = 600
+SHIFT_HOURS = 8
+UNIT_CODES = ("M92", "M203", "M201")
+
+
+"""
+    what has to stay the same for the holders to stay where they are
+"""
+def setup_key(job):
+    manual_home = job.pre_wrap is not None and bool(job.pre_wrap["manual_home"])
+    return (float(job.tube["od"]), float(job.tube["length"]), float(job.tube["start_offset"]), float(job.tube["head_offset"]), manual_home)
+
+
+class ScheduledJob:
+    """
+        @param job: the job as it runs in the schedule, with the redundant setup taken out
+        @param index: position of the job in the manifest
+        @param setup_change: whether the mandrel setup has to change before it
+    """
+    def __init__(self, job, index, setup_change):
+        self.job = job
+        self.index = index
+        self.setup_change = setup_change
+        # what got left out: "home", "check_locations" and the number of unit commands
+        self.skipped = []
+        self.units_skipped = 0
+        self.seconds = 0.0
+        self.prompts = 0
+        self.baseline_seconds = 0.0
+        self.output = None
+
+    @property
+    def name(self):
+        return self.job.name or ("job " + str(self.index + 1))
+
+    """
+        time (s) saved against running the job as it was, in manifest order
+    """
+    def saved(self):
+        return self.baseline_seconds - self.seconds
+
+    def to_dict(self):
+        return {"name": self.name, "index": self.index, "output": self.output, "setup_change": self.setup_change, "skipped": self.skipped,
+                "units_skipped": self.units_skipped, "seconds": round(self.seconds, 3), "baseline_seconds": round(self.baseline_seconds, 3)}
+
+
+class JobScheduler:
+    """
+        @param prompt_seconds: time counted for every operator prompt
+        @param setup_change_seconds: time counted for every change of mandrel setup
+        @param shift_hours: length of a shift, for the report
+        @param reorder: group the jobs, or keep the manifest order and only drop the redundant setup
+    """
+    def __init__(self, homing_seconds = DEFAULT_HOMING_SECONDS, prompt_seconds = PROMPT_SECONDS, setup_change_seconds = SETUP_CHANGE_SECONDS,
+                 shift_hours = SHIFT_HOURS, reorder = True):
+        self.homing_seconds = homing_seconds
+        self.prompt_seconds = prompt_seconds
+        self.setup_change_seconds = setup_change_seconds
+        self.shift_hours = shift_hours
+        self.reorder = reorder
+        self.scheduled = []
+
+    """
+        the order to run the jobs in, as manifest indexes
+        sorting is stable, so jobs with the same setup keep their manifest order
+    """
+    def order(self, jobs):
+        indexes = list(range(len(jobs)))
+        if self.reorder:
+            indexes.sort(key = lambda i: setup_key(jobs[i]))
+        return indexes
+
+    """
+        works out the schedule, and writes the programs when given somewhere to
+        @param jobs: list of WindJobs, in manifest order
+        @param output_dir: directory to write the programs to, numbered in the order to run them. None to only plan
+        @return list of ScheduledJobs, in the order to run them
+    """
+    def schedule(self, jobs, output_dir = None):
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok = True)
+        simulator = MachineSimulator(self.homing_seconds)
+        units = {}
+        self.scheduled = []
+        previous = None
+        for position, index in enumerate(self.order(jobs)):
+            job = jobs[index]
+            scheduled = ScheduledJob(self.trim(job, simulator, previous), index, previous is not None and setup_key(job) != setup_key(previous))
+            if job.pre_wrap is not None:
+                scheduled.skipped = [key for key in ("home", "check_locations") if job.pre_wrap[key] and not scheduled.job.pre_wrap[key]]
+            if output_dir is not None:
+                name = job.name or ("job_" + str(index + 1))
+                scheduled.output = os.path.join(output_dir, str(position + 1).zfill(2) + "_" + name + ("" if "." in name else ".gcode"))
+            with open_sink(scheduled.output) as sink:
+                self.run_job(scheduled, simulator, units, sink)
+            self.scheduled.append(scheduled)
+            previous = job
+        self.baselines(jobs)
+        return self.scheduled
+
+    """
+        copy of the job without the homing and holder check the machine doesn't need at this point
+        @param simulator: the machine as the jobs before left it
+        @param previous: the job that ran before, None for the first
+    """
+    def trim(self, job, simulator, previous):
+        if job.pre_wrap is None or job.pre_wrap["manual_home"]:
+            return job
+        data = copy.deepcopy(job.to_dict())
+        same_setup = previous is not None and setup_key(job) == setup_key(previous)
+        # a new mandrel goes in with the head homed out of the way, the program homes Y first for that
+        if data["pre_wrap"]["home"] and same_setup and self.still_homed(simulator):
+            data["pre_wrap"]["home"] = False
+        if data["pre_wrap"]["check_locations"] and same_setup:
+            data["pre_wrap"]["check_locations"] = False
+        return WindJob.from_dict(data)
+
+    """
+        whether the machine is homed and its coordinates are the ones homing gave it
+    """
+    def still_homed(self, simulator):
+        for axis in ("X", "Y", "Z"):
+            if axis not in simulator.homed or simulator.offset[axis] != 0:
+                return False
+        return True
+
+    """
+        runs a job on the machine, leaving out unit commands that set what's already set
+        @param units: the values the machine has for every (code, axis) so far
+    """
+    def run_job(self, scheduled, simulator, units, sink):
+        original = scheduled.job
+        start_time = simulator.time
+        start_prompts = simulator.prompts
+        # TubeWinder reports its calculations with print
+        with contextlib.redirect_stdout(io.StringIO()):
+            winder = original.create_winder(sink)
+            for record in original.records(winder):
+                if isinstance(record, Command) and not self.unit_needed(record.text, units):
+                    scheduled.units_skipped += 1
+                    continue
+                simulator.step(record)
+                sink.write(record.gcode())
+        winder.flush()
+        scheduled.seconds = simulator.time - start_time + (simulator.prompts - start_prompts) * self.prompt_seconds
+        if scheduled.setup_change:
+            scheduled.seconds += self.setup_change_seconds
+
+    """
+        whether a command has to go out, unit commands that only set the values in place don't
+    """
+    def unit_needed(self, text, units):
+        code, words = command_words(text)
+        if code not in UNIT_CODES:
+            return True
+        values = {(code, axis): value for axis, value in words.items() if value is not None}
+        if values and all(units.get(key) == value for key, value in values.items()):
+            return False
+        units.update(values)
+        return True
+
+    """
+        times every job as it was, run in manifest order
+    """
+    def baselines(self, jobs):
+        seconds = []
+        for i, job in enumerate(jobs):
+            with contextlib.redirect_stdout(io.StringIO()):
+                estimator = estimate_job(job, homing_seconds = self.homing_seconds)
+            total = estimator.total_seconds() + sum(stage.prompts for stage in estimator.stages) * self.prompt_seconds
+            if i > 0 and setup_key(job) != setup_key(jobs[i - 1]):
+                total += self.setup_change_seconds
+            seconds.append(total)
+        for scheduled in self.scheduled:
+            scheduled.baseline_seconds = seconds[scheduled.index]
+
+    """
+        splits the schedule into shifts, a job that doesn't fit in what's left of a shift starts the next one
+        @return list of dictionaries, one per shift
+    """
+    def shifts(self):
+        shift_seconds = self.shift_hours * 3600
+        shifts = []
+        current = None
+        for scheduled in self.scheduled:
+            if current is None or (current["jobs"] and current["seconds"] + scheduled.seconds > shift_seconds):
+                current = {"jobs": [], "seconds": 0.0, "baseline_seconds": 0.0, "saved_seconds": 0.0}
+                shifts.append(current)
+            current["jobs"].append(scheduled.name)
+            current["seconds"] += scheduled.seconds
+            current["baseline_seconds"] += scheduled.baseline_seconds
+            current["saved_seconds"] += scheduled.saved()
+        for shift in shifts:
+            for key in ("seconds", "baseline_seconds", "saved_seconds"):
+                shift[key] = round(shift[key], 3)
+        return shifts
+
+    def report(self):
+        return {"seconds": round(sum(scheduled.seconds for scheduled in self.scheduled), 3),
+                "baseline_seconds": round(sum(scheduled.baseline_seconds for scheduled in self.scheduled), 3),
+                "setup_changes": sum(1 for scheduled in self.scheduled if scheduled.setup_change),
+                "jobs": [scheduled.to_dict() for scheduled in self.scheduled], "shifts": self.shifts()}
+
+
+"""
+    G-code of every program in a schedule, in the order they run
+"""
+def schedule_programs(jobs, reorder = True):
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        scheduled = JobScheduler(reorder = reorder).schedule(jobs, output_dir)
+        programs = []
+        for entry in scheduled:
+            with open(entry.output) as program:
+                programs.append(program.read())
+    return programs
+
+
+"""
+    the G-code lines of a program that home the machine, up to its first move (a G1 that names an axis)
+"""
+def first_motion(program):
+    lines = []
+    for line in program.splitlines():
+        code, words = command_words(line)
+        if code == "G28" or (code == "G1" and any(axis in words for axis in "XYZE")):
+            lines.append(line.strip())
+            if code == "G1":
+                break
+    return lines
+
+
+"""
+    checks the scheduler leaves out homing only where it's safe to
+    @return list of problems, empty when everything checks out
+"""
+def check():
+    problems = []
+    # a diameter change homes again, Y first, before anything moves
+    small = WindJob.from_dict({"name": "small", "tube": {"od": 1}})
+    big = WindJob.from_dict({"name": "big", "tube": {"od": 4}})
+    programs = schedule_programs([small, big])
+    motion = first_motion(programs[1])
+    if not motion or motion[0] != "G28 Y":
+        problems.append("the tube after a diameter change moves before homing Y: " + ", ".join(motion))
+    # the same setup twice stays homed
+    programs = schedule_programs([small, WindJob.from_dict({"name": "small again", "tube": {"od": 1}})])
+    if any(line.startswith("G28") for line in first_motion(programs[1])):
+        problems.append("the second tube on the same setup homes again")
+    if not any(line.startswith("G28") for line in first_motion(programs[0])):
+        problems.append("the first tube of the run doesn't home")
+    return problems
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Order a manifest of tubes to keep machine setup down")
+    parser.add_argument("manifest", nargs = "?", help = "json manifest of jobs")
+    parser.add_argument("--check", action = "store_true", help = "check the scheduler on a few small schedules instead")
+    parser.add_argument("-o", "--output-dir", default = None, help = "write the programs here, numbered in the order to run them")
+    parser.add_argument("--keep-order", action = "store_true", help = "run in manifest order, only leave out the redundant setup")
+    parser.add_argument("--shift-hours", type = float, default = SHIFT_HOURS, help = "length of a shift (default " + str(SHIFT_HOURS) + ")")
+    parser.add_argument("--setup-minutes", type = float, default = SETUP_CHANGE_SECONDS / 60,
+                        help = "time to change mandrel setup (default " + str(SETUP_CHANGE_SECONDS // 60) + ")")
+    parser.add_argument("--prompt-seconds", type = float, default = PROMPT_SECONDS,
+                        help = "time to answer an operator prompt (default " + str(PROMPT_SECONDS) + ")")
+    parser.add_argument("--summary", default = None, help = "also write the report as json to this file")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        problems = check()
+        for problem in problems:
+            print(problem)
+        print("ok" if not problems else str(len(problems)) + " problems")
+        return 1 if problems else 0
+    if args.manifest is None:
+        parser.error("a manifest is needed")
+    scheduler = JobScheduler(prompt_seconds = args.prompt_seconds, setup_change_seconds = args.setup_minutes * 60, shift_hours = args.shift_hours,
+                             reorder = not args.keep_order)
+    scheduler.schedule(load_manifest(args.manifest), args.output_dir)
+    report = scheduler.report()
+    for scheduled in scheduler.scheduled:
+        line = scheduled.name + ": " + format_duration(scheduled.seconds)
+        if scheduled.setup_change:
+            line += ", change setup first"
+        skipped = scheduled.skipped + ([str(scheduled.units_skipped) + " unit commands"] if scheduled.units_skipped else [])
+        if skipped:
+            line += ", skips " + ", ".join(skipped)
+        print(line)
+    for i, shift in enumerate(report["shifts"]):
+        saved = shift["saved_seconds"]
+        # a setup change can land in a later shift than it did in manifest order
+        print("shift " + str(i + 1) + ": " + str(len(shift["jobs"])) + " jobs, " + format_duration(shift["seconds"])
+              + (", saves " + format_duration(saved) if saved >= 0 else ", costs " + format_duration(-saved)))
+    print("total " + format_duration(report["seconds"]) + " against " + format_duration(report["baseline_seconds"]) + " in manifest order, "
+          + str(report["setup_changes"]) + " setup changes")
+    if args.summary is not None:
+        with open(args.summary, 'w') as summary_file:
+            json.dump(report, summary_file, indent = 2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,299 @@
+import sys
+from math import sqrt
+
+from Toolpath import Move, Command, Stage
+
+"""
+Simulates the state of the winder as it runs a program
+Feed it records (from TubeWinder or GcodeParser) and it keeps track of where every axis is, the
+units and limits the program has set (M92, M203, M201), homing, prompts and status messages, and
+how long the machine has been running. step() returns a MachineState for every record, so the
+whole run can be followed as a timeline without holding the program in memory.
+
+Moves are timed with a trapezoidal speed profile, from rest up to the feedrate and back to rest,
+slowed down so that no axis goes over its M203/M201 limits.
+
+usage: python MachineSimulator.py program.gcode
+
+"""
+
+AXES = ("X", "Y", "Z", "E")
+# used for any axis the program doesn't set a limit for (Marlin's defaults)
+DEFAULT_MAX_FEEDRATE = {"X": 300, "Y": 300, "Z": 5, "E": 25}
+DEFAULT_ACCELERATION = {"X": 3000, "Y": 3000, "Z": 100, "E": 10000}
+DEFAULT_STEPS_PER_UNIT = {"X": 80, "Y": 80, "Z": 400, "E": 500}
+# rough time for a G28, the machine's homing speeds aren't part of the program
+DEFAULT_HOMING_SECONDS = 10
+
+# kinds of MachineState
+MOVE = "move"
+UNITS = "units"
+HOME = "home"
+SET_POSITION = "set_position"
+PROMPT = "prompt"
+STATUS = "status"
+MOTORS = "motors"
+STAGE = "stage"
+COMMAND = "command"
+
+"""
+    splits a command into its code and axis words, ie "M203 X375" -> ("M203", {"X": 375.0})
+    comments in brackets or after a ; are dropped. Words without a value map to None
+"""
+def command_words(text):
+    for marker in ("(", ";"):
+        if marker in text:
+            text = text[:text.index(marker)]
+    parts = text.split()
+    words = {}
+    for part in parts[1:]:
+        try:
+            words[part[0].upper()] = float(part[1:]) if len(part) > 1 else None
+        except ValueError:
+            pass
+    return (parts[0].upper() if parts else ""), words
+
+
+"""
+    time (s) to move dist (mm) starting and ending at rest
+    @param dist: length of the move
+    @param speed: cruising speed in mm/s
+    @param accel: acceleration in mm/s^2
+"""
+def trapezoid_time(dist, speed, accel):
+    if dist <= 0:
+        return 0.0
+    if speed <= 0:
+        return float("inf")
+    if accel <= 0:
+        return dist / speed
+    if dist >= speed * speed / accel:
+        # reaches full speed: accelerate, cruise, decelerate
+        return dist / speed + speed / accel
+    # never reaches full speed, accelerate half the way and decelerate the rest
+    return 2 * sqrt(dist / accel)
+
+
+class MachineState:
+    """
+        snapshot of the machine after one record
+        x, y, z and e are the positions the program sees (after any G92), time is the running total in seconds
+        and duration how long this record took. message holds the command text, prompt or stage name
+    """
+    __slots__ = ("line", "kind", "x", "y", "z", "e", "feedrate", "time", "duration", "message")
+
+    def __init__(self, line, kind, x, y, z, e, feedrate, time, duration, message = None):
+        self.line = line
+        self.kind = kind
+        self.x = x
+        self.y = y
+        self.z = z
+        self.e = e
+        self.feedrate = feedrate
+        self.time = time
+        self.duration = duration
+        self.message = message
+
+    def __repr__(self):
+        return ("MachineState(line=" + str(self.line) + ", " + self.kind + ", X" + str(self.x) + " Y" + str(self.y) + " Z" + str(self.z)
+                + " E" + str(self.e) + " F" + str(self.feedrate) + ", t=" + str(round(self.time, 3)) + ")")
+
+
+class MachineSimulator:
+    """
+        @param homing_seconds: time counted for every G28
+    """
+    def __init__(self, homing_seconds = DEFAULT_HOMING_SECONDS):
+        self.homing_seconds = homing_seconds
+        self.position = {"X": 0.0, "Y": 0.0, "Z": 0.0, "E": 0.0}
+        # G92 shifts the program's coordinates, this keeps track of how far from the machine's own
+        self.offset = {"X": 0.0, "Y": 0.0, "Z": 0.0, "E": 0.0}
+        self.steps_per_unit = dict(DEFAULT_STEPS_PER_UNIT)
+        self.max_feedrate = dict(DEFAULT_MAX_FEEDRATE)
+        self.acceleration = dict(DEFAULT_ACCELERATION)
+        self.feedrate = None
+        self.homed = set()
+        self.motors_enabled = True
+        self.time = 0.0
+        self.line = 0
+        self.moves = 0
+        self.prompts = 0
+        self.homes = 0
+        self.unit_changes = 0
+        self.prompt = None
+        self.status = None
+        self.stage = None
+        # deltas of the last move, per axis (0 for axes that didn't move), and its length
+        self.last_delta = {"X": 0.0, "Y": 0.0, "Z": 0.0, "E": 0.0}
+        self.last_length = 0.0
+
+    """
+        runs one record
+        @param record: Move, Command or Stage
+        @param line: line number of the record, counts up on its own when not given
+        @return MachineState after the record
+    """
+    def step(self, record, line = None):
+        self.line = self.line + 1 if line is None else line
+        if isinstance(record, Move):
+            duration = self.run_move(record)
+            return self.state(MOVE, duration)
+        if isinstance(record, Stage):
+            self.stage = record.name
+            return self.state(STAGE, 0.0, record.name)
+        kind, duration = self.run_command(record.text)
+        return self.state(kind, duration, record.text)
+
+    """
+        runs every record, yielding the state after each one
+        @param records: iterable of records, or of (line number, record) as GcodeParser gives them
+    """
+    def timeline(self, records):
+        for item in records:
+            if isinstance(item, tuple):
+                yield self.step(item[1], item[0])
+            else:
+                yield self.step(item)
+
+    """
+        runs every record without keeping the states
+        @return the simulator, in its final state
+    """
+    def run(self, records):
+        for state in self.timeline(records):
+            pass
+        return self
+
+    def state(self, kind, duration, message = None):
+        position = self.position
+        return MachineState(self.line, kind, position["X"], position["Y"], position["Z"], position["E"], self.feedrate,
+                            self.time, duration, message)
+
+    """
+        position of an axis in the machine's own coordinates, undoing any G92
+    """
+    def machine_position(self, axis):
+        return self.position[axis] + self.offset[axis]
+
+    def run_move(self, move):
+        if move.feedrate is not None:
+            self.feedrate = move.feedrate
+        deltas = self.last_delta
+        total = 0.0
+        for axis, value in (("X", move.x), ("Y", move.y), ("Z", move.z), ("E", move.e)):
+            if value is None:
+                deltas[axis] = 0.0
+                continue
+            delta = value - self.position[axis]
+            self.position[axis] = value
+            deltas[axis] = delta
+            total += delta * delta
+        self.last_length = sqrt(total)
+        if total == 0:
+            return 0.0
+        self.moves += 1
+        duration = self.move_time(deltas, self.last_length)
+        self.time += duration
+        return duration
+
+    """
+        time (s) a move of the given per axis deltas takes at the current feedrate and limits
+        the feedrate is along the path through every axis, e included (see TubeWinder.determine_feedrate)
+    """
+    def move_time(self, deltas, length):
+        if not self.feedrate or length <= 0:
+            return 0.0
+        speed = self.feedrate / 60
+        accel = None
+        for axis in AXES:
+            delta = abs(deltas[axis])
+            if delta == 0:
+                continue
+            # slow the whole move down until no axis goes over its limits
+            share = delta / length
+            speed = min(speed, self.max_feedrate[axis] / share)
+            axis_accel = self.acceleration[axis] / share
+            accel = axis_accel if accel is None else min(accel, axis_accel)
+        return trapezoid_time(length, speed, accel)
+
+    """
+        speed (mm/s) each axis moved at during the last move, without acceleration
+    """
+    def axis_speeds(self):
+        if not self.feedrate or self.last_length <= 0:
+            return {axis: 0.0 for axis in AXES}
+        speed = self.feedrate / 60 / self.last_length
+        return {axis: abs(delta) * speed for axis, delta in self.last_delta.items()}
+
+    def run_command(self, text):
+        code, words = command_words(text)
+        if code in ("M92", "M203", "M201"):
+            table = {"M92": self.steps_per_unit, "M203": self.max_feedrate, "M201": self.acceleration}[code]
+            for axis, value in words.items():
+                if axis in AXES and value is not None:
+                    table[axis] = value
+            self.unit_changes += 1
+            return UNITS, 0.0
+        if code == "G92":
+            axes = [axis for axis in words if axis in AXES]
+            for axis in axes or AXES:
+                value = words.get(axis)
+                value = 0.0 if value is None else value
+                # the machine doesn't move, only the program's numbers do
+                self.offset[axis] += self.position[axis] - value
+                self.position[axis] = value
+            return SET_POSITION, 0.0
+        if code == "G28":
+            axes = [axis for axis in words if axis in AXES and axis != "E"] or ["X", "Y", "Z"]
+            for axis in axes:
+                self.position[axis] = 0.0
+                self.offset[axis] = 0.0
+                self.homed.add(axis)
+            self.homes += 1
+            self.time += self.homing_seconds
+            return HOME, self.homing_seconds
+        if code in ("M0", "M1"):
+            # waiting on the operator isn't machine time
+            self.prompts += 1
+            self.prompt = text.split(" ", 1)[1] if " " in text else ""
+            return PROMPT, 0.0
+        if code == "M117":
+            self.status = text.split(" ", 1)[1] if " " in text else ""
+            return STATUS, 0.0
+        if code in ("M17", "M18", "M84"):
+            self.motors_enabled = code == "M17"
+            if not self.motors_enabled:
+                # the axes can be pushed around by hand now, they're no longer homed
+                self.homed.clear()
+            return MOTORS, 0.0
+        return COMMAND, 0.0
+
+
+def main(argv = None):
+    from GcodeParser import parse_file
+
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print("usage: python MachineSimulator.py program.gcode")
+        return 1
+    simulator = MachineSimulator()
+    low = {}
+    high = {}
+    for state in simulator.timeline(parse_file(argv[0])):
+        if state.kind == MOVE:
+            for axis, value in (("X", state.x), ("Y", state.y), ("Z", state.z)):
+                low[axis] = min(low.get(axis, value), value)
+                high[axis] = max(high.get(axis, value), value)
+    print("Lines: " + str(simulator.line))
+    print("Moves: " + str(simulator.moves) + ", homes: " + str(simulator.homes) + ", prompts: " + str(simulator.prompts))
+    print("Machine time: " + str(round(simulator.time, 1)) + "s")
+    for axis in sorted(low):
+        print(axis + " travel: " + str(round(low[axis], 3)) + " to " + str(round(high[axis], 3)))
+    print("Max feedrates: " + str(simulator.max_feedrate))
+    print("Accelerations: " + str(simulator.acceleration))
+    print("Steps per unit: " + str(simulator.steps_per_unit))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+import sys
+from math import ceil, cos, gcd, radians, tan
+
+"""
+Works out wind patterns that cover the tube in as few passes as possible
+Every pass of a wrap lays two helical bands (out and back) and then indexes the tube around before
+the next one. Around the tube a band covers filament_width / cos(wind angle) of the circumference,
+so to leave no gaps there have to be at least circumference / (band width * overlap) passes, the
+overlap multiplier being how far each band moves on from the one next to it as a fraction of its
+width (.9 overlaps them by 10%).
+
+Indexing by step / passes of a turn, with step and passes coprime, visits every one of the passes
+evenly spaced start angles exactly once before coming back around, so the layer comes out even.
+Out of those steps the solver picks the one that needs the least rotation after each pass.
+
+usage: python PatternSolver.py manifest.json
+
+"""
+
+class WindPattern:
+    """
+        @param passes: passes per layer
+        @param step: the tube is indexed step / passes of a turn between passes
+        @param spacing: distance (mm) between neighbouring bands around the tube
+        @param band_width: width (mm) of a band around the tube
+        @param reindex_deg: rotation (deg) at the end of every pass to get to the next start angle
+    """
+    def __init__(self, passes, step, spacing, band_width, reindex_deg):
+        self.passes = passes
+        self.step = step
+        self.spacing = spacing
+        self.band_width = band_width
+        self.reindex_deg = reindex_deg
+
+    """
+        angle (deg) between the start of one pass and the next
+    """
+    @property
+    def index_deg(self):
+        return 360.0 * self.step / self.passes
+
+    """
+        how much of its width each band overlaps the next one by
+    """
+    def overlap(self):
+        return 1 - self.spacing / self.band_width
+
+    def to_dict(self):
+        return {"passes": self.passes, "step": self.step, "index_deg": round(self.index_deg, 4), "spacing": round(self.spacing, 4),
+                "band_width": round(self.band_width, 4), "reindex_deg": round(self.reindex_deg, 4)}
+
+    def __repr__(self):
+        return "WindPattern(" + str(self.passes) + " passes, step " + str(self.step) + ", spacing " + str(round(self.spacing, 3)) + "mm)"
+
+
+"""
+    finds the pattern with the fewest passes that covers the tube
+    @param circumference: e distance (mm) of one turn of the tube
+    @param length: length (mm) of the tube
+    @param filament_width: width (mm) of the filament
+    @param overlap_multiplier: band spacing as a fraction of the band width, 1 just touches
+    @param wind_angle: angle to wind at (deg from the tube's axis)
+    @param extension_dist: distance the head goes past each end of the tube
+    @param turned_deg: how far the tube turns in a pass before the re-index, None for the original dwell at each end
+    @return WindPattern
+"""
+def solve_pattern(circumference, length, filament_width, overlap_multiplier, wind_angle, extension_dist = 0, turned_deg = None):
+    if not 0 <= wind_angle < 90:
+        raise ValueError("Wind angle has to be from 0 up to 90 deg, not " + str(wind_angle))
+    if filament_width <= 0 or overlap_multiplier <= 0:
+        raise ValueError("Filament width and overlap multiplier have to be positive")
+    band_width = filament_width / cos(radians(wind_angle))
+    # a hair of slack so a spacing that works out exactly doesn't get an extra pass from rounding
+    passes = max(1, int(ceil(circumference / (band_width * overlap_multiplier) - 1e-9)))
+    # how far around the tube has turned by the end of a pass, before the re-index:
+    # out, 360 deg, back, 60 deg (see TubeWinder.iter_wrap)
+    if turned_deg is None:
+        e_mm_per_deg = circumference / 360
+        traverse_deg = (length + 2 * extension_dist) * tan(radians(wind_angle)) / e_mm_per_deg
+        turned_deg = 2 * traverse_deg + 360 + 60
+    turned = turned_deg % 360
+    best = None
+    for step in range(1, passes + 1):
+        if gcd(step, passes) != 1:
+            continue
+        reindex = (360.0 * step / passes - turned) % 360
+        if best is None or reindex < best.reindex_deg:
+            best = WindPattern(passes, step, circumference / passes, band_width, reindex)
+    return best
+
+
+"""
+    the pattern for a wrap on a TubeWinder, see solve_pattern
+"""
+def solve_wrap(winder, filament_width, overlap_multiplier, wind_angle, extension_dist, turned_deg = None):
+    return solve_pattern(winder.e_circumference, winder.length, filament_width, overlap_multiplier, wind_angle, extension_dist, turned_deg)
+
+
+def main(argv = None):
+    import contextlib
+    import io
+    from WindJob import load_manifest, INCH
+
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print("usage: python PatternSolver.py manifest.json")
+        return 1
+    try:
+        from CoverageMap import coverage_job
+    except ImportError:
+        # no numpy, just show the patterns
+        coverage_job = None
+    for i, job in enumerate(load_manifest(argv[0])):
+        if job.wrap is None:
+            continue
+        print((job.name or ("job " + str(i + 1))) + ":")
+        with contextlib.redirect_stdout(io.StringIO()):
+            winder = job.create_winder()
+        reports = {}
+        if coverage_job is not None:
+            for pattern in ("heuristic", "solve"):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    reports[pattern] = coverage_job(job.with_pattern(pattern), passes_needed = False)["layers"]
+        for row_index, row in enumerate(job.wrap["rows"]):
+            with contextlib.redirect_stdout(io.StringIO()):
+                old_passes = winder.wrap_pattern(float(job.wrap["filament_width"]) * INCH, float(job.wrap["filament_overlap"]), float(row["angle"]))[0]
+            pattern = solve_wrap(winder, float(job.wrap["filament_width"]) * INCH, float(job.wrap["filament_overlap"]), float(row["angle"]),
+                                 float(job.wrap["extension"]) * INCH)
+            line = "    row " + str(row_index + 1) + " (" + str(row["angle"]) + " deg): " + str(old_passes) + " passes -> " + str(pattern.passes)
+            line += " passes, index " + str(pattern.step) + "/" + str(pattern.passes) + " of a turn"
+            if reports:
+                line += ", coverage " + str(round(reports["heuristic"][row_index]["coverage"] * 100, 2)) + "% -> "
+                line += str(round(reports["solve"][row_index]["coverage"] * 100, 2)) + "%"
+            print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+"""
+Disk cache of generated G-code, one entry per stage
+A stage's G-code only depends on the TubeWinder it runs on (diameter, length, offsets, feedrate
+mode), the stage's own parameters, and the part of the winder's state the stage uses (see
+TubeWinder.stage_inputs). All of that, plus a hash of the generating code itself, is hashed into the
+key, so a stage run again with the same inputs is read back from disk instead of working the geometry
+out again. Each entry keeps the state the stage sets, so the next stage picks up exactly where it
+would have.
+
+Entries are plain files, evicted least recently used first once the cache goes over its size.
+Several processes (ie CAWBatch workers) can share one cache directory.
+
+usage: python ProgramCache.py [cache directory]      show what's in the cache
+       python ProgramCache.py --clear [cache directory]
+       python ProgramCache.py --check                  check reused stages against fresh generation
+
+"""
+
+DEFAULT_CACHE_DIR = os.environ.get("CAW_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "caw"))
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# once over max_bytes, evict down to this fraction of it, so eviction doesn't run on every put
+EVICT_TO = .9
+ENTRY_SUFFIX = ".gcode"
+# the modules whose code decides what G-code comes out, a change to any of them invalidates every entry
+# (GenerationMetrics reports the same hash as the "source" of a run)
+SOURCE_MODULES = ("TubeWinder.py", "WrapPlanner.py", "PatternSolver.py", "TurnaroundPlanner.py", "Toolpath.py", "GcodeSink.py")
+
+
+"""
+    hash of the generating code
+"""
+def source_hash():
+    digest = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in SOURCE_MODULES:
+        try:
+            with open(os.path.join(here, name), 'rb') as source:
+                digest.update(source.read())
+        except OSError:
+            digest.update(name.encode())
+    return digest.hexdigest()
+
+
+SOURCE_HASH = source_hash()
+
+
+def json_default(value):
+    # ie WindPatterns
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    return repr(value)
+
+
+class ProgramCache:
+    """
+        @param path: directory to keep the entries in, made if it isn't there
+        @param max_bytes: size the cache is kept under
+    """
+    def __init__(self, path = DEFAULT_CACHE_DIR, max_bytes = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok = True)
+        self.size = None
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    """
+        key of a stage run on the winder as it is right now
+        @param method: name of the TubeWinder generator for the stage, ie "iter_wrap"
+        @param args: arguments for it
+    """
+    def key(self, winder, method, args):
+        data = {"source": SOURCE_HASH, "winder": winder.settings, "stage": method, "args": list(args), "state": winder.stage_inputs(method)}
+        text = json.dumps(data, sort_keys = True, default = json_default)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + ENTRY_SUFFIX)
+
+    """
+        @return (G-code, state the stage sets), or None when it isn't cached
+    """
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path) as entry:
+                header = entry.readline()
+                text = entry.read()
+            state = json.loads(header)
+        except (OSError, ValueError):
+            # not there, evicted by another process while reading, or half written by one that died
+            self.stats["misses"] += 1
+            return None
+        try:
+            # used just now, keep it out of the way of eviction
+            os.utime(path)
+        except OSError:
+            pass
+        self.stats["hits"] += 1
+        return text, state
+
+    """
+        stores a stage, the first line of the entry holds the state as json and the rest is the G-code
+    """
+    def put(self, key, text, state):
+        header = json.dumps(state) + "\n"
+        # write to a temporary file and move it into place, so a reader never sees half an entry
+        handle, temp_path = tempfile.mkstemp(dir = self.path, suffix = ".tmp")
+        try:
+            with os.fdopen(handle, 'w') as entry:
+                entry.write(header)
+                entry.write(text)
+            os.replace(temp_path, self.entry_path(key))
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        if self.size is None:
+            self.size = self.total_size()
+        else:
+            self.size += len(header) + len(text)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    """
+        G-code of a stage, from the cache or by running it. Either way the winder ends up in the
+        state the stage leaves it in
+        @param on_record: called with every record when the stage has to be run
+        @return G-code of the stage
+    """
+    def stage(self, winder, method, args, on_record = None):
+        key = self.key(winder, method, args)
+        cached = self.get(key)
+        if cached is not None:
+            text, state = cached
+            winder.set_state(state)
+            return text
+        records = getattr(winder, method)(*args)
+        if on_record is not None:
+            records = (record for record in records if on_record(record) or True)
+        text = "".join(record.gcode() for record in records)
+        self.put(key, text, winder.stage_outputs(method))
+        return text
+
+    """
+        writes a WindJob's program, stage by stage, through the cache
+        @param file: file or GcodeSink to write to
+        @param on_report: see TubeWinder. Stages read from the cache don't report anything
+        @return the TubeWinder used, in its final state
+    """
+    def write_job(self, job, file, on_report = None):
+        winder = job.create_winder(file, on_report = on_report)
+        for name, method, args in job.stages():
+            winder.sink.write(self.stage(winder, method, args))
+        winder.flush()
+        return winder
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            try:
+                info = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, name))
+        return entries
+
+    def total_size(self):
+        return sum(size for mtime, size, name in self.entries())
+
+    """
+        deletes the least recently used entries until the cache is back under EVICT_TO of its size
+    """
+    def evict(self):
+        entries = sorted(self.entries())
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, name in entries:
+            if size <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+                self.stats["evictions"] += 1
+            except OSError:
+                # someone else got to it first
+                pass
+            size -= entry_size
+        self.size = size
+
+    def clear(self):
+        for mtime, size, name in self.entries():
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+        self.size = 0
+
+
+"""
+    checks that programs put together from reused stages, by the cache and by IncrementalProgram, come out
+    the same as generating them fresh. Stages are reused across jobs that differ in one stage, so a stage
+    that depends on state it doesn't list in TubeWinder.STAGE_STATE shows up here
+    @return list of problems, empty when everything matches
+"""
+def check():
+    from GcodeSink import MemorySink
+    from IncrementalProgram import IncrementalProgram
+    from WindJob import WindJob
+
+    def ignore_report(name, value):
+        pass
+
+    def generate(job, cache = None):
+        sink = MemorySink()
+        job.generate(sink, cache = cache, on_report = ignore_report)
+        return sink.getvalue()
+
+    # pairs of jobs, the second one runs on what's left from the first
+    pairs = []
+    for mode in ("rpm", "max"):
+        feedrates = {"mode": mode}
+        with_tape = {"feedrates": feedrates}
+        without_tape = {"feedrates": feedrates, "heat_shrink": None}
+        pairs.append(("shrink tape left out, " + mode + " feedrates", with_tape, without_tape))
+        pairs.append(("shrink tape put back, " + mode + " feedrates", without_tape, with_tape))
+    problems = []
+    for label, first, second in pairs:
+        first, second = WindJob.from_dict(first), WindJob.from_dict(second)
+        expected = generate(second)
+        with tempfile.TemporaryDirectory() as path:
+            cache = ProgramCache(path)
+            generate(first, cache)
+            if generate(second, cache) != expected:
+                problems.append(label + ": the cache's program differs from a fresh one")
+        program = IncrementalProgram()
+        program.update(first, on_report = ignore_report)
+        program.update(second, on_report = ignore_report)
+        if program.text() != expected:
+            problems.append(label + ": the incremental program differs from a fresh one")
+    return problems
+
+
+def main(argv = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if "--check" in argv:
+        problems = check()
+        for problem in problems:
+            print(problem)
+        print("ok" if not problems else str(len(problems)) + " problems")
+        return 1 if problems else 0
+    clear = "--clear" in argv
+    argv = [arg for arg in argv if arg != "--clear"]
+    cache = ProgramCache(argv[0] if argv else DEFAULT_CACHE_DIR)
+    if clear:
+        cache.clear()
+    entries = cache.entries()
+    print(cache.path + ": " + str(len(entries)) + " stages, " + str(sum(entry[1] for entry in entries)) + " bytes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
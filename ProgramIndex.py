@@ -0,0 +1,368 @@
+import argparse
+import gzip
+import json
+import os
+import sys
+
+from GcodeParser import parse_line
+from GcodeSink import open_sink, format_number
+from MachineSimulator import MachineSimulator, command_words
+from Toolpath import Move, Command, Stage
+
+"""
+Checkpoints of a program, to pick an interrupted run back up where it stopped
+The index is a json sidecar next to the program (program.gcode.idx.json) with a checkpoint at the
+start of every stage and every "M117 Pass i of n". Each checkpoint has the byte offset and line of
+its line in the program, and the machine's state right before it: where every axis is (x, y, z
+and e, TubeWinder's x_loc, y_loc, z_loc and e_loc as written out, so z is mm of the head gear), the
+feedrate, the units and limits set so far (M92, M203, M201) and which axes are homed.
+
+The index also keeps every command that set the machine up before each checkpoint (units, homing,
+motors, G92 of anything but e), in order. A resumed program replays those, which re-homes the
+machine the same way the program did, moves back to the checkpoint with x and z first and y last,
+sets e to where it was with a G92 and waits for the operator to re-tie the filament. The rest is
+copied straight out of the program from the checkpoint's offset, nothing is generated again.
+
+Offsets are into the G-code text, a .gz program is indexed and resumed through its decompressed text.
+
+usage: python ProgramIndex.py program.gcode                               index a program, list its checkpoints
+       python ProgramIndex.py program.gcode --stage "Wrap 2" --pass 12    write program.resume.gcode
+
+"""
+
+INDEX_SUFFIX = ".idx.json"
+RESUME_SUFFIX = ".resume.gcode"
+PASS_PREFIX = "M117 Pass "
+# commands that set the machine up rather than move it, replayed when resuming
+SETUP_CODES = ("M92", "M203", "M201", "G28", "M17", "M18", "M84")
+# feedrate to move back to a checkpoint at, the pre wrap's default
+RESUME_FEEDRATE = 2000
+COPY_SIZE = 1 << 18
+
+
+class Checkpoint:
+    """
+        @param stage: name of the stage the checkpoint is in
+        @param occurrence: how many stages of that name there have been, counting this one
+        @param number: the pass the checkpoint starts, None at the start of the stage
+        @param offset: byte offset of the checkpoint's line in the program
+        @param text: the checkpoint's line, to check the index still fits the program
+        @param state: the machine's state before the line, see ProgramIndexer.state
+        @param setup: number of the index's setup commands run before the checkpoint
+    """
+    def __init__(self, stage, occurrence, number, passes, offset, line, text, state, setup):
+        self.stage = stage
+        self.occurrence = occurrence
+        self.number = number
+        self.passes = passes
+        self.offset = offset
+        self.line = line
+        self.text = text
+        self.state = state
+        self.setup = setup
+
+    """
+        name of the stage, numbered when there is more than one of it, ie "Wrap 2"
+    """
+    def stage_label(self, numbered = True):
+        return self.stage + (" " + str(self.occurrence) if numbered else "")
+
+    def label(self, numbered = True):
+        label = self.stage_label(numbered)
+        if self.number is not None:
+            label += " pass " + str(self.number) + " of " + str(self.passes)
+        return label
+
+    def to_dict(self):
+        return {"stage": self.stage, "occurrence": self.occurrence, "pass": self.number, "passes": self.passes, "offset": self.offset,
+                "line": self.line, "text": self.text, "state": self.state, "setup": self.setup}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["stage"], data["occurrence"], data["pass"], data["passes"], data["offset"], data["line"], data["text"], data["state"],
+                   data["setup"])
+
+
+class ProgramIndex:
+    """
+        @param setup: every setup command of the program, in order (see SETUP_CODES)
+        @param checkpoints: list of Checkpoints, in the order they come in the program
+        @param size: bytes of G-code the index was made from
+    """
+    def __init__(self, setup = None, checkpoints = None, size = 0, lines = 0):
+        self.setup = [] if setup is None else setup
+        self.checkpoints = [] if checkpoints is None else checkpoints
+        self.size = size
+        self.lines = lines
+
+    """
+        whether a stage name comes up more than once, and so needs its number
+    """
+    def repeated(self, stage):
+        return any(checkpoint.stage == stage and checkpoint.occurrence > 1 for checkpoint in self.checkpoints)
+
+    def label(self, checkpoint):
+        return checkpoint.label(self.repeated(checkpoint.stage))
+
+    """
+        the checkpoint to resume from
+        @param stage: name of the stage, ie "Wrap", or with its number when there's more than one of it, ie "Wrap 2".
+            None for the first stage with passes when a pass is given
+        @param number: pass to resume at, None for the start of the stage
+    """
+    def find(self, stage = None, number = None):
+        if stage is None and number is None:
+            raise ValueError("Pick a stage or a pass to resume from")
+        matches = []
+        for checkpoint in self.checkpoints:
+            if stage is None:
+                matches.append(checkpoint)
+            elif stage in (checkpoint.stage, checkpoint.stage_label()):
+                if stage == checkpoint.stage and checkpoint.occurrence > 1 and matches:
+                    # a bare name is the first stage of that name
+                    break
+                matches.append(checkpoint)
+        for checkpoint in matches:
+            if checkpoint.number == number:
+                return checkpoint
+        where = "" if stage is None else " in " + stage
+        if number is None:
+            raise ValueError("No stage " + str(stage) + " in the program, it has: "
+                             + ", ".join(self.label(checkpoint) for checkpoint in self.checkpoints if checkpoint.number is None))
+        raise ValueError("No pass " + str(number) + where)
+
+    def to_dict(self):
+        return {"size": self.size, "lines": self.lines, "setup": self.setup, "checkpoints": [checkpoint.to_dict() for checkpoint in self.checkpoints]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["setup"], [Checkpoint.from_dict(checkpoint) for checkpoint in data["checkpoints"]], data["size"], data["lines"])
+
+    def write(self, path):
+        with open(path, 'w') as index_file:
+            json.dump(self.to_dict(), index_file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as index_file:
+            return cls.from_dict(json.load(index_file))
+
+
+class ProgramIndexer:
+    """
+        builds a ProgramIndex from the records of a program, as they go out
+    """
+    def __init__(self):
+        self.simulator = MachineSimulator()
+        self.index = ProgramIndex()
+        self.occurrences = {}
+        self.stage = None
+
+    """
+        the machine's state before the next record
+    """
+    def state(self):
+        simulator = self.simulator
+        # as they're written out (see format_move), the same from the records as from the file
+        at = {axis: float(format_number(value)) for axis, value in simulator.position.items()}
+        feedrate = int(simulator.feedrate) if simulator.feedrate is not None else None
+        return {"x": at["X"], "y": at["Y"], "z": at["Z"], "e": at["E"], "feedrate": feedrate, "units": {"steps_per_unit": dict(simulator.steps_per_unit), "max_feedrate": dict(simulator.max_feedrate),
+                                                          "acceleration": dict(simulator.acceleration)},
+                "homed": sorted(simulator.homed)}
+
+    """
+        takes the next record of the program
+        @param offset: byte offset of the record's line (the comment line of a stage)
+        @param line: line number of the record's line
+    """
+    def add(self, record, offset, line):
+        if isinstance(record, Stage):
+            self.stage = record.name
+            self.occurrences[record.name] = self.occurrences.get(record.name, 0) + 1
+            self.checkpoint(record.name, None, None, offset, line, "; " + record.name)
+        elif isinstance(record, Command):
+            text = record.text
+            if text.startswith(PASS_PREFIX) and self.stage is not None:
+                number, passes = pass_numbers(text)
+                if number is not None:
+                    self.checkpoint(self.stage, number, passes, offset, line, text)
+            elif self.is_setup(text):
+                self.index.setup.append(text)
+        self.simulator.step(record, line)
+
+    def checkpoint(self, stage, number, passes, offset, line, text):
+        self.index.checkpoints.append(Checkpoint(stage, self.occurrences[stage], number, passes, offset, line, text, self.state(),
+                                                 len(self.index.setup)))
+
+    def is_setup(self, text):
+        code, words = command_words(text)
+        if code in SETUP_CODES:
+            return True
+        if code == "G92":
+            # setting e is part of a stage, anything else says where an axis is on the machine
+            return any(axis != "E" for axis in words) or not words
+        # a prompt while the motors are off is the operator setting the machine up by hand (ie a manual home)
+        return code in ("M0", "M1") and not self.simulator.motors_enabled
+
+    """
+        indexes records on their way to a sink, see WindJob.generate
+        @param records: iterable of records
+        @param sink: GcodeSink the records are written to, its position gives their offsets
+        @return generator of the same records
+    """
+    def index_records(self, records, sink):
+        line = sink.lines_written + sum(text.count("\n") for text in sink.buffer)
+        for record in records:
+            offset = sink.tell()
+            if isinstance(record, Stage):
+                # a stage is written after two blank lines, checkpoint its comment line
+                line += 3
+                self.add(record, offset + 2, line)
+            else:
+                line += 1
+                self.add(record, offset, line)
+            yield record
+        self.index.size = sink.tell()
+        self.index.lines = line
+
+
+"""
+    the pass number and count of an "M117 Pass i of n" line
+    @return (i, n), (None, None) when the line doesn't fit
+"""
+def pass_numbers(text):
+    words = text[len(PASS_PREFIX):].split()
+    try:
+        return int(words[0]), int(words[2])
+    except (IndexError, ValueError):
+        return None, None
+
+
+"""
+    the sidecar of a program
+"""
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def open_program(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+"""
+    indexes a G-code file, streaming it
+    @return ProgramIndex
+"""
+def index_file(path):
+    indexer = ProgramIndexer()
+    offset = 0
+    number = 0
+    with open_program(path) as program:
+        for number, raw in enumerate(program, 1):
+            record = parse_line(raw.decode("ascii", "replace"))
+            if record is not None:
+                indexer.add(record, offset, number)
+            offset += len(raw)
+    indexer.index.size = offset
+    indexer.index.lines = number
+    return indexer.index
+
+
+"""
+    the index of a program, from its sidecar when that's there and still fits, otherwise indexed again
+    @param write: write the sidecar when the program had to be indexed
+"""
+def load_index(path, write = True):
+    sidecar = index_path(path)
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+        index = ProgramIndex.load(sidecar)
+        # a .gz is only known by its decompressed size, which the resume checks anyway
+        if path.endswith(".gz") or index.size == os.path.getsize(path):
+            return index
+    index = index_file(path)
+    if write:
+        index.write(sidecar)
+    return index
+
+
+"""
+    the records that bring the machine back to a checkpoint
+    @param feedrate: feedrate to move back to the checkpoint at
+    @return list of records
+"""
+def resume_preamble(index, checkpoint, feedrate = RESUME_FEEDRATE):
+    state = checkpoint.state
+    label = index.label(checkpoint)
+    records = [Stage("Resume at " + label), Command("M117 Resuming at " + label)]
+    records += [Command(text) for text in index.setup[:checkpoint.setup]]
+    # y is the head, keep it clear of the tube until x and z are where they go
+    records.append(Move(x = state["x"], z = state["z"], feedrate = feedrate))
+    records.append(Move(y = state["y"]))
+    records.append(Command("G92 E" + format_number(state["e"])))
+    records.append(Command("M0 Tie the filament back on to resume " + label))
+    if state["feedrate"] is not None:
+        records.append(Move(feedrate = state["feedrate"]))
+    return records
+
+
+"""
+    writes a program that picks a run back up at a checkpoint
+    @param path: the program that was running
+    @param output: where to write the resumed program, '.gz' is compressed
+    @return number of bytes copied from the program
+"""
+def write_resume(path, index, checkpoint, output, feedrate = RESUME_FEEDRATE):
+    with open_program(path) as program:
+        program.seek(checkpoint.offset)
+        first = program.readline()
+        if first.decode("ascii", "replace").strip() != checkpoint.text:
+            raise ValueError("The index doesn't fit " + path + " anymore, index it again")
+        copied = len(first)
+        with open_sink(output) as sink:
+            for record in resume_preamble(index, checkpoint, feedrate):
+                sink.write(record.gcode())
+            sink.write(first.decode("ascii", "replace"))
+            while True:
+                chunk = program.read(COPY_SIZE)
+                if not chunk:
+                    break
+                copied += len(chunk)
+                sink.write(chunk.decode("ascii", "replace"))
+    return copied
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Index a program's stages and passes, and resume an interrupted run from one")
+    parser.add_argument("program", help = "G-code file (.gcode or .gcode.gz)")
+    parser.add_argument("--stage", default = None, help = "stage to resume, ie \"Wrap\" or \"Wrap 2\" when there's more than one")
+    parser.add_argument("--pass", dest = "number", type = int, default = None, help = "pass to resume at, in the first stage with passes by default")
+    parser.add_argument("-o", "--output", default = None, help = "resumed program to write (default program" + RESUME_SUFFIX + ")")
+    parser.add_argument("-f", "--feedrate", type = int, default = RESUME_FEEDRATE, help = "feedrate to move back to the checkpoint at")
+    args = parser.parse_args(argv)
+
+    index = load_index(args.program)
+    if args.stage is None and args.number is None:
+        for checkpoint in index.checkpoints:
+            state = checkpoint.state
+            print("line " + str(checkpoint.line) + ": " + index.label(checkpoint) + " at X" + format_number(state["x"]) + " Y" + format_number(state["y"])
+                  + " Z" + format_number(state["z"]) + " E" + format_number(state["e"]))
+        return 0
+    try:
+        checkpoint = index.find(args.stage, args.number)
+    except ValueError as e:
+        print(e)
+        return 1
+    output = args.output
+    if output is None:
+        base = args.program[:-3] if args.program.endswith(".gz") else args.program
+        output = os.path.splitext(base)[0] + RESUME_SUFFIX
+    copied = write_resume(args.program, index, checkpoint, output, args.feedrate)
+    print("resuming at " + index.label(checkpoint) + " (line " + str(checkpoint.line) + "), " + str(copied) + " bytes of the program left, written to "
+          + output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
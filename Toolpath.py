@@ -0,0 +1,115 @@
+from GcodeSink import format_move
+
+"""
+Structured records for a generated program
+TubeWinder's stage generators yield these instead of text, so a program can be inspected,
+optimized or re-targeted before (or instead of) being turned into G-code.
+Each record knows how to write itself as G-code with gcode().
+
+"""
+
+class Move:
+    """
+        a G1 move, in absolute machine coordinates. Axes that are None don't move
+        z is in machine units (mm of the head gear), not degrees
+    """
+    __slots__ = ("x", "y", "z", "e", "feedrate")
+
+    def __init__(self, x = None, y = None, z = None, e = None, feedrate = None):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.e = e
+        self.feedrate = feedrate
+
+    def gcode(self):
+        return format_move(self.x, self.y, self.z, self.e, self.feedrate)
+
+    """
+        letters of the axes this move names, ie "XE"
+    """
+    def axes(self):
+        axes = ""
+        if self.x is not None:
+            axes += "X"
+        if self.y is not None:
+            axes += "Y"
+        if self.z is not None:
+            axes += "Z"
+        if self.e is not None:
+            axes += "E"
+        return axes
+
+    def __eq__(self, other):
+        return isinstance(other, Move) and (self.x, self.y, self.z, self.e, self.feedrate) == (other.x, other.y, other.z, other.e, other.feedrate)
+
+    def __repr__(self):
+        return "Move(" + self.gcode().strip() + ")"
+
+
+class Command:
+    """
+        any other single line of G-code, ie "G92 E0", "M0 Tie Down Filament" or "M117 Pass 1 of 20"
+    """
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    """
+        the G/M code of the command, ie "M117"
+    """
+    @property
+    def code(self):
+        return self.text.split(" ", 1)[0]
+
+    """
+        everything after the code, ie the prompt of an M0
+    """
+    @property
+    def message(self):
+        parts = self.text.split(" ", 1)
+        return parts[1] if len(parts) > 1 else ""
+
+    def gcode(self):
+        return self.text + "\n"
+
+    def __eq__(self, other):
+        return isinstance(other, Command) and self.text == other.text
+
+    def __repr__(self):
+        return "Command(" + repr(self.text) + ")"
+
+
+class Stage:
+    """
+        marks the start of a stage of the program (pre wrap, wrap, ...), written as a comment
+    """
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def gcode(self):
+        return "\n\n; " + self.name + "\n"
+
+    def __eq__(self, other):
+        return isinstance(other, Stage) and self.name == other.name
+
+    def __repr__(self):
+        return "Stage(" + repr(self.name) + ")"
+
+
+"""
+    writes records to a sink (or anything with a write method)
+    @param records: iterable of records, consumed lazily
+    @param sink: where to write the G-code
+"""
+def write_records(records, sink):
+    # sinks that store the records themselves (ToolpathBinary.ToolpathSink) take them as they are
+    if hasattr(sink, "write_records"):
+        sink.write_records(records)
+        return
+    write = sink.write
+    for record in records:
+        write(record.gcode())
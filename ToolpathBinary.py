@@ -0,0 +1,498 @@
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+import numpy as np
+
+from GcodeParser import parse_line, open_gcode
+from GcodeSink import GcodeSink, DEFAULT_BUFFER_SIZE
+from MachineSimulator import command_words
+from Toolpath import Move, Command, Stage
+
+"""
+Compact binary form of a program, for opening huge ones without parsing text
+A .cawtp file is a header, an array of fixed width records (RECORD_DTYPE, one per line or stage of
+the program) and a blob of text. Moves keep their coordinates as doubles, with a bit per axis for
+the ones the move names (the others are NaN). The feedrate is only ever written as a whole number,
+so it's kept as one. Unit changes (M92/M203/M201), set position (G92) and
+homing (G28) keep their axis values the same way, next to their text. Prompts, other commands and
+stage names live in the text blob.
+
+Reading maps the file and hands out numpy views of it, so a program of millions of moves opens
+instantly and columns like records["x"] cost nothing until they're touched. positions() works out
+where the program is at every record (G92 and G28 included) in a few array operations.
+
+A record is 48 bytes, wider than most G-code lines, so a .cawtp file is two to three times the
+size of its G-code (test.gcode's 29492 bytes take 78995). That's the price of fixed width records
+that can be read anywhere without parsing a float. The coordinates stay doubles, floats can't keep
+the .001 they're written to once E gets past about 8m and a long wrap row goes well past that.
+
+Converting from G-code is lossless: a line that wouldn't come out the same way from its record
+(spacing, number formatting, comments, blank lines) keeps its exact text as well, so converting
+back gives the original file byte for byte. Generating straight to a .cawtp file (GcodeSink.open_sink) stores
+TubeWinder's records as they come, without formatting them as text first.
+
+usage: python ToolpathBinary.py program.gcode [program.cawtp]     convert to binary
+       python ToolpathBinary.py program.cawtp [program.gcode]     convert back
+       python ToolpathBinary.py --info program.cawtp
+
+"""
+
+MAGIC = b"CAWTP\0\0\0"
+VERSION = 2
+# magic, version, record size, record count, strings offset, strings length
+HEADER_FORMAT = "<8sIIQQQ"
+HEADER_SIZE = 64
+EXTENSION = ".cawtp"
+# records buffered before they're written out
+CHUNK_RECORDS = 65536
+
+# record kinds
+MOVE = 1
+SET_POSITION = 2
+HOME = 3
+UNITS = 4
+PROMPT = 5
+COMMAND = 6
+STAGE = 7
+# lines that aren't records, ie blank lines, kept only for their text
+TEXT = 8
+KIND_NAMES = {MOVE: "move", SET_POSITION: "set_position", HOME: "home", UNITS: "units", PROMPT: "prompt", COMMAND: "command", STAGE: "stage",
+              TEXT: "text"}
+
+# flags
+# the text is the exact G-code of the record, write it instead of formatting the record
+VERBATIM = 1
+
+# bits of mask for the values a record has
+AXIS_BITS = (("x", 1), ("y", 2), ("z", 4), ("e", 8), ("feedrate", 16))
+AXES = ("X", "Y", "Z", "E")
+
+RECORD_DTYPE = np.dtype([("kind", "u1"), ("flags", "u1"), ("mask", "u1"), ("pad", "u1"), ("text_length", "<u4"), ("text_start", "<u4"),
+                         ("feedrate", "<i4"), ("x", "<f8"), ("y", "<f8"), ("z", "<f8"), ("e", "<f8")])
+# text_start is 32 bits
+MAX_STRINGS_LENGTH = 1 << 32
+
+KIND_CODES = {"G92": SET_POSITION, "G28": HOME, "M92": UNITS, "M203": UNITS, "M201": UNITS, "M0": PROMPT, "M1": PROMPT}
+
+
+class ToolpathError(Exception):
+    pass
+
+
+"""
+    kind, mask and (x, y, z, e, feedrate) of a command
+"""
+def command_values(text):
+    code, words = command_words(text)
+    kind = KIND_CODES.get(code, COMMAND)
+    values = [np.nan] * 5
+    mask = 0
+    if kind in (SET_POSITION, HOME, UNITS):
+        axes = [axis for axis in AXES if axis in words]
+        if not axes and kind != UNITS:
+            # a bare G92 zeroes every axis, a bare G28 homes X, Y and Z
+            axes = list(AXES) if kind == SET_POSITION else ["X", "Y", "Z"]
+        for axis in axes:
+            index = AXES.index(axis)
+            value = words.get(axis)
+            values[index] = 0.0 if value is None or kind == HOME else value
+            mask |= AXIS_BITS[index][1]
+    return kind, mask, values
+
+
+"""
+    kind, mask, (x, y, z, e, feedrate) and text of a record
+    @param record: Move, Command or Stage, None for a TEXT record
+"""
+def record_values(record):
+    mask = 0
+    values = [np.nan] * 5
+    text = None
+    if isinstance(record, Move):
+        kind = MOVE
+        for index, value in enumerate((record.x, record.y, record.z, record.e, record.feedrate)):
+            if value is not None:
+                values[index] = value
+                mask |= AXIS_BITS[index][1]
+    elif isinstance(record, Stage):
+        kind = STAGE
+        text = record.name
+    elif isinstance(record, Command):
+        kind, mask, values = command_values(record.text)
+        text = record.text
+    elif record is None:
+        kind = TEXT
+    else:
+        raise ToolpathError("Can't store " + repr(record))
+    return kind, mask, values, text
+
+
+"""
+    a record's fields in RECORD_DTYPE's order
+"""
+def record_row(kind, flags, mask, text_length, text_start, values):
+    x, y, z, e, feedrate = values
+    return (kind, flags, mask, 0, text_length, text_start, int(feedrate) if mask & AXIS_BITS[4][1] else 0, x, y, z, e)
+
+
+"""
+    records in memory as a RECORD_DTYPE array, without their text
+"""
+def record_array(records):
+    rows = []
+    for record in records:
+        kind, mask, values, text = record_values(record)
+        rows.append(record_row(kind, 0, mask, 0, 0, values))
+    return np.array(rows, RECORD_DTYPE)
+
+
+"""
+    where a program is after every record, in its own coordinates
+    moves, G92 and G28 set the axes they name, every other record leaves them where they were
+    @param records: RECORD_DTYPE array
+    @return (number of records, 4) array of x, y, z, e
+"""
+def positions(records):
+    kinds = records["kind"]
+    sets = (kinds == MOVE) | (kinds == SET_POSITION) | (kinds == HOME)
+    filled = np.zeros((len(records), 4))
+    for column, name in enumerate(("x", "y", "z", "e")):
+        values = records[name]
+        known = sets & ~np.isnan(values)
+        # carry the last value set forward, everything starts at 0
+        last = np.maximum.accumulate(np.where(known, np.arange(len(values)), -1))
+        filled[:, column] = np.where(last >= 0, values[np.maximum(last, 0)], 0.0)
+    return filled
+
+
+class ToolpathWriter:
+    """
+        streams records into a .cawtp file
+        @param path: file to write, it's complete once the writer is closed
+    """
+    def __init__(self, path, chunk_records = CHUNK_RECORDS):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(b"\0" * HEADER_SIZE)
+        # the text goes after the records, it waits in a file of its own until they're all written
+        self.strings = tempfile.TemporaryFile()
+        self.strings_length = 0
+        self.count = 0
+        self.chunk = np.zeros(chunk_records, RECORD_DTYPE)
+        self.filled = 0
+
+    def store_text(self, text):
+        data = text.encode()
+        start = self.strings_length
+        if start + len(data) > MAX_STRINGS_LENGTH:
+            raise ToolpathError(self.path + " has more text than a toolpath file can hold")
+        self.strings.write(data)
+        self.strings_length += len(data)
+        return start, len(data)
+
+    """
+        adds a record
+        @param record: Move, Command or Stage, None for a TEXT record
+        @param verbatim: exact G-code of the record, when formatting the record wouldn't give it back
+    """
+    def add(self, record, verbatim = None):
+        kind, mask, values, text = record_values(record)
+        if verbatim is not None:
+            text = verbatim
+        start, length = self.store_text(text) if text is not None else (0, 0)
+        self.chunk[self.filled] = record_row(kind, VERBATIM if verbatim is not None else 0, mask, length, start, values)
+        self.filled += 1
+        self.count += 1
+        if self.filled == len(self.chunk):
+            self.write_chunk()
+
+    def add_records(self, records):
+        for record in records:
+            self.add(record)
+
+    def write_chunk(self):
+        self.file.write(self.chunk[:self.filled].tobytes())
+        self.filled = 0
+
+    def close(self):
+        if self.file is None:
+            return
+        self.write_chunk()
+        strings_offset = HEADER_SIZE + self.count * RECORD_DTYPE.itemsize
+        self.strings.seek(0)
+        shutil.copyfileobj(self.strings, self.file)
+        self.strings.close()
+        self.file.seek(0)
+        self.file.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, RECORD_DTYPE.itemsize, self.count, strings_offset, self.strings_length))
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ToolpathFile:
+    """
+        a .cawtp file, mapped into memory
+        records is a read only structured array over the file (see RECORD_DTYPE)
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            header = file.read(struct.calcsize(HEADER_FORMAT))
+        if len(header) < struct.calcsize(HEADER_FORMAT):
+            raise ToolpathError(path + " is too short to be a toolpath file")
+        magic, version, record_size, count, strings_offset, strings_length = struct.unpack(HEADER_FORMAT, header)
+        if magic != MAGIC:
+            raise ToolpathError(path + " isn't a toolpath file")
+        if version != VERSION or record_size != RECORD_DTYPE.itemsize:
+            raise ToolpathError(path + " is version " + str(version) + ", only version " + str(VERSION) + " can be read")
+        if os.path.getsize(path) < strings_offset + strings_length:
+            raise ToolpathError(path + " is cut short")
+        # memmap can't map nothing, an empty program gets empty arrays
+        if count:
+            self.records = np.memmap(path, RECORD_DTYPE, 'r', offset = HEADER_SIZE, shape = (count,))
+        else:
+            self.records = np.zeros(0, RECORD_DTYPE)
+        if strings_length:
+            self.strings = np.memmap(path, np.uint8, 'r', offset = strings_offset, shape = (strings_length,))
+        else:
+            self.strings = np.zeros(0, np.uint8)
+
+    def __len__(self):
+        return len(self.records)
+
+    def text(self, index):
+        row = self.records[index]
+        start = int(row["text_start"])
+        return self.strings[start:start + int(row["text_length"])].tobytes().decode()
+
+    """
+        the record at an index, None for TEXT records
+    """
+    def record(self, index):
+        row = self.records[index]
+        kind = int(row["kind"])
+        if kind == MOVE:
+            mask = int(row["mask"])
+            return Move(*(row[name].item() if mask & bit else None for name, bit in AXIS_BITS))
+        if kind == TEXT:
+            return None
+        text = self.text(index)
+        if row["flags"] & VERBATIM:
+            return parse_line(text)
+        return Stage(text) if kind == STAGE else Command(text)
+
+    """
+        every record in order, the same ones that were written (TEXT records are skipped)
+    """
+    def iter_records(self):
+        for index in range(len(self.records)):
+            record = self.record(index)
+            if record is not None:
+                yield record
+
+    """
+        G-code of the record at an index, exactly as it was converted from
+    """
+    def gcode(self, index):
+        if self.records[index]["flags"] & VERBATIM:
+            return self.text(index)
+        return self.record(index).gcode()
+
+    def write_gcode(self, file):
+        for index in range(len(self.records)):
+            file.write(self.gcode(index))
+
+    """
+        the G-code line every record comes out on once the file is converted back, the last one for a record
+        that takes several (a stage after its blank lines)
+        @return array of line numbers, one per record
+    """
+    def line_numbers(self):
+        # a record written as it formats takes a line, a stage takes its two blank lines and its comment
+        newlines = np.where(self.records["kind"] == STAGE, 3, 1).astype(np.int64)
+        own = newlines.copy()
+        for index in np.flatnonzero(self.records["flags"] & VERBATIM):
+            text = self.text(index)
+            newlines[index] = text.count("\n")
+            # the last line of a file can end without a newline
+            own[index] = text.count("\n", 0, len(text) - 1) + 1
+        return np.cumsum(newlines) - newlines + own
+
+    """
+        indexes of the records of a kind
+    """
+    def indexes(self, kind):
+        return np.flatnonzero(self.records["kind"] == kind)
+
+    """
+        where the program is after every record, see positions
+    """
+    def positions(self):
+        return positions(self.records)
+
+    def counts(self):
+        kinds = np.bincount(self.records["kind"], minlength = TEXT + 1)
+        return {KIND_NAMES[kind]: int(kinds[kind]) for kind in KIND_NAMES if kinds[kind]}
+
+    def close(self):
+        # the maps close once nothing refers to them
+        self.records = None
+        self.strings = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class LineConverter:
+    """
+        turns G-code lines into records on a ToolpathWriter, keeping the exact text of any that wouldn't format back the same
+        @param writer: ToolpathWriter
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        # blank lines waiting to see if they're the start of a stage
+        self.pending = []
+
+    """
+        @param line: a line with its line ending exactly as it is in the file
+    """
+    def add_line(self, line):
+        record = parse_line(line)
+        if record is None:
+            self.pending.append(line)
+            return
+        if isinstance(record, Stage) and self.pending[-2:] == ["\n", "\n"] and "\n\n" + line == record.gcode():
+            self.pending = self.pending[:-2]
+            self.add_record(record)
+        else:
+            self.write_pending()
+            self.writer.add(record, None if line == record.gcode() else line)
+
+    """
+        adds a record that's written exactly as it formats, ie one straight from TubeWinder
+    """
+    def add_record(self, record):
+        self.write_pending()
+        self.writer.add(record)
+
+    def write_pending(self):
+        if self.pending:
+            self.writer.add(None, "".join(self.pending))
+            self.pending = []
+
+    def finish(self):
+        self.write_pending()
+
+
+"""
+    converts G-code lines to records, see LineConverter
+    @param lines: lines with their line endings exactly as they are in the file, ie one opened with newline = ""
+    @param writer: ToolpathWriter
+"""
+def convert_lines(lines, writer):
+    converter = LineConverter(writer)
+    for line in lines:
+        converter.add_line(line)
+    converter.finish()
+
+
+class ToolpathSink(GcodeSink):
+    """
+        a sink that writes a .cawtp file instead of G-code text, see open_sink
+        records handed to write_records go in as they are, anything written as text is converted line by line.
+        The line and byte counts are those of the G-code the file converts back to
+        @param path: file to write, it's complete once the sink is closed
+    """
+    def __init__(self, path, buffer_size = DEFAULT_BUFFER_SIZE):
+        super().__init__(buffer_size)
+        self.writer = ToolpathWriter(path)
+        self.converter = LineConverter(self.writer)
+        # text after the last line ending written so far
+        self.partial = ""
+
+    def write_out(self, data):
+        text = self.partial + data
+        end = text.rfind("\n") + 1
+        self.partial = text[end:]
+        for line in io.StringIO(text[:end], newline = ""):
+            self.converter.add_line(line)
+
+    """
+        writes records without formatting them to text and parsing them back, see Toolpath.write_records
+    """
+    def write_records(self, records):
+        self.flush()
+        for record in records:
+            if self.partial:
+                # carries on a line written as text
+                self.write(record.gcode())
+                continue
+            text = record.gcode()
+            self.converter.add_record(record)
+            self.bytes_written += len(text)
+            self.lines_written += text.count("\n")
+
+    def close_out(self):
+        if self.partial:
+            self.converter.add_line(self.partial)
+        self.converter.finish()
+        self.writer.close()
+
+
+def gcode_to_binary(source, destination):
+    # newline = "" so \r\n endings come through as they are and get kept with the line's text
+    with open_gcode(source, newline = "") as lines, ToolpathWriter(destination) as writer:
+        convert_lines(lines, writer)
+        return writer.count
+
+
+def binary_to_gcode(source, destination):
+    with ToolpathFile(source) as toolpath, open(destination, 'w', newline = "") as file:
+        toolpath.write_gcode(file)
+        return len(toolpath)
+
+
+def main(argv = None):
+    import time
+
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) == 2 and argv[0] == "--info":
+        start = time.perf_counter()
+        with ToolpathFile(argv[1]) as toolpath:
+            positions = toolpath.positions()
+            seconds = time.perf_counter() - start
+            print(argv[1] + ": " + str(len(toolpath)) + " records " + str(toolpath.counts()))
+            if len(positions):
+                print("x " + str(round(positions[:, 0].min(), 3)) + " to " + str(round(positions[:, 0].max(), 3)) + ", opened in "
+                      + str(round(seconds * 1000, 2)) + "ms")
+        return 0
+    if len(argv) not in (1, 2) or argv[0].startswith("-"):
+        print("usage: python ToolpathBinary.py program.gcode|program" + EXTENSION + " [output]")
+        print("       python ToolpathBinary.py --info program" + EXTENSION)
+        return 1
+    source = argv[0]
+    if source.endswith(EXTENSION):
+        destination = argv[1] if len(argv) == 2 else source[:-len(EXTENSION)] + ".gcode"
+        count = binary_to_gcode(source, destination)
+    else:
+        base = source[:-3] if source.endswith(".gz") else source
+        destination = argv[1] if len(argv) == 2 else os.path.splitext(base)[0] + EXTENSION
+        count = gcode_to_binary(source, destination)
+    print(source + " -> " + destination + " (" + str(count) + " records)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import numpy as np
+
+from MachineSimulator import MachineSimulator, MOVE, HOME, STAGE
+
+"""
+Level of detail for drawing toolpaths
+A program can have tens of thousands of moves, far more than there are pixels to show them on
+when zoomed out. The toolpath is turned into polylines once, and each polyline keeps a pyramid of
+decimated copies, every level merging points that are closer than twice the distance the level
+below it does. A view picks the level that matches how much of the toolpath one pixel covers, and
+only the chunks of it that are on screen.
+
+Two plots come out of a program:
+    surface: x against e on the unrolled mandrel (e wrapped to the circumference, so every pass
+        shows up where it lands on the tube, broken where it crosses the seam)
+    head: the z head angle (deg) against machine time (s)
+
+Polylines are (n, 2) float arrays, with a row of NaNs wherever the line breaks.
+
+"""
+
+# number of levels kept, the tolerance doubles from one to the next
+DEFAULT_LEVELS = 12
+# points per chunk, the unit views are culled in
+CHUNK_POINTS = 2048
+
+
+class PolylineLOD:
+    """
+        @param points: (n, 2) array of the polyline, NaN rows break it
+        @param base_tolerance: (x, y) distance merged at the first decimated level (level 0 is the polyline as it is),
+            the two axes can be in different units
+        @param levels: how many levels to keep
+    """
+    def __init__(self, points, base_tolerance, levels = DEFAULT_LEVELS, chunk_points = CHUNK_POINTS):
+        self.points = np.asarray(points, dtype = float).reshape(-1, 2)
+        self.base_tolerance = np.asarray(base_tolerance, dtype = float)
+        self.chunk_points = chunk_points
+        finite = self.points[np.isfinite(self.points).all(axis = 1)]
+        if finite.size:
+            self.bounds = (float(finite[:, 0].min()), float(finite[:, 1].min()), float(finite[:, 0].max()), float(finite[:, 1].max()))
+        else:
+            self.bounds = (0.0, 0.0, 0.0, 0.0)
+        self.levels = [self.points]
+        for level in range(1, levels):
+            self.levels.append(decimate(self.levels[-1], self.tolerance(level)))
+        self.level_chunks = [split_chunks(points, chunk_points) for points in self.levels]
+
+    """
+        (x, y) tolerance of a level, 0 for the full polyline
+    """
+    def tolerance(self, level):
+        return self.base_tolerance * (0 if level == 0 else 2 ** (level - 1))
+
+    """
+        coarsest level that's still within a pixel
+        @param x_per_pixel, y_per_pixel: how much of the plot one pixel covers along each axis
+    """
+    def level_for(self, x_per_pixel, y_per_pixel):
+        level = 0
+        while level + 1 < len(self.levels):
+            x_tolerance, y_tolerance = self.tolerance(level + 1)
+            if x_tolerance > x_per_pixel or y_tolerance > y_per_pixel:
+                break
+            level += 1
+        return level
+
+    """
+        the chunks of a level that can be seen
+        @param view: (x min, y min, x max, y max) of the view, None for all of it
+        @return list of (n, 2) arrays
+    """
+    def visible_chunks(self, level, view = None):
+        chunks = self.level_chunks[level]
+        if view is None:
+            return [points for points, box in chunks]
+        x_min, y_min, x_max, y_max = view
+        return [points for points, box in chunks if box[0] <= x_max and box[2] >= x_min and box[1] <= y_max and box[3] >= y_min]
+
+    def point_count(self, level):
+        return len(self.levels[level])
+
+
+"""
+    drops points that land in the same tolerance sized cell as the point before them
+    the first and last point of every piece of the line are always kept
+    @param tolerance: (x, y) size of the cells
+"""
+def decimate(points, tolerance):
+    tolerance = np.asarray(tolerance, dtype = float)
+    if len(points) < 3 or (tolerance <= 0).any():
+        return points
+    finite = np.isfinite(points).all(axis = 1)
+    cells = np.floor(np.where(finite[:, None], points, 0) / tolerance).astype(np.int64)
+    keep = np.ones(len(points), dtype = bool)
+    keep[1:] = (cells[1:] != cells[:-1]).any(axis = 1)
+    # breaks, and the points either side of them
+    keep |= ~finite
+    keep[1:] |= ~finite[:-1]
+    keep[:-1] |= ~finite[1:]
+    keep[-1] = True
+    return points[keep]
+
+
+"""
+    cuts a polyline into chunks with their bounding boxes, neighbouring chunks share a point so nothing goes missing between them
+"""
+def split_chunks(points, chunk_points):
+    chunks = []
+    for start in range(0, max(len(points) - 1, 1), chunk_points):
+        chunk = points[start:start + chunk_points + 1]
+        finite = chunk[np.isfinite(chunk).all(axis = 1)]
+        if not finite.size:
+            continue
+        box = (finite[:, 0].min(), finite[:, 1].min(), finite[:, 0].max(), finite[:, 1].max())
+        chunks.append((chunk, box))
+    return chunks
+
+
+"""
+    lays moves out on the unrolled mandrel, splitting them where they cross the seam
+    @param x0, e0, x1, e1: arrays of the start and end of every move, e in mm of the machine's own coordinates
+    @param circumference: e distance of one turn
+    @return (n, 2) polyline of (x, e around the tube)
+"""
+def unroll(x0, e0, x1, e1, circumference):
+    x0, e0, x1, e1 = (np.asarray(a, dtype = float) for a in (x0, e0, x1, e1))
+    if not x0.size:
+        return np.zeros((0, 2))
+    first = np.floor(e0 / circumference)
+    last = np.floor(e1 / circumference)
+    crossings = np.abs(last - first).astype(np.int64)
+    # every crossing adds the end of one piece, a break and the start of the next, then comes the end of the move
+    counts = 3 * crossings + 1
+    move = np.repeat(np.arange(x0.size), counts)
+    position = np.arange(move.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    crossing = position // 3
+    role = position % 3
+    rising = e1[move] >= e0[move]
+    seam = np.where(rising, first[move] + 1 + crossing, first[move] - crossing) * circumference
+    span = e1[move] - e0[move]
+    t = np.divide(seam - e0[move], span, out = np.zeros_like(span), where = span != 0)
+    x = x0[move] + t * (x1[move] - x0[move])
+    # end of a piece is at the far edge it ran into, the next piece starts at the other edge
+    e = np.where((role == 0) == rising, circumference, 0.0)
+    is_end = position == 3 * crossings[move]
+    x = np.where(is_end, x1[move], x)
+    e = np.where(is_end, e1[move] - last[move] * circumference, e)
+    broken = (role == 1) & ~is_end
+    x[broken] = np.nan
+    e[broken] = np.nan
+    start = np.array([[x0[0], e0[0] - first[0] * circumference]])
+    return np.concatenate((start, np.column_stack((x, e))))
+
+
+class ToolpathLOD:
+    """
+        @param surface: PolylineLOD of x against e around the tube
+        @param head: PolylineLOD of head angle against time
+        @param tube: (x start, length, circumference) of the tube
+        @param stages: list of (name, time it starts)
+    """
+    def __init__(self, surface, head, tube, stages):
+        self.surface = surface
+        self.head = head
+        self.tube = tube
+        self.stages = stages
+
+
+"""
+    follows a program and builds the preview of it
+    @param records: records of the program, or (line, record) as GcodeParser gives them
+    @param circumference: e distance of one turn of the tube
+    @param x_start, length: where the tube is, for drawing it
+    @param z_mm_per_deg: to show the head in degrees, as TubeWinder works in them
+"""
+def toolpath_lod(records, circumference, x_start, length, z_mm_per_deg, levels = DEFAULT_LEVELS):
+    simulator = MachineSimulator()
+    moves = []
+    head = [(0.0, 0.0)]
+    stages = []
+    for state in simulator.timeline(records):
+        if state.kind == MOVE and simulator.last_length > 0:
+            x = simulator.position["X"]
+            e = simulator.machine_position("E")
+            moves.append((x - simulator.last_delta["X"], e - simulator.last_delta["E"], x, e))
+            if simulator.last_delta["Z"] != 0:
+                # the head holds still between its own moves, so only those need points
+                z = simulator.machine_position("Z")
+                head.append((state.time - state.duration, (z - simulator.last_delta["Z"]) / z_mm_per_deg))
+                head.append((state.time, z / z_mm_per_deg))
+        elif state.kind == STAGE:
+            stages.append((state.message, state.time))
+        elif state.kind == HOME:
+            head.append((state.time, simulator.machine_position("Z") / z_mm_per_deg))
+    head.append((simulator.time, simulator.machine_position("Z") / z_mm_per_deg))
+    moves = np.array(moves).reshape(-1, 4)
+    surface = unroll(moves[:, 0], moves[:, 1], moves[:, 2], moves[:, 3], circumference)
+    head = np.array(head)
+    # start merging at a tenth of a mm on the tube, and at a tenth of a second and a hundredth of a degree on the head plot
+    return ToolpathLOD(PolylineLOD(surface, (.1, .1), levels), PolylineLOD(head, (.1, .01), levels), (x_start, length, circumference), stages)
+
+
+"""
+    preview of G-code text, ie an IncrementalProgram's
+    @param winder: TubeWinder the program was made with, for the size of the tube
+"""
+def program_lod(text, winder, levels = DEFAULT_LEVELS):
+    from GcodeParser import parse_lines
+
+    return toolpath_lod(parse_lines(text.splitlines()), winder.e_circumference, winder.start_offset, winder.length, winder.z_mm_per_deg, levels)
@@ -0,0 +1,271 @@
+import time
+
+import numpy as np
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLabel
+from PyQt5.QtGui import QPainter, QPen, QColor, QPixmap, QPolygonF
+from PyQt5.QtCore import Qt, QPointF, QRectF, QTimer
+
+"""
+Preview of a generated program, drawn from a ToolpathLOD
+The top plot is the mandrel's surface unrolled (x along the tube, e around it), the bottom one is
+the head angle over the run. Scroll to zoom, drag to pan, double click to see all of it again.
+
+Drawing goes into a pixmap a few chunks at a time off a timer, so a big program never holds the
+window up, and only the level of detail that matches the zoom, and the chunks in view, get drawn.
+
+"""
+
+# time (s) spent drawing before handing back to the event loop
+DRAW_BUDGET = .015
+MARGIN = 40
+ZOOM_STEP = 1.25
+
+
+class PlotView(QWidget):
+    """
+        @param x_label, y_label: axis names
+    """
+    def __init__(self, x_label, y_label, parent = None):
+        super(QWidget, self).__init__(parent)
+        self.x_label = x_label
+        self.y_label = y_label
+        self.lod = None
+        # (x min, y min, x max, y max) of the plot shown
+        self.view = None
+        self.pixmap = None
+        # the pixmap being drawn into, shown as it fills in
+        self.next_pixmap = None
+        self.pending = []
+        self.level = 0
+        self.drag_start = None
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.draw_some)
+        self.setMinimumSize(300, 150)
+
+    """
+        shows a polyline
+        @param lod: PolylineLOD, None to clear the plot
+    """
+    def set_lod(self, lod):
+        self.lod = lod
+        self.fit()
+
+    """
+        zooms out to the whole plot
+    """
+    def fit(self):
+        if self.lod is None:
+            self.view = None
+        else:
+            x_min, y_min, x_max, y_max = self.data_bounds()
+            # a little room around it, and some height for lines that are flat
+            x_pad = (x_max - x_min) * .02 or 1.0
+            y_pad = (y_max - y_min) * .05 or 1.0
+            self.view = (x_min - x_pad, y_min - y_pad, x_max + x_pad, y_max + y_pad)
+        self.redraw()
+
+    def data_bounds(self):
+        return self.lod.bounds
+
+    def plot_rect(self):
+        return QRectF(MARGIN, 10, max(self.width() - MARGIN - 10, 1), max(self.height() - MARGIN - 10, 1))
+
+    """
+        (x, y) plot units per pixel
+    """
+    def scale(self):
+        rect = self.plot_rect()
+        x_min, y_min, x_max, y_max = self.view
+        return (x_max - x_min) / rect.width(), (y_max - y_min) / rect.height()
+
+    """
+        pixel positions of an (n, 2) array of plot points
+    """
+    def to_pixels(self, points):
+        rect = self.plot_rect()
+        x_scale, y_scale = self.scale()
+        pixels = np.empty_like(points)
+        pixels[:, 0] = rect.left() + (points[:, 0] - self.view[0]) / x_scale
+        pixels[:, 1] = rect.bottom() - (points[:, 1] - self.view[1]) / y_scale
+        return pixels
+
+    def to_plot(self, pos):
+        rect = self.plot_rect()
+        x_scale, y_scale = self.scale()
+        return self.view[0] + (pos.x() - rect.left()) * x_scale, self.view[1] + (rect.bottom() - pos.y()) * y_scale
+
+    """
+        starts drawing the plot over
+    """
+    def redraw(self):
+        self.timer.stop()
+        self.pending = []
+        if self.view is None or self.width() <= 0 or self.height() <= 0:
+            self.pixmap = None
+            self.update()
+            return
+        self.next_pixmap = QPixmap(self.size())
+        self.next_pixmap.fill(Qt.white)
+        painter = QPainter(self.next_pixmap)
+        painter.setClipRect(self.plot_rect())
+        self.draw_background(painter)
+        painter.end()
+        x_scale, y_scale = self.scale()
+        self.level = self.lod.level_for(x_scale, y_scale)
+        self.pending = self.lod.visible_chunks(self.level, self.view)
+        self.draw_some()
+
+    """
+        draws chunks until the time budget is used up, then comes back for the rest
+    """
+    def draw_some(self):
+        painter = QPainter(self.next_pixmap)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setClipRect(self.plot_rect())
+        painter.setPen(QPen(QColor(30, 90, 200), 1))
+        start = time.perf_counter()
+        while self.pending and time.perf_counter() - start < DRAW_BUDGET:
+            self.draw_chunk(painter, self.pending.pop(0))
+        painter.end()
+        # show what's there so far, it fills in over the next few frames
+        self.pixmap = self.next_pixmap
+        self.update()
+        if self.pending:
+            self.timer.start(0)
+
+    def draw_chunk(self, painter, points):
+        pixels = self.to_pixels(points)
+        finite = np.isfinite(pixels).all(axis = 1)
+        # a polygon per piece of the line between breaks
+        for piece in np.split(pixels, np.flatnonzero(~finite)):
+            piece = piece[np.isfinite(piece).all(axis = 1)]
+            if len(piece) > 1:
+                painter.drawPolyline(QPolygonF([QPointF(x, y) for x, y in piece.tolist()]))
+
+    """
+        drawn under the toolpath, for the plots to add to
+    """
+    def draw_background(self, painter):
+        pass
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.white)
+        if self.pixmap is not None:
+            painter.drawPixmap(0, 0, self.pixmap)
+        rect = self.plot_rect()
+        painter.setPen(QPen(Qt.black, 1))
+        painter.drawRect(rect)
+        if self.view is not None:
+            x_min, y_min, x_max, y_max = self.view
+            painter.drawText(int(rect.left()), int(rect.bottom()) + 15, str(round(x_min, 1)))
+            painter.drawText(int(rect.right()) - 60, int(rect.bottom()) + 15, 60, 20, Qt.AlignRight, str(round(x_max, 1)))
+            painter.drawText(2, int(rect.bottom()), str(round(y_min, 1)))
+            painter.drawText(2, int(rect.top()) + 10, str(round(y_max, 1)))
+            painter.drawText(int(rect.left()), int(rect.bottom()) + 30, self.x_label + " / " + self.y_label
+                             + "  (detail level " + str(self.level) + ", " + str(self.lod.point_count(self.level)) + " points)")
+
+    def resizeEvent(self, event):
+        self.redraw()
+
+    def wheelEvent(self, event):
+        if self.view is None:
+            return
+        # zoom around the point under the mouse
+        x, y = self.to_plot(event.pos())
+        factor = 1 / ZOOM_STEP if event.angleDelta().y() > 0 else ZOOM_STEP
+        x_min, y_min, x_max, y_max = self.view
+        self.view = (x - (x - x_min) * factor, y - (y - y_min) * factor, x + (x_max - x) * factor, y + (y_max - y) * factor)
+        self.redraw()
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.drag_start = event.pos()
+
+    def mouseMoveEvent(self, event):
+        if self.drag_start is None or self.view is None:
+            return
+        x_scale, y_scale = self.scale()
+        dx = (event.pos().x() - self.drag_start.x()) * x_scale
+        dy = (event.pos().y() - self.drag_start.y()) * y_scale
+        self.drag_start = event.pos()
+        x_min, y_min, x_max, y_max = self.view
+        self.view = (x_min - dx, y_min + dy, x_max - dx, y_max + dy)
+        self.redraw()
+
+    def mouseReleaseEvent(self, event):
+        self.drag_start = None
+
+    def mouseDoubleClickEvent(self, event):
+        self.fit()
+
+
+"""
+    the unrolled mandrel, with the tube drawn under the toolpath
+"""
+class SurfaceView(PlotView):
+    def __init__(self, parent = None):
+        super().__init__("x (mm)", "around the tube (mm)", parent)
+        self.tube = None
+
+    def set_toolpath(self, lod):
+        self.tube = lod.tube
+        self.set_lod(lod.surface)
+
+    def data_bounds(self):
+        x_min, y_min, x_max, y_max = self.lod.bounds
+        x_start, length, circumference = self.tube
+        return min(x_min, x_start), 0.0, max(x_max, x_start + length), circumference
+
+    def draw_background(self, painter):
+        x_start, length, circumference = self.tube
+        corners = self.to_pixels(np.array([[x_start, 0.0], [x_start + length, circumference]]))
+        painter.fillRect(QRectF(QPointF(*corners[0]), QPointF(*corners[1])).normalized(), QColor(235, 235, 235))
+
+
+"""
+    the head angle over the run, with a line where each stage starts
+"""
+class HeadView(PlotView):
+    def __init__(self, parent = None):
+        super().__init__("time (s)", "head (deg)", parent)
+        self.stages = []
+
+    def set_toolpath(self, lod):
+        self.stages = lod.stages
+        self.set_lod(lod.head)
+
+    def draw_background(self, painter):
+        rect = self.plot_rect()
+        painter.setPen(QPen(QColor(200, 200, 200), 1))
+        last_label = None
+        for name, start in self.stages:
+            x = self.to_pixels(np.array([[start, 0.0]]))[0][0]
+            painter.drawLine(QPointF(x, rect.top()), QPointF(x, rect.bottom()))
+            # skip names that would land on top of the one before
+            if last_label is None or x - last_label > 80:
+                painter.drawText(QPointF(x + 2, rect.top() + 12), name)
+                last_label = x
+
+
+class ToolpathPreview(QWidget):
+    def __init__(self, parent = None):
+        super(QWidget, self).__init__(parent)
+        self.surface_view = SurfaceView(self)
+        self.head_view = HeadView(self)
+        self.info_label = QLabel("Preview the program to see its toolpath")
+        vbox = QVBoxLayout()
+        vbox.addWidget(self.surface_view, 3)
+        vbox.addWidget(self.head_view, 1)
+        vbox.addWidget(self.info_label)
+        self.setLayout(vbox)
+
+    """
+        @param lod: ToolpathLOD of the program
+    """
+    def set_toolpath(self, lod):
+        self.surface_view.set_toolpath(lod)
+        self.head_view.set_toolpath(lod)
+        self.info_label.setText(str(lod.surface.point_count(0)) + " points on the tube, "
+                                + str(round(lod.head.bounds[2] / 60, 1)) + " min of machine time")
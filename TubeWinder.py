@@ -1,13 +1,64 @@
 from math import cos, tan, radians
 
+from GcodeSink import GcodeSink, FileSink, NullSink
+import PatternSolver
+import TurnaroundPlanner
+from Toolpath import Move, Command, Stage, write_records
+try:
+    import WrapPlanner
+except ImportError:
+    # numpy isn't installed, wrap falls back to planning pass by pass
+    WrapPlanner = None
+
 """
 Simple engine for winding straight tubes with filaments
 
+Every stage has two forms: iter_<stage> is a generator yielding Move/Command/Stage records
+(see Toolpath) and <stage> writes those records to the sink as G-code. Records are made
+lazily, the winder's location is updated as each one is yielded.
+
+"""
+
+# what get_state/set_state carry between stages. pre_wrap moves the start offset when homing by hand
+STATE_ATTRIBUTES = ("x_loc", "y_loc", "z_loc", "e_loc", "cur_feedrate", "start_offset")
+# the state each stage's G-code depends on and the state it sets, for the stages that don't need all of it.
+# Only what ends up in the G-code counts, ie wrap resets e and moves x to an absolute spot before anything else
+STAGE_STATE = {
+    "iter_units": ((), ("cur_feedrate",)),
+    "iter_tie_down_wrap": (("start_offset",), ("x_loc", "e_loc", "cur_feedrate")),
+    "iter_wrap": (("start_offset",), ("x_loc", "z_loc", "e_loc", "cur_feedrate")),
+    "iter_shrink_tape": (("start_offset",), ("x_loc", "e_loc", "cur_feedrate")),
+    # heat gun only names its feedrate on the move to its start when it isn't already going at it
+    "iter_heat_gun": (("start_offset", "cur_feedrate"), ("x_loc", "e_loc", "cur_feedrate")),
+}
+
+"""
+    the default on_report, shows a value on the console
 """
+def print_value(name, value):
+    print(name + ": " + str(value))
+
 
 class TubeWinder:
-    def __init__(self, file, diameter, length, start_offset, head_offset):
-        self.file = file
+    """
+        @param file: file or GcodeSink to write to. None throws the G-code away, for when only the records are wanted
+        @param write_units: write the units and feedrates straight away. Without it, get them from iter_units
+        @param feedrate_mode: "rpm" drives wrap moves from the e axis rpm (see determine_feedrate), "max" runs wrap and
+            holder check moves as fast as the axis limits allow (see fastest_feedrate)
+        @param rpm_cap: in "max" mode, never spin the e axis faster than this many rpm
+        @param on_report: called with (name, value) for every value the winder works out along the way (units,
+            passes per layer, ...), they're printed when it isn't given
+    """
+    def __init__(self, file, diameter, length, start_offset, head_offset, write_units = True, feedrate_mode = "rpm", rpm_cap = None,
+                 on_report = None):
+        # everything goes through a buffered sink, plain files get wrapped in one
+        # (call flush when done so the buffered output reaches the file)
+        if file is None:
+            self.sink = NullSink()
+        elif isinstance(file, GcodeSink):
+            self.sink = file
+        else:
+            self.sink = FileSink(file)
         self.diameter = diameter
         self.length = length
         self.start_offset = start_offset
@@ -17,17 +68,73 @@ class TubeWinder:
         self.z_loc = 0
         self.e_loc = 0
         self.cur_feedrate = 0
-        # set the feedrates for the machine
-        self.file.write("\n\n; Set the correct units and feedrates\n")
+        if feedrate_mode not in ("rpm", "max"):
+            raise ValueError("Unknown feedrate mode: " + str(feedrate_mode))
+        self.feedrate_mode = feedrate_mode
+        self.rpm_cap = rpm_cap
+        self.on_report = on_report if on_report is not None else print_value
+        # everything the output depends on besides the stages run, see ProgramCache
+        self.settings = {"diameter": diameter, "length": length, "start_offset": start_offset, "head_offset": head_offset,
+                         "feedrate_mode": feedrate_mode, "rpm_cap": rpm_cap}
         self.calculate_step_units_and_feedrates()
+        # set the feedrates for the machine
+        if write_units:
+            self.emit(self.iter_units())
+
+    """
+        writes records to the sink as G-code
+        @param records: iterable of records, ie from one of the iter_ stage generators
+    """
+    def emit(self, records):
+        write_records(records, self.sink)
+
+    """
+        hands a calculated value to on_report
+    """
+    def report(self, name, value):
+        self.on_report(name, value)
+
+    """
+        where the winder is between stages, everything a stage can change
+        @return dictionary for set_state
+    """
+    def get_state(self):
+        return {name: getattr(self, name) for name in STATE_ATTRIBUTES}
+
+    """
+        puts the winder back in a state from get_state, ie to carry on after a stage that wasn't run
+        @param state: all or part of a state, attributes left out are kept as they are
+    """
+    def set_state(self, state):
+        for name in STATE_ATTRIBUTES:
+            if name in state:
+                setattr(self, name, state[name])
+
+    """
+        the part of the current state a stage's G-code depends on
+        @param method: name of the stage's generator, ie "iter_wrap"
+    """
+    def stage_inputs(self, method):
+        names = STAGE_STATE[method][0] if method in STAGE_STATE else STATE_ATTRIBUTES
+        return {name: getattr(self, name) for name in names}
+
+    """
+        the part of the current state a stage sets, call after running it
+    """
+    def stage_outputs(self, method):
+        names = STAGE_STATE[method][1] if method in STAGE_STATE else STATE_ATTRIBUTES
+        return {name: getattr(self, name) for name in names}
 
     """
         reset the relative axis (e axis for now) in case of special circumstances.
     """
     def reset_relative_axis(self):
+        self.emit((self.reset_e(),))
+
+    def reset_e(self):
         # use this just for safety measures...
-        self.file.write("G92 E0\n");
         self.e_loc = 0
+        return Command("G92 E0")
 
     """
         calculates appropriate step units and feedrates for each axis
@@ -39,16 +146,12 @@ class TubeWinder:
         # default x steps per mm is 142.782152231 steps/mm
         self.x_steps_per_mm = 142.782152231 / 16.0 * 4 
         self.max_x_feedrate = 22500 # this was found through experimentation
-        self.file.write("M92 X" + str(round(self.x_steps_per_mm,4)) + "\n")
-        self.file.write("M203 X" + str(int(self.max_x_feedrate/60)) + "\n")
-        self.file.write("M201 X900\n")
+        self.max_x_accel = 900
         # then y steps
         # default y steps per mm is 203.937007874
         self.y_steps_per_mm = 203.937007874
         self.max_y_feedrate = 3000 # this was found through experimentation
-        self.file.write("M92 Y" + str(round(self.y_steps_per_mm,4)) + "\n")
-        self.file.write("M203 Y" + str(int(self.max_y_feedrate/60)) + "\n")
-        print("Max Y feedrate: " + str(round(self.max_y_feedrate,4)))
+        self.report("Max Y feedrate", round(self.max_y_feedrate,4))
         # then do the z axis (ratary head)
         # because the head size *should* never change, treat like the x and y axis
         # meaning that we don't need to go from a max deg/s to a max mm/m calculation
@@ -61,11 +164,12 @@ class TubeWinder:
         # gear ratio is a 40 tooth .2" pitch
         self.z_circumference = 40 * .2 * 25.4
         self.z_steps_per_mm = z_steps_per_rotation / self.z_circumference
-        #self.file.write("M92 E" + str(self.z_steps_per_mm) + "\n")
+        #self.sink.write("M92 E" + str(self.z_steps_per_mm) + "\n")
         self.max_z_feedrate = 9000 # this was found through experimentation
-        #self.file.write("M203 Z" + str(self.max_z_feedrate/60) + "\n")
-        print("Z steps per mm: " + str(round(self.z_steps_per_mm,2)))
-        print("Z steps per deg: " +str(round(self.z_steps_per_deg,2)))
+        self.max_z_accel = 900
+        #self.sink.write("M203 Z" + str(self.max_z_feedrate/60) + "\n")
+        self.report("Z steps per mm", round(self.z_steps_per_mm,2))
+        self.report("Z steps per deg", round(self.z_steps_per_deg,2))
         self.z_mm_per_deg = self.z_circumference / 360
 
         # and now the e axis
@@ -75,21 +179,32 @@ class TubeWinder:
         self.e_steps_per_rotation = 60.444444444 * 360 / 16.0 * 4
         self.e_circumference = self.diameter * 3.14159
         self.e_steps_per_mm = self.e_steps_per_rotation / self.e_circumference
-        # write this to the controller
-        self.file.write("M92 E" + str(round(self.e_steps_per_mm,4)) + "\n")
-        print("E Steps per mm: " + str(round(self.e_steps_per_mm,4)))
+        self.report("E Steps per mm", round(self.e_steps_per_mm,4))
         # go and set an appropriate max feedrate in rpm in equiv mm/s
         default_max_rpm = 60
         self.max_e_feedrate = (default_max_rpm * self.diameter * 3.14159)
+        self.report("Max e feedrate", int(self.max_e_feedrate))
+        self.report("Max e feedrate/s", round(self.max_e_feedrate/60))
+        self.e_mm_per_deg = self.e_circumference/360
+        self.report("E MM per Deg", self.e_mm_per_deg)
+
+    """
+        tells the controller the units and feedrates found in calculate_step_units_and_feedrates
+    """
+    def iter_units(self):
+        yield Stage("Set the correct units and feedrates")
+        yield Command("M92 X" + str(round(self.x_steps_per_mm,4)))
+        yield Command("M203 X" + str(int(self.max_x_feedrate/60)))
+        yield Command("M201 X" + str(self.max_x_accel))
+        yield Command("M92 Y" + str(round(self.y_steps_per_mm,4)))
+        yield Command("M203 Y" + str(int(self.max_y_feedrate/60)))
+        # z units are written after homing, see home_axis
+        yield Command("M92 E" + str(round(self.e_steps_per_mm,4)))
         # convert to mm/s and tell the device
-        self.file.write("M203 E" + str(int(self.max_e_feedrate/60)) + "\n")
-        self.file.write("M201 E01500\n")
-        print("Max e feedrate: " + str(int(self.max_e_feedrate)))
-        print("Max e feedrate/s: " + str(round(self.max_e_feedrate/60)))
+        yield Command("M203 E" + str(int(self.max_e_feedrate/60)))
+        yield Command("M201 E01500")
         # go and limit the feedrate of everything based on the e axis
-        self.write_move(feedrate = self.max_e_feedrate * .75)
-        self.e_mm_per_deg = self.e_circumference/360
-        print("E MM per Deg: " + str(self.e_mm_per_deg))
+        yield self.move(feedrate = self.max_e_feedrate * .75)
 
 
 
@@ -99,23 +214,25 @@ class TubeWinder:
         @param passes: number of passes (back and forth) to perform
         @param feedrate: speed at which to perform motion
     """
-    def heat_gun(self, e_to_length_ratio, passes, feedrate):
+    def iter_heat_gun(self, e_to_length_ratio, passes, feedrate):
         # reset axis for safety
-        self.reset_relative_axis()
+        yield self.reset_e()
         # write a quick comment in the gcode
-        self.file.write("\n\n; Heat Gun\n")
+        yield Stage("Heat Gun")
         # calculate against the ratio
         e_per_move = self.e_mm_per_deg * 360 * e_to_length_ratio
         # move to the start
-        self.file.write("M0 Move to starting position\n")
-        self.write_move(x = self.start_offset)
+        yield Command("M0 Move to starting position")
+        # at the stage's own feedrate, not whatever the last stage ended on (the wrap's, with the shrink tape skipped).
+        # Left off when that's the feedrate already, as in test.gcode
+        yield self.move(x = self.start_offset, feedrate = None if self.cur_feedrate == feedrate else feedrate)
         # tell the user what to do
-        self.file.write("M0 Attatch Heat Gun\n")
+        yield Command("M0 Attatch Heat Gun")
         # preform the passes
         for i in range(passes):
-            self.file.write("M117 Pass " + str(i+1) + " of " + str(passes) + "\n")
-            self.write_move_rel(x = self.length, e = e_per_move, feedrate = feedrate)
-            self.write_move_rel(x = -1*self.length, e = e_per_move, feedrate = feedrate)
+            yield Command("M117 Pass " + str(i+1) + " of " + str(passes))
+            yield self.move_rel(x = self.length, e = e_per_move, feedrate = feedrate)
+            yield self.move_rel(x = -1*self.length, e = e_per_move, feedrate = feedrate)
 
 
     """
@@ -124,16 +241,16 @@ class TubeWinder:
         @param start_wrap_rotations: number of rotations to perform to keep the filament down
         @param feedrate: speed at which to perform this action
     """
-    def tie_down_wrap(self, extension_dist, start_wrap_rotations, feedrate):
+    def iter_tie_down_wrap(self, extension_dist, start_wrap_rotations, feedrate):
         # write a comment in the gcode
-        self.file.write("\n\n; Wrap\n")
+        yield Stage("Wrap")
         # tell the user what's going on
-        self.file.write("M0 Moving to behind the holder\n")
-        self.write_move(x = self.start_offset - extension_dist, feedrate = feedrate)
+        yield Command("M0 Moving to behind the holder")
+        yield self.move(x = self.start_offset - extension_dist, feedrate = feedrate)
         # tell the user to tie down the filament
-        self.file.write("M0 Tie Down Filament\n")
+        yield Command("M0 Tie Down Filament")
         #now rotate to hold down the filament
-        self.write_move(e = 360*start_wrap_rotations*self.e_mm_per_deg, feedrate = feedrate)
+        yield self.move(e = 360*start_wrap_rotations*self.e_mm_per_deg, feedrate = feedrate)
 
     """
         perform a wrap of the tube
@@ -145,22 +262,33 @@ class TubeWinder:
         @param feedrate: speed at which to perform winding
         @param extension_dist: distance to extend behind the holder when starting and finishing a pass. This helps ensure the filament catches
             on the holders
+        @param pattern: None works the passes and index angle out with wrap_pattern, "solve" uses the pattern from
+            PatternSolver with the fewest passes that covers the tube, or give a WindPattern to use
+        @param vectorized: lay out all the passes at once with WrapPlanner (the default when numpy is available)
+            instead of one at a time. Both give the same moves, to the .001 they're written to
     """
-    def wrap(self, filament_width, filament_overlap_multiplier = 1, wind_angle = 45, layers = 1, wanted_rpm = 20, extension_dist = 40):
+    def iter_wrap(self, filament_width, filament_overlap_multiplier = 1, wind_angle = 45, layers = 1, wanted_rpm = 20, extension_dist = 40, pattern = None,
+                  turnaround = "dwell", vectorized = None):
         # start the wrapping cycle
-        self.file.write("\n\n; Wrap\n")
+        yield Stage("Wrap")
         # some calculations are necessary
         # write now we only support a 45 deg wrap
-        self.reset_relative_axis()
-        print("Filament Overlap Multiplier: " + str(filament_overlap_multiplier))
-        print("Filament Width: " + str(filament_width))
-        a = tan(radians(90-wind_angle)) * filament_width/filament_overlap_multiplier
-        effective_filament_width = round(pow(pow(filament_width/filament_overlap_multiplier,2) + pow(a,2),.5),2)
-        print("Width: " + str(effective_filament_width))
-        wraps_per_layer = int(self.e_circumference / effective_filament_width + 1.5)
-        print("Wraps per Layer: " + str(wraps_per_layer))
-        extraTurnDeg = round(360.0/wraps_per_layer,2)*1.05
-        print("Extra turn:" + str(extraTurnDeg))
+        yield self.reset_e()
+        blended = None
+        if turnaround == "blend":
+            blended = TurnaroundPlanner.plan_blended_wrap(self, wind_angle, wanted_rpm, extension_dist)
+        elif turnaround != "dwell":
+            raise ValueError("Unknown turnaround " + str(turnaround) + ", use dwell or blend")
+        if pattern is None:
+            wraps_per_layer, extraTurnDeg = self.wrap_pattern(filament_width, filament_overlap_multiplier, wind_angle)
+        else:
+            if pattern == "solve":
+                pattern = PatternSolver.solve_wrap(self, filament_width, filament_overlap_multiplier, wind_angle, extension_dist,
+                                                   None if blended is None else blended.turned_deg)
+            self.report("Wind Pattern", pattern)
+            wraps_per_layer, extraTurnDeg = pattern.passes, pattern.index_deg
+        # a solved pattern's index angle is exact, so take the shortest way around to it
+        shortest_reindex = pattern is not None
         # now start the wrap
         # for now, just go over and back
         # have a 'lead in' in which the head turns to follow the path
@@ -170,28 +298,39 @@ class TubeWinder:
         e_per_x = tan(radians(wind_angle))
         previous_start_wrap = self.e_loc
         # make sure we're at the start_offset - extension dist
-        self.write_move(x = self.start_offset - extension_dist)
+        yield self.move(x = self.start_offset - extension_dist)
         winding_length = wraps_per_layer * 2 * (pow(pow(self.length,2) + pow(self.e_circumference,2),.5) + self.e_circumference)/25.4/12
-        print("Estimated Winding Length: " + str(winding_length))
+        self.report("Estimated Winding Length", winding_length)
+        if blended is not None:
+            yield from self.iter_blended_passes(blended, wraps_per_layer, extraTurnDeg)
+            return
+        if vectorized is None:
+            vectorized = WrapPlanner is not None
+        if vectorized:
+            plan = WrapPlanner.plan_wrap(self, wraps_per_layer, extraTurnDeg, wind_angle, wanted_rpm, extension_dist, shortest_reindex)
+            if plan.settled_from is not None:
+                self.report("Settled from pass", plan.settled_from + 1)
+            yield from self.iter_planned_passes(plan)
+            return
         for i in range(0,wraps_per_layer):
-            self.file.write("M117 Pass " + str(i + 1) + " of " + str(wraps_per_layer) + "\n")
+            yield Command("M117 Pass " + str(i + 1) + " of " + str(wraps_per_layer))
             previous_start_wrap = self.e_loc
             #self.write_move_rel(x = lead_in_dist, e = lead_in_dist * e_per_x, z = -1*(90-wind_angle), feedrate = self.determine_feedrate(x = lead_in_dist, e = lead_in_dist * e_per_x, z = -1*(90-wind_angle), rpm = wanted_rpm))
             #self.write_move_rel(x = linear_move_dist + lead_in_dist, e = (linear_move_dist + lead_in_dist)*e_per_x, feedrate = self.determine_feedrate(x = linear_move_dist + lead_in_dist, e = (linear_move_dist + lead_in_dist)*e_per_x,rpm=wanted_rpm))
-            self.write_move_rel(x = self.length + 2*extension_dist, e = (self.length + 2*extension_dist)*e_per_x, feedrate = self.determine_feedrate(x = self.length + 2*extension_dist, e = (self.length + 2*extension_dist)*e_per_x,rpm=wanted_rpm))
+            yield self.move_rel(x = self.length + 2*extension_dist, e = (self.length + 2*extension_dist)*e_per_x, feedrate = self.plan_feedrate(x = self.length + 2*extension_dist, e = (self.length + 2*extension_dist)*e_per_x,rpm=wanted_rpm))
             # roatate ~ 360 degrees before moving back
             # but we need to rotate over 60 degrees to make sure the filament makes it
             #self.write_move_rel(e = 45*self.e_mm_per_deg,feedrate = self.determine_feedrate(e = 45*self.e_mm_per_deg,rpm = wanted_rpm))
             # then move the head over to 0 deg
             #self.write_move(e = self.e_loc + 60*self.e_mm_per_deg, z = 0,feedrate = self.determine_feedrate(e=60*self.e_mm_per_deg,z = self.z_loc,rpm = wanted_rpm))
-            self.write_move_rel(e = (360) * self.e_mm_per_deg, feedrate = self.determine_feedrate(e = (360) * self.e_mm_per_deg, rpm = wanted_rpm))
+            yield self.move_rel(e = (360) * self.e_mm_per_deg, feedrate = self.plan_feedrate(e = (360) * self.e_mm_per_deg, rpm = wanted_rpm))
             # then start moving back
             #self.write_move_rel(x = -lead_in_dist, e = lead_in_dist*e_per_x, z = 90-wind_angle, feedrate = self.determine_feedrate(x = -lead_in_dist, e = lead_in_dist*e_per_x, z = 90-wind_angle,rpm = wanted_rpm))
             #self.write_move_rel(x = -1 * (linear_move_dist + lead_in_dist), e = (linear_move_dist + lead_in_dist)*e_per_x, feedrate = self.determine_feedrate(x = -1 * (linear_move_dist + lead_in_dist), e = (linear_move_dist + lead_in_dist)*e_per_x,rpm = wanted_rpm))
-            self.write_move_rel(x = -1*(self.length + 2*extension_dist), e = (self.length + 2*extension_dist)*e_per_x,feedrate=self.determine_feedrate(x = self.length + 2*extension_dist, e = (self.length + 2*extension_dist)*e_per_x,rpm=wanted_rpm))
+            yield self.move_rel(x = -1*(self.length + 2*extension_dist), e = (self.length + 2*extension_dist)*e_per_x,feedrate=self.plan_feedrate(x = self.length + 2*extension_dist, e = (self.length + 2*extension_dist)*e_per_x,rpm=wanted_rpm))
             # roatate ~ 360 degrees before moving back
             # but we need to rotate over 60 degrees to make sure the filament makes it
-            self.write_move_rel(e = 60*self.e_mm_per_deg, feedrate = self.determine_feedrate(e = 45*self.e_mm_per_deg,rpm = wanted_rpm))
+            yield self.move_rel(e = 60*self.e_mm_per_deg, feedrate = self.plan_feedrate(e = 60*self.e_mm_per_deg,rpm = wanted_rpm))
             # then move the head over to 0 deg
             #self.write_move(e = self.e_loc + 60*self.e_mm_per_deg, z = 0, feedrate = self.determine_feedrate(e = 60*self.e_mm_per_deg, z = self.z_loc,rpm = wanted_rpm))
             # now rotate to the closest previous_start_wrap + extraTurnDeg
@@ -203,7 +342,122 @@ class TubeWinder:
                 required_e_delta_deg = required_e_delta_deg + 360
             if(required_e_delta_deg > 360):
                 required_e_delta_deg = required_e_delta_deg - 360
-            self.write_move_rel(e = (required_e_delta_deg + extraTurnDeg) * self.e_mm_per_deg, feedrate = self.determine_feedrate(e = (required_e_delta_deg + extraTurnDeg) * self.e_mm_per_deg, rpm = wanted_rpm))
+            reindex_deg = required_e_delta_deg + extraTurnDeg
+            if shortest_reindex:
+                reindex_deg = reindex_deg % 360
+            yield self.move_rel(e = reindex_deg * self.e_mm_per_deg, feedrate = self.plan_feedrate(e = reindex_deg * self.e_mm_per_deg, rpm = wanted_rpm))
+
+
+    """
+        works out how many passes a layer takes and how far to index around between them
+        @return (wraps_per_layer, extra turn in deg)
+    """
+    def wrap_pattern(self, filament_width, filament_overlap_multiplier, wind_angle):
+        self.report("Filament Overlap Multiplier", filament_overlap_multiplier)
+        self.report("Filament Width", filament_width)
+        a = tan(radians(90-wind_angle)) * filament_width/filament_overlap_multiplier
+        effective_filament_width = round(pow(pow(filament_width/filament_overlap_multiplier,2) + pow(a,2),.5),2)
+        self.report("Width", effective_filament_width)
+        wraps_per_layer = int(self.e_circumference / effective_filament_width + 1.5)
+        self.report("Wraps per Layer", wraps_per_layer)
+        extraTurnDeg = round(360.0/wraps_per_layer,2)*1.05
+        self.report("Extra turn", extraTurnDeg)
+        return wraps_per_layer, extraTurnDeg
+
+    """
+        yields the moves of a WrapPlan, pass by pass
+    """
+    def iter_planned_passes(self, plan):
+        # plain floats format faster than numpy scalars
+        x_out = plan.x_out.tolist()
+        x_back = plan.x_back.tolist()
+        e = plan.e.tolist()
+        traverse_feedrate = plan.traverse_feedrate
+        rotate_feedrate = plan.rotate_feedrate
+        for i in range(plan.passes):
+            e_pass = e[i]
+            yield Command("M117 Pass " + str(i + 1) + " of " + str(plan.passes))
+            yield self.move(x = x_out[i], e = e_pass[0], feedrate = traverse_feedrate)
+            yield self.move(e = e_pass[1], feedrate = rotate_feedrate)
+            yield self.move(x = x_back[i], e = e_pass[2], feedrate = traverse_feedrate)
+            yield self.move(e = e_pass[3], feedrate = rotate_feedrate)
+            yield self.move(e = e_pass[4], feedrate = rotate_feedrate)
+
+
+    """
+        yields the passes of a wrap with blended turnarounds (see TurnaroundPlanner)
+        every pass starts and ends with x stopped at the near end, where the tube turns on to the next start angle
+        @param plan: BlendedWrap
+        @param index_deg: angle between the starts of one pass and the next
+    """
+    def iter_blended_passes(self, plan, passes, index_deg):
+        turnaround = plan.turnaround
+        half = turnaround.segments // 2
+        # the same for every pass, only where they start changes
+        speed_up = turnaround.moves(-1, half)
+        far_end = turnaround.moves(1)
+        slow_down = turnaround.moves(-1, 0, half)
+        straight_e = plan.straight * plan.e_per_x
+        dwell = plan.dwell_deg(index_deg) * self.e_mm_per_deg
+        self.report("Turnaround", str(round(turnaround.duration, 3)) + "s, " + str(round(turnaround.distance, 2)) + "mm")
+        self.report("Dwell per pass", round(dwell / self.e_mm_per_deg, 2))
+        for i in range(0,passes):
+            yield Command("M117 Pass " + str(i + 1) + " of " + str(passes))
+            # from the near end's apex, x stopped and the head straight, out and back to it
+            yield from self.iter_turnaround(speed_up)
+            yield self.move_rel(x = plan.straight, e = straight_e, feedrate = plan.feedrate)
+            yield from self.iter_turnaround(far_end)
+            yield self.move_rel(x = -plan.straight, e = straight_e, feedrate = plan.feedrate)
+            yield from self.iter_turnaround(slow_down)
+            if i < passes - 1 and dwell > 0:
+                # the tube keeps turning at the speed it came in at, x is stopped anyway
+                yield self.move_rel(e = dwell, feedrate = turnaround.e_speed * 60)
+
+    """
+        yields a stretch of a turnaround from where the winder is, see Turnaround.moves
+    """
+    def iter_turnaround(self, moves):
+        x_from = self.x_loc
+        e_from = self.e_loc
+        for x, z, e, feedrate in moves:
+            yield self.move(x = x_from + x, z = z, e = e_from + e, feedrate = feedrate)
+
+
+    """
+        picks the feedrate for a wrap move depending on the feedrate mode
+        "rpm" keeps the e axis at rpm, "max" goes as fast as the axis limits (and rpm_cap) allow
+        @param z: delta z in deg
+    """
+    def plan_feedrate(self, x = None, y = None, z = None, e = None, rpm = None):
+        if self.feedrate_mode == "max":
+            return self.fastest_feedrate(x, y, z, e, self.rpm_cap)
+        return self.determine_feedrate(x, y, z, e, rpm)
+
+    """
+        highest feedrate at which no axis goes over its max feedrate
+        the feedrate is along the path through every axis, e included, just like in determine_feedrate
+        @param x, y, e: deltas in mm
+        @param z: delta in deg
+        @param rpm: optionally cap the e axis at this many rpm
+    """
+    def fastest_feedrate(self, x = None, y = None, z = None, e = None, rpm = None):
+        # the controller is told the limits in whole mm/s, stay under what it was told
+        limits = [(x, int(self.max_x_feedrate/60)*60), (y, int(self.max_y_feedrate/60)*60), (e, int(self.max_e_feedrate/60)*60),
+                  (None if z is None else z*self.z_mm_per_deg, self.max_z_feedrate)]
+        if rpm is not None and e is not None:
+            limits.append((e, rpm * self.e_mm_per_deg * 360))
+        length = pow(sum(pow(delta,2) for delta, limit in limits[:4] if delta is not None),.5)
+        if length == 0:
+            # not going anywhere, anything will do
+            return min(limit for delta, limit in limits)
+        feedrate = None
+        for delta, limit in limits:
+            if delta is None or delta == 0:
+                continue
+            # this axis covers abs(delta)/length of the path, so the path can go length/abs(delta) times its limit
+            axis_feedrate = limit * length / abs(delta)
+            feedrate = axis_feedrate if feedrate is None else min(feedrate, axis_feedrate)
+        return feedrate
 
 
     def determine_feedrate(self, x = None, y = None, z = None, e = None, rpm = None):
@@ -257,20 +511,21 @@ class TubeWinder:
         @param feedrate: speed at which to perform the process
     """
 
-    def shrink_tape(self, shrink_tape_width, overlap_multiplier, feedrate):
+    def iter_shrink_tape(self, shrink_tape_width, overlap_multiplier, feedrate):
         # write a comment in the gcode
-        self.file.write("\n\n; Shrink Tape\n")
+        yield Stage("Shrink Tape")
         # make sure the head's back at the offset
-        self.reset_relative_axis()
-        self.file.write("M0 Please Remove Filament\n")
-        self.write_move(x = self.start_offset + shrink_tape_width)
+        yield self.reset_e()
+        yield Command("M0 Please Remove Filament")
+        # a feedrate of its own, so it doesn't carry on at the wrap's last one
+        yield self.move(x = self.start_offset + shrink_tape_width, feedrate = feedrate)
         # attatch shrink tape
-        self.file.write("M0 Please Attatch Shrink Tape\n")
+        yield Command("M0 Please Attatch Shrink Tape")
         # wind 360 degrees
-        self.write_move(e = self.e_loc + 360 * self.e_mm_per_deg, feedrate = feedrate)
+        yield self.move(e = self.e_loc + 360 * self.e_mm_per_deg, feedrate = feedrate)
         # do a slow progression
         e_rotation = (self.length - 2*shrink_tape_width) / (shrink_tape_width * overlap_multiplier) * 360
-        self.write_move_rel(x = self.length - shrink_tape_width, e = e_rotation * self.e_mm_per_deg, feedrate = feedrate)
+        yield self.move_rel(x = self.length - shrink_tape_width, e = e_rotation * self.e_mm_per_deg, feedrate = feedrate)
 
     """
         handles all necessary pre wrapping steps
@@ -282,48 +537,59 @@ class TubeWinder:
         @param feedrate: feedrate at which to move while performing rotational moves
     """
 
-    def pre_wrap(self, home_before_winding = True, manual_home = False, check_holder_locations = True, feedrate = 2000):
+    def iter_pre_wrap(self, home_before_winding = True, manual_home = False, check_holder_locations = True, feedrate = 2000):
         # pre wrap
-        self.file.write("\n\n; Pre Wrap\n")
+        yield Stage("Pre Wrap")
 
         #go home if required
         if(home_before_winding == True):
-            self.home_axis()
+            yield from self.iter_home_axis()
         #do a manual home if required
         if(manual_home == True):
             if(home_before_winding == False):
-                self.home_axis()
-            self.file.write("M18\n")
-            self.file.write("M0 Manual Home X")
-            self.file.write("M17\n")
+                yield from self.iter_home_axis()
+            yield Command("M18")
+            yield Command("M0 Manual Home X")
+            yield Command("M17")
             # void the start offset!
-            self.file.write("G92 X0\n")
+            yield Command("G92 X0")
             # tell the user about to perform automatic on Y and Z
-            self.file.write("M0 Homing Y Z\n")
-            self.file.write("G28 Y Z\n")
+            yield Command("M0 Homing Y Z")
+            yield Command("G28 Y Z")
             self.start_offset = 0
             # go and home the y and z axis
         # move the head out to the start, let the user tape down the start, then wrap a certain amount, go from there
-        self.reset_relative_axis()
-        self.write_move(x = self.start_offset, feedrate = feedrate)
+        yield self.reset_e()
+        yield self.move(x = self.start_offset, feedrate = feedrate)
         #move the head out
-        self.file.write("M0 Moving Head Out\n")
-        self.write_move(y = 4.5*25.4-self.diameter/2 - self.head_offset, feedrate = feedrate)
+        yield Command("M0 Moving Head Out")
+        yield self.move(y = 4.5*25.4-self.diameter/2 - self.head_offset, feedrate = feedrate)
 
         if check_holder_locations == True:
             #do a test wrap to make sure the part and the fingers are in the right
             # test the wrap
-            #self.file.write("\n\n; Perform a test wrap\n")
+            #self.sink.write("\n\n; Perform a test wrap\n")
             # tell the user we are about to perform a test wrap
-            self.file.write("M0 Checking Holder Locations\n")
-            self.write_move(feedrate = feedrate)
-            self.write_move(x = self.start_offset)
-            #move the head out
-            self.write_move(y = 4.5*25.4-self.diameter/2 - self.head_offset)
-            self.file.write("M0 This Should Be Centered On Holder\n")
-            self.write_move(x = (self.start_offset + self.length))
-            self.file.write("M0 This Should Be Centered On Holder\n")
-            self.write_move(x = self.start_offset)
+            yield Command("M0 Checking Holder Locations")
+            if self.feedrate_mode == "max":
+                # nothing is being wound yet, go as fast as the machine can
+                yield self.move(x = self.start_offset, feedrate = self.fastest_feedrate(x = self.start_offset - self.x_loc))
+                y = 4.5*25.4-self.diameter/2 - self.head_offset
+                yield self.move(y = y, feedrate = self.fastest_feedrate(y = y - self.y_loc))
+                yield Command("M0 This Should Be Centered On Holder")
+                yield self.move(x = (self.start_offset + self.length), feedrate = self.fastest_feedrate(x = self.length))
+                yield Command("M0 This Should Be Centered On Holder")
+                yield self.move(x = self.start_offset, feedrate = self.fastest_feedrate(x = self.length))
+                yield self.move(feedrate = feedrate)
+            else:
+                yield self.move(feedrate = feedrate)
+                yield self.move(x = self.start_offset)
+                #move the head out
+                yield self.move(y = 4.5*25.4-self.diameter/2 - self.head_offset)
+                yield Command("M0 This Should Be Centered On Holder")
+                yield self.move(x = (self.start_offset + self.length))
+                yield Command("M0 This Should Be Centered On Holder")
+                yield self.move(x = self.start_offset)
         #done
 
 
@@ -332,88 +598,127 @@ class TubeWinder:
         Homes the Y axis first (to prevent crashes), then the other axis
         Handles reseting and setting axis units in special cases
     """
-    def home_axis(self):
-        self.file.write("\n\n; Home the machine\n")
+    def iter_home_axis(self):
+        yield Stage("Home the machine")
         # home the y axis first to prevent collisions
-        self.file.write("G28 Y\n")
+        yield Command("G28 Y")
         # home the other axis
          # important: I've overriden the steps/mm on the Z axis (rotatry head) but the firmware
         # the machine is running expects to set the 0 location using a steps/deg.
         # solution: only write the updated z calculations after homing the z axis!
         # to catch any weird running programs after a run, go ahead and set the standard values
-        self.file.write("M92 Z115.111111 (make sure the z axis will home correctly)\n")
-        self.file.write("M203 Z2000 (make sure the z axis won't move too fast)\n")
-        self.file.write("G28 X Z\n")
+        yield Command("M92 Z115.111111 (make sure the z axis will home correctly)")
+        yield Command("M203 Z2000 (make sure the z axis won't move too fast)")
+        yield Command("G28 X Z")
         # the Z axis is roughly 132 degrees from horizontal, move it there and re zero
         # get the z axis back to its 'Zero' pos
-        self.write_move(z = 0)
+        yield self.move(z = 0)
         # now go and write the new units to the z axis
-        self.file.write("M92 Z" + str(self.z_steps_per_mm) + " (now write the correct units)" + "\n")
-        self.file.write("M203 Z" + str(self.max_z_feedrate/60) + " (set the correct max feedrate)" + "\n")
-        self.file.write("M201 Z900\n")
+        yield Command("M92 Z" + str(self.z_steps_per_mm) + " (now write the correct units)")
+        yield Command("M203 Z" + str(self.max_z_feedrate/60) + " (set the correct max feedrate)")
+        yield Command("M201 Z" + str(self.max_z_accel))
         # reset the e axis to 0
-        self.file.write("G92 E0\n");
+        yield Command("G92 E0")
 
     """
-        writes a move (G1) command to the file
+        the stages, written straight to the sink. See the iter_ generators for the parameters
+    """
+    def heat_gun(self, e_to_length_ratio, passes, feedrate):
+        self.emit(self.iter_heat_gun(e_to_length_ratio, passes, feedrate))
+
+    def tie_down_wrap(self, extension_dist, start_wrap_rotations, feedrate):
+        self.emit(self.iter_tie_down_wrap(extension_dist, start_wrap_rotations, feedrate))
+
+    def wrap(self, filament_width, filament_overlap_multiplier = 1, wind_angle = 45, layers = 1, wanted_rpm = 20, extension_dist = 40, pattern = None,
+             turnaround = "dwell", vectorized = None):
+        self.emit(self.iter_wrap(filament_width, filament_overlap_multiplier, wind_angle, layers, wanted_rpm, extension_dist, pattern, turnaround,
+                                 vectorized))
+
+    def shrink_tape(self, shrink_tape_width, overlap_multiplier, feedrate):
+        self.emit(self.iter_shrink_tape(shrink_tape_width, overlap_multiplier, feedrate))
+
+    def pre_wrap(self, home_before_winding = True, manual_home = False, check_holder_locations = True, feedrate = 2000):
+        self.emit(self.iter_pre_wrap(home_before_winding, manual_home, check_holder_locations, feedrate))
+
+    def home_axis(self):
+        self.emit(self.iter_home_axis())
+
+
+    """
+        makes a move (G1) record and updates the location of the winder
         @param x: x position in mm
         @param y: y position in mm
-        @param z: z position in mm
+        @param z: z position in deg
         @param e: e position in mm
         @param feedrate: speed at which to move
     """
-    def write_move(self, x = None, y = None, z = None, e = None, e_deg = None, feedrate = None):
-        # doing G1's for now, combine everything
-        line = "G1 "
+    def move(self, x = None, y = None, z = None, e = None, feedrate = None):
         if(x is not None):
-            line += "X" + str(round(x,3)) + " "
             self.x_loc = x
         if(y is not None):
-            line += "Y" + str(round(y,3)) + " "
             self.y_loc = y
         if(z is not None):
-            # z axis is still treated in deg, convert to mm before sending over
-            line += "Z" + str(round(z*self.z_mm_per_deg,3)) + " "
             self.z_loc = z
+            # z axis is still treated in deg, convert to mm before sending over
+            z = z*self.z_mm_per_deg
         if(e is not None):
-            line += "E" + str(round(e,3))+ " "
             self.e_loc = e
-        #print("Feed: " + str(feedrate))
         if(feedrate is not None):
-            line += "F" + str(int(feedrate))
             self.cur_feedrate = feedrate
-        line += "\n"
-        # write it to the file
-        self.file.write(line)
-        #print(line)
-
+        return Move(x, y, z, e, feedrate)
 
     """
-        writes a relative move (G1) command to the file. Uses the last recorded absolute position in this class to handle relative moves.
+        makes a relative move (G1) record. Uses the last recorded absolute position in this class to handle relative moves.
         @param x: delta x position in mm
         @param y: delta y position in mm
-        @param z: delta z position in mm
+        @param z: delta z position in deg
         @param e: delta e position in mm
         @param feedrate: speed at which to move
     """
-    def write_move_rel(self, x = None, y = None, z = None, e = None, feedrate = None):
-        # initialize temp variables
-        #print("f: " + str(feedrate))
-        act_x = None
-        act_y = None
-        act_z = None
-        act_e = None
+    def move_rel(self, x = None, y = None, z = None, e = None, feedrate = None):
         # reassign those if necessary
         if(x is not None):
-            act_x = self.x_loc + x
+            x = self.x_loc + x
         if(y is not None):
-            act_y = self.y_loc + y
+            y = self.y_loc + y
         if(z is not None):
-            act_z = self.z_loc + z
+            z = self.z_loc + z
         if(e is not None):
-            act_e = self.e_loc + e
-        # execute an absolute move with the new absolute coordinates
-        self.write_move(act_x, act_y, act_z, act_e, feedrate= feedrate)
+            e = self.e_loc + e
+        # make an absolute move with the new absolute coordinates
+        return self.move(x, y, z, e, feedrate)
+
+
+    """
+        writes a move (G1) command to the file
+        @param x: x position in mm
+        @param y: y position in mm
+        @param z: z position in mm
+        @param e: e position in mm
+        @param feedrate: speed at which to move
+    """
+    def write_move(self, x = None, y = None, z = None, e = None, e_deg = None, feedrate = None):
+        # write it to the sink
+        self.sink.write(self.move(x, y, z, e, feedrate).gcode())
+
+
+    """
+        pushes everything written so far out to the underlying file
+    """
+    def flush(self):
+        self.sink.flush()
+
+
+    """
+        writes a relative move (G1) command to the file. Uses the last recorded absolute position in this class to handle relative moves.
+        @param x: delta x position in mm
+        @param y: delta y position in mm
+        @param z: delta z position in mm
+        @param e: delta e position in mm
+        @param feedrate: speed at which to move
+    """
+    def write_move_rel(self, x = None, y = None, z = None, e = None, feedrate = None):
+        self.sink.write(self.move_rel(x, y, z, e, feedrate).gcode())
 
 
 def main():
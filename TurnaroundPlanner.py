@@ -0,0 +1,156 @@
+from math import cos, pi, radians, sqrt, tan
+
+"""
+Blended turnarounds for the wrap passes
+The original wrap stops dead at each end of the tube: x stops, the tube turns a full 360 deg (60 deg
+at the near end, plus the re-index) and x starts back. A blended turnaround keeps the tube turning at
+the pass's speed while x slows down past the end of the tube, reverses and speeds back up, at a
+constant acceleration no higher than the M201 X limit. The rotary head follows the filament: it
+leans -(90 - wind angle) on the way out, +(90 - wind angle) on the way back, and swings over during
+the turnaround, straightening up as x slows down and leaning the other way as it speeds back up.
+Each half of the swing eases in and out (half a cosine), so the head starts and stops smoothly at
+both ends of a pass and at the apex, where x stops.
+
+The only rotation left over is whatever it takes to land the next pass on its start angle, done at
+the near end while x is stopped anyway, and always under a turn.
+
+Curves are split into SEGMENTS straight G1 moves per turnaround.
+
+"""
+
+# G1 moves per turnaround, kept even so x's stop at the apex falls on a segment end
+SEGMENTS = 8
+# give up slowing the passes down to fit a turnaround below this x speed (mm/s)
+MIN_X_SPEED = 1.0
+
+
+class Turnaround:
+    """
+        one reversal of x, the same at both ends of the tube
+        @param x_speed: speed (mm/s) of x on the passes
+        @param e_speed: speed (mm/s) of the tube's surface, kept through the turnaround
+        @param lay_deg: how far (deg) the head leans either way to follow the filament
+        @param z_mm_per_deg: see TubeWinder
+        @param x_accel: highest x acceleration (mm/s^2)
+        @param z_speed: highest z speed (mm/s)
+        @param z_accel: highest z acceleration (mm/s^2)
+    """
+    def __init__(self, x_speed, e_speed, lay_deg, z_mm_per_deg, x_accel, z_speed, z_accel, segments = SEGMENTS):
+        self.x_speed = x_speed
+        self.e_speed = e_speed
+        self.lay_deg = lay_deg
+        self.z_mm_per_deg = z_mm_per_deg
+        self.segments = segments
+        # as quick as x can reverse, but no quicker than the head can swing over from one side to the other.
+        # Half a cosine over half the turnaround peaks at pi/2 times the average speed, and pi^2/2 times the
+        # average acceleration at its ends
+        z_lean = lay_deg * z_mm_per_deg
+        z_half = max(pi * z_lean / (2 * z_speed), pi * sqrt(z_lean / (2 * z_accel)))
+        self.duration = max(2 * x_speed / x_accel, 2 * z_half)
+        self.x_accel = 2 * x_speed / self.duration
+        # how far x goes on from where it starts slowing down
+        self.distance = x_speed * self.duration / 4
+        # e covered by a whole turnaround
+        self.e = e_speed * self.duration
+
+    """
+        where the turnaround is at a sample, relative to where it started
+        @param direction: 1 when x was moving up before the turnaround, -1 when it was moving down
+        @return (x, z in deg, e)
+    """
+    def sample(self, k, direction):
+        t = self.duration * k / self.segments
+        x = direction * (self.x_speed * t - self.x_accel * t * t / 2)
+        # the head leans against the way x is going, straight at the apex
+        half = self.duration / 2
+        if t <= half:
+            z = -direction * self.lay_deg * (1 + cos(pi * t / half)) / 2
+        else:
+            z = direction * self.lay_deg * (1 - cos(pi * (t - half) / half)) / 2
+        return x, z, self.e_speed * t
+
+    """
+        the G1 moves of a stretch of the turnaround, relative to where the stretch starts
+        @param first, last: samples to go from and to, 0 to segments is the whole turnaround
+        @return list of (x, z in deg (absolute), e, feedrate)
+    """
+    def moves(self, direction, first = 0, last = None):
+        last = self.segments if last is None else last
+        seconds = self.duration / self.segments
+        x0, z0, e0 = self.sample(first, direction)
+        moves = []
+        previous = (x0, z0, e0)
+        for k in range(first + 1, last + 1):
+            x, z, e = self.sample(k, direction)
+            length = pow(pow(x - previous[0],2) + pow((z - previous[1]) * self.z_mm_per_deg,2) + pow(e - previous[2],2),.5)
+            moves.append((x - x0, z, e - e0, max(1, length / seconds * 60)))
+            previous = (x, z, e)
+        return moves
+
+
+class BlendedWrap:
+    """
+        how a wrap row goes with blended turnarounds
+        @param x_start: x at the near end's apex, x stops here between passes
+        @param travel: distance (mm) between the two apexes
+        @param e_per_x: e per x on the passes
+        @param feedrate: feedrate of the straight part of the passes
+        @param turnaround: Turnaround used at both ends
+        @param e_mm_per_deg: see TubeWinder
+    """
+    def __init__(self, x_start, travel, e_per_x, feedrate, turnaround, e_mm_per_deg):
+        self.x_start = x_start
+        self.travel = travel
+        self.e_per_x = e_per_x
+        self.feedrate = feedrate
+        self.turnaround = turnaround
+        self.e_mm_per_deg = e_mm_per_deg
+
+    """
+        x covered by the straight part of a pass, between the turnarounds
+    """
+    @property
+    def straight(self):
+        return self.travel - 2 * self.turnaround.distance
+
+    """
+        how far (deg) the tube turns in a pass, out and back, without any dwell
+    """
+    @property
+    def turned_deg(self):
+        return (2 * self.straight * self.e_per_x + 2 * self.turnaround.e) / self.e_mm_per_deg
+
+    """
+        rotation (deg) at the near end that lands the next pass index_deg on from the last one
+    """
+    def dwell_deg(self, index_deg):
+        dwell = (index_deg - self.turned_deg) % 360
+        # don't go a whole turn for a rounding error
+        return 0.0 if dwell > 360 - 1e-6 else dwell
+
+
+"""
+    works out the turnarounds for a wrap row
+    the passes are slowed down if they'd need more room to turn around than the extension gives them
+    @param wind_angle: deg from the tube's axis
+    @param wanted_rpm: rpm of the tube on the passes (see TubeWinder.plan_feedrate)
+    @param extension_dist: distance (mm) the head goes past each end of the tube, the turnarounds happen in there
+    @return BlendedWrap
+"""
+def plan_blended_wrap(winder, wind_angle, wanted_rpm, extension_dist, segments = SEGMENTS):
+    if extension_dist <= 0:
+        raise ValueError("Blended turnarounds need an extension past the ends of the tube to turn around in")
+    travel = winder.length + 2*extension_dist
+    e_per_x = tan(radians(wind_angle))
+    feedrate = winder.plan_feedrate(x = travel, e = travel*e_per_x, rpm = wanted_rpm)
+    # the feedrate is along x and e together
+    x_speed = feedrate / 60 * cos(radians(wind_angle))
+    while True:
+        turnaround = Turnaround(x_speed, x_speed*e_per_x, 90 - wind_angle, winder.z_mm_per_deg, winder.max_x_accel, winder.max_z_feedrate/60,
+                                winder.max_z_accel, segments)
+        if turnaround.distance <= extension_dist:
+            break
+        if x_speed < MIN_X_SPEED:
+            raise ValueError("No room to turn around in " + str(round(extension_dist, 2)) + "mm, make the extension longer")
+        x_speed *= .9
+    return BlendedWrap(winder.start_offset - extension_dist, travel, e_per_x, x_speed / cos(radians(wind_angle)) * 60, turnaround, winder.e_mm_per_deg)
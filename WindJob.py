@@ -0,0 +1,186 @@
+import copy
+import json
+
+from GcodeOptimizer import PeepholeOptimizer
+from TubeWinder import TubeWinder
+
+"""
+Description of a single tube to wind, independent of the GUI
+Holds the same values the CAW tabs hold (in the same units the tabs use, inches for
+lengths) so a job can come from the GUI, a manifest file, or anywhere else and be
+turned into G-code the same way.
+
+"""
+
+INCH = 25.4
+
+class WindJob:
+    def __init__(self, tube, pre_wrap = None, wrap = None, heat_shrink = None, heat_gun = None, name = None, feedrates = None, output = None):
+        # every section besides the tube is optional, leaving one out skips the stage
+        self.name = name
+        # file a batch run writes the program to (see CAWBatch.output_path), None names it after the job
+        self.output = output
+        self.tube = dict(tube)
+        # how wrap moves get their feedrates, see TubeWinder's feedrate_mode
+        self.feedrates = dict(FEEDRATE_DEFAULTS)
+        if feedrates is not None:
+            self.feedrates.update(feedrates)
+        self.pre_wrap = dict(pre_wrap) if pre_wrap is not None else None
+        self.wrap = dict(wrap) if wrap is not None else None
+        self.heat_shrink = dict(heat_shrink) if heat_shrink is not None else None
+        self.heat_gun = dict(heat_gun) if heat_gun is not None else None
+
+    """
+        builds a job from a dictionary (one entry of a manifest)
+        @param data: dictionary with a 'tube' section and optional 'pre_wrap', 'wrap', 'heat_shrink'
+            and 'heat_gun' sections, and an optional 'output' file name. Missing values fall back to the GUI defaults
+    """
+    @classmethod
+    def from_dict(cls, data):
+        tube = dict(TUBE_DEFAULTS)
+        tube.update(data.get("tube", {}))
+        sections = {}
+        for key, defaults in (("pre_wrap", PRE_WRAP_DEFAULTS), ("wrap", WRAP_DEFAULTS), ("heat_shrink", HEAT_SHRINK_DEFAULTS), ("heat_gun", HEAT_GUN_DEFAULTS)):
+            # a section set to false/null is skipped, a missing one uses the defaults
+            value = data.get(key, {})
+            if value is None or value is False:
+                sections[key] = None
+                continue
+            section = dict(defaults)
+            section.update(value)
+            sections[key] = section
+        return cls(tube, name = data.get("name"), feedrates = data.get("feedrates"), output = data.get("output"), **sections)
+
+    def to_dict(self):
+        return {"name": self.name, "tube": self.tube, "feedrates": self.feedrates, "pre_wrap": self.pre_wrap, "wrap": self.wrap,
+                "heat_shrink": self.heat_shrink, "heat_gun": self.heat_gun, "output": self.output}
+
+    """
+        creates the TubeWinder for this job
+        @param file: file or GcodeSink to write the G-code to, None when only the records are wanted
+        @param write_units: write the units header straight away. records() yields it either way,
+            so leave this off when going through records()
+        @param on_report: see TubeWinder
+    """
+    def create_winder(self, file = None, write_units = False, on_report = None):
+        return TubeWinder(file, float(self.tube["od"]) * INCH, float(self.tube["length"]) * INCH,
+                          float(self.tube["start_offset"]) * INCH, float(self.tube["head_offset"]) * INCH, write_units,
+                          self.feedrates["mode"], self.feedrates["rpm_cap"], on_report)
+
+    """
+        lists every enabled stage of the job, in the same order the GUI runs them
+        @return list of (name, TubeWinder generator method name, arguments)
+    """
+    def stages(self):
+        stages = [("units", "iter_units", ())]
+        if self.pre_wrap is not None:
+            stages.append(("pre_wrap", "iter_pre_wrap", (bool(self.pre_wrap["home"]), bool(self.pre_wrap["manual_home"]),
+                                                         bool(self.pre_wrap["check_locations"]), int(self.pre_wrap["feedrate"]))))
+        if self.wrap is not None:
+            # first execute the tie down wrap
+            stages.append(("tie_down_wrap", "iter_tie_down_wrap", (float(self.wrap["extension"]) * INCH, float(self.wrap["start_wrap_rotations"]),
+                                                                   float(self.wrap["tie_down_feedrate"]))))
+            # now go and handle each row
+            for i, row in enumerate(self.wrap["rows"]):
+                stages.append(("wrap " + str(i + 1), "iter_wrap", (float(self.wrap["filament_width"]) * INCH, float(self.wrap["filament_overlap"]),
+                                                                   float(row["angle"]), float(row["layers"]), int(row["rpm"]),
+                                                                   float(self.wrap["extension"]) * INCH, self.wind_pattern(),
+                                                                   self.wrap.get("turnaround", "dwell"))))
+        if self.heat_shrink is not None:
+            stages.append(("shrink_tape", "iter_shrink_tape", (float(self.heat_shrink["width"]) * INCH, float(self.heat_shrink["overlap"]),
+                                                               int(self.heat_shrink["feedrate"]))))
+        if self.heat_gun is not None:
+            stages.append(("heat_gun", "iter_heat_gun", (float(self.heat_gun["rotation_per_pass"]), int(self.heat_gun["passes"]),
+                                                         int(self.heat_gun["feedrate"]))))
+        return stages
+
+    """
+        the pattern argument for TubeWinder.iter_wrap, None for the original heuristic
+    """
+    def wind_pattern(self):
+        pattern = self.wrap.get("pattern", "heuristic")
+        if pattern in (None, "heuristic"):
+            return None
+        if pattern != "solve":
+            raise ValueError("Unknown wind pattern " + str(pattern) + ", use heuristic or solve")
+        return pattern
+
+    """
+        copy of the job winding with another pattern ("heuristic" or "solve")
+    """
+    def with_pattern(self, pattern):
+        # to_dict hands back the job's own sections
+        data = copy.deepcopy(self.to_dict())
+        if data["wrap"] is not None:
+            data["wrap"]["pattern"] = pattern
+        return WindJob.from_dict(data)
+
+    """
+        lazily yields the records of the whole program, stage by stage
+        @param winder: TubeWinder made by create_winder
+    """
+    def records(self, winder):
+        for name, method, args in self.stages():
+            yield from getattr(winder, method)(*args)
+
+    """
+        writes the whole program
+        @param file: file or GcodeSink to write the G-code to
+        @param optimize: run the program through the peephole optimizer (see GcodeOptimizer) on the way out
+        @param cache: ProgramCache to read unchanged stages from and store new ones in. The optimizer works on
+            the records themselves, so an optimized program doesn't go through the cache
+        @param index: ProgramIndexer to checkpoint the program with as it's written (see ProgramIndex). Cached stages
+            are written as text, so an indexed program doesn't go through the cache either
+        @param on_report: see TubeWinder
+        @return the TubeWinder used, in its final state
+    """
+    def generate(self, file, optimize = False, cache = None, index = None, on_report = None):
+        if cache is not None and not optimize and index is None:
+            return cache.write_job(self, file, on_report)
+        winder = self.create_winder(file, on_report = on_report)
+        records = self.records(winder)
+        if optimize:
+            records = PeepholeOptimizer().optimize(records)
+        if index is not None:
+            records = index.index_records(records, winder.sink)
+        winder.emit(records)
+        winder.flush()
+        return winder
+
+
+"""
+    loads a list of jobs from a json manifest
+    the manifest is either a list of jobs or an object with a 'jobs' list and an optional 'defaults'
+    job that every job is layered on top of
+    @param path: path of the manifest file
+"""
+def load_manifest(path):
+    with open(path) as manifest_file:
+        data = json.load(manifest_file)
+    defaults = {}
+    if isinstance(data, dict):
+        defaults = data.get("defaults", {})
+        data = data["jobs"]
+    jobs = []
+    for entry in data:
+        merged = {}
+        for key in set(defaults) | set(entry):
+            if isinstance(defaults.get(key), dict) and isinstance(entry.get(key), dict):
+                merged[key] = dict(defaults[key])
+                merged[key].update(entry[key])
+            else:
+                merged[key] = entry.get(key, defaults.get(key))
+        jobs.append(WindJob.from_dict(merged))
+    return jobs
+
+
+# defaults match the values the GUI tabs start with
+TUBE_DEFAULTS = {"od": 2.716, "length": 10, "start_offset": 1.5, "head_offset": 1}
+FEEDRATE_DEFAULTS = {"mode": "rpm", "rpm_cap": None}
+PRE_WRAP_DEFAULTS = {"home": True, "manual_home": False, "check_locations": True, "feedrate": 2000}
+# pattern: "heuristic" picks passes and index angle the original way (TubeWinder.wrap_pattern), "solve" uses PatternSolver
+# turnaround: "dwell" stops and turns the tube at each end, "blend" turns around without stopping (see TurnaroundPlanner)
+WRAP_DEFAULTS = {"filament_width": .1, "filament_overlap": .9, "extension": 1.5, "start_wrap_rotations": 1.5,
+                 "tie_down_feedrate": 1500, "pattern": "heuristic", "turnaround": "dwell", "rows": [{"layers": 1, "angle": 45, "rpm": 20}]}
+HEAT_SHRINK_DEFAULTS = {"width": .5, "overlap": .9, "feedrate": 2000}
+HEAT_GUN_DEFAULTS = {"passes": 20, "rotation_per_pass": 10, "feedrate": 2000}
@@ -0,0 +1,282 @@
+import json
+import sys
+import time
+from math import tan, radians
+
+import numpy as np
+
+"""
+Vectorized planner for the passes of TubeWinder.wrap
+Every pass of a wrap has the same shape (out, rotate 360, back, rotate 60, re-index), so instead
+of working each one out in a loop the whole layer is laid out as arrays in one go.
+Produces the same moves as the loop in TubeWinder.iter_wrap, to the .001 they're written to. The planner and the
+loop can round the last bit of a position differently, so a value sitting right on a rounding tie can come out one
+in the last digit apart.
+
+run this file to benchmark the planner against the loop: python WrapPlanner.py
+or to check it writes the same G-code as the loop:      python WrapPlanner.py --check [configurations]
+
+"""
+
+# moves per pass: out, 360 deg rotation, back, 60 deg rotation, re-index rotation
+MOVES_PER_PASS = 5
+# re-index rotations (mm of e) closer than this are the same, far under the .001 the G-code is written to
+SETTLE_TOLERANCE = 1e-6
+
+class WrapPlan:
+    """
+        @param settled_from: first pass that had to be settled one at a time, None when none did
+    """
+    def __init__(self, passes, x_out, x_back, e, traverse_feedrate, rotate_feedrate, settled_from = None):
+        self.passes = passes
+        self.settled_from = settled_from
+        # x at the end of the out and back moves, one per pass
+        self.x_out = x_out
+        self.x_back = x_back
+        # e at the end of every move, shape (passes, MOVES_PER_PASS)
+        self.e = e
+        self.traverse_feedrate = traverse_feedrate
+        self.rotate_feedrate = rotate_feedrate
+
+    """
+        e delta of each re-index rotation, one per pass
+    """
+    def reindex_deltas(self):
+        return self.e[:, 4] - self.e[:, 3]
+
+
+"""
+    lays out every pass of a wrap starting from the winder's current location
+    @param winder: TubeWinder, at the start of the wrap (after the move behind the holder)
+    @param wraps_per_layer: number of passes
+    @param extra_turn_deg: index angle added on every re-index rotation
+    @param wind_angle: angle to perform the wind at
+    @param wanted_rpm: e axis speed
+    @param extension_dist: distance to extend behind the holder
+    @param shortest_reindex: take the re-index rotation the shortest way forwards (under a turn), as the loop does for solved patterns
+"""
+def plan_wrap(winder, wraps_per_layer, extra_turn_deg, wind_angle, wanted_rpm, extension_dist, shortest_reindex = False):
+    n = wraps_per_layer
+    e_mm_per_deg = winder.e_mm_per_deg
+    e_per_x = tan(radians(wind_angle))
+    travel = winder.length + 2*extension_dist
+    traverse_e = travel*e_per_x
+    # same feedrates the loop works out, they don't change from pass to pass
+    # (rotations are e only moves, their feedrate doesn't depend on how far they go)
+    traverse_feedrate = winder.plan_feedrate(x = travel, e = traverse_e, rpm = wanted_rpm)
+    rotate_feedrate = winder.plan_feedrate(e = 360 * e_mm_per_deg, rpm = wanted_rpm)
+    if n <= 0:
+        empty = np.zeros(0)
+        return WrapPlan(0, empty, empty, np.zeros((0, MOVES_PER_PASS)), traverse_feedrate, rotate_feedrate)
+
+    # x goes out and back by the same amount every pass, accumulate it the same way the loop does
+    x_steps = np.empty(2*n)
+    x_steps[0::2] = travel
+    x_steps[1::2] = -1*travel
+    x = np.cumsum(np.concatenate(([winder.x_loc], x_steps)))[1:]
+
+    # e deltas of every move, the re-index rotation of the first pass sets the guess for the rest
+    deltas = np.empty((n, MOVES_PER_PASS))
+    deltas[:, 0] = traverse_e
+    deltas[:, 1] = 360 * e_mm_per_deg
+    deltas[:, 2] = traverse_e
+    deltas[:, 3] = 60 * e_mm_per_deg
+    start_e = winder.e_loc
+    end_e = start_e + traverse_e + 360 * e_mm_per_deg + traverse_e + 60 * e_mm_per_deg
+    deltas[:, 4] = reindex_rotation(reindex_deg(start_e, end_e, e_mm_per_deg) + extra_turn_deg, shortest_reindex) * e_mm_per_deg
+    e = accumulate(start_e, deltas)
+    # then work the re-index out for every pass from where it actually starts and ends, and lay it out again
+    deltas[:, 4] = pass_reindex(start_e, e, extra_turn_deg, e_mm_per_deg, shortest_reindex)
+    e = accumulate(start_e, deltas)
+    # rounding only moves the re-index in the last few bits, which never shows in the G-code. The one thing
+    # that does is a pass that starts and ends so close to the same angle that its re-index jumps a whole
+    # turn one way or the other. Settle from the first of those one pass after the other, like the loop does
+    drifted = np.flatnonzero(np.abs(pass_reindex(start_e, e, extra_turn_deg, e_mm_per_deg, shortest_reindex) - deltas[:, 4]) > SETTLE_TOLERANCE)
+    settled_from = None
+    if drifted.size:
+        settled_from = int(drifted[0])
+        e = settle(e, settled_from, start_e, deltas, extra_turn_deg, e_mm_per_deg, shortest_reindex)
+    return WrapPlan(n, x[0::2], x[1::2], e, traverse_feedrate, rotate_feedrate, settled_from)
+
+
+"""
+    the re-index rotation (mm of e) of every pass, from where each one starts and ends up before it
+    @param e: e at the end of every move, shape (passes, MOVES_PER_PASS)
+"""
+def pass_reindex(start_e, e, extra_turn_deg, e_mm_per_deg, shortest_reindex = False):
+    starts = np.concatenate(([start_e], e[:-1, 4]))
+    return reindex_rotation(reindex_deg(starts, e[:, 3], e_mm_per_deg) + extra_turn_deg, shortest_reindex) * e_mm_per_deg
+
+
+"""
+    rotation (deg, 0 to 360) needed to get from end_e back around to the angle of start_e
+    works on single values and arrays
+"""
+def reindex_deg(start_e, end_e, e_mm_per_deg):
+    current_e_deg = np.mod(np.divide(end_e, e_mm_per_deg), 360)
+    last_e = np.mod(np.divide(start_e, e_mm_per_deg), 360)
+    required = last_e - current_e_deg
+    # make sure this is a positive number < 360
+    required = np.where(required < 0, required + 360, required)
+    required = np.where(required > 360, required - 360, required)
+    return required
+
+
+"""
+    the re-index rotation (deg), less any whole turns when going the shortest way
+"""
+def reindex_rotation(rotation, shortest_reindex):
+    return np.mod(rotation, 360) if shortest_reindex else rotation
+
+
+"""
+    redoes the e positions from pass first on, working each re-index out from the pass before it
+"""
+def settle(e, first, start_e, deltas, extra_turn_deg, e_mm_per_deg, shortest_reindex = False):
+    d0, d1, d2, d3 = deltas[0, :4].tolist()
+    e = e.tolist()
+    e_loc = start_e if first == 0 else e[first - 1][4]
+    for i in range(first, len(e)):
+        start = e_loc
+        e1 = e_loc + d0
+        e2 = e1 + d1
+        e3 = e2 + d2
+        e4 = e3 + d3
+        required_e_delta_deg = (start / e_mm_per_deg) % 360 - (e4 / e_mm_per_deg) % 360
+        if(required_e_delta_deg < 0):
+            required_e_delta_deg = required_e_delta_deg + 360
+        if(required_e_delta_deg > 360):
+            required_e_delta_deg = required_e_delta_deg - 360
+        rotation = required_e_delta_deg + extra_turn_deg
+        if shortest_reindex:
+            rotation = rotation % 360
+        e_loc = e4 + rotation * e_mm_per_deg
+        e[i] = [e1, e2, e3, e4, e_loc]
+    return np.array(e)
+
+
+def accumulate(start_e, deltas):
+    # a running sum adds the moves one after the other, just like the loop does
+    e = np.cumsum(np.concatenate(([start_e], deltas.ravel())))[1:]
+    return e.reshape(deltas.shape)
+
+
+"""
+    benchmarks the planner against the loop on a few big jobs and checks the output matches
+    reports the time to make the moves on their own and the time to also write them out as G-code
+"""
+def benchmark(repeats = 3):
+    from GcodeSink import MemorySink
+    from TubeWinder import TubeWinder
+    import contextlib
+    import io
+
+    cases = [("2.7in x 10in", 2.716, 10), ("12in x 10in", 12, 10), ("2.7in x 120in", 2.716, 120), ("24in x 120in", 24, 120)]
+    for label, od, length in cases:
+        plan_times = {}
+        write_times = {}
+        outputs = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for vectorized in (False, True):
+                for i in range(repeats):
+                    winder = TubeWinder(None, od*25.4, length*25.4, 1.5*25.4, 25.4)
+                    start = time.perf_counter()
+                    for record in winder.iter_wrap(.1*25.4, .9, 45, 1, 20, 1.5*25.4, vectorized = vectorized):
+                        pass
+                    elapsed = time.perf_counter() - start
+                    plan_times[vectorized] = min(elapsed, plan_times.get(vectorized, elapsed))
+                    sink = MemorySink()
+                    winder = TubeWinder(sink, od*25.4, length*25.4, 1.5*25.4, 25.4)
+                    start = time.perf_counter()
+                    winder.wrap(.1*25.4, .9, 45, 1, 20, 1.5*25.4, vectorized = vectorized)
+                    winder.flush()
+                    elapsed = time.perf_counter() - start
+                    write_times[vectorized] = min(elapsed, write_times.get(vectorized, elapsed))
+                outputs[vectorized] = sink.getvalue()
+        passes = outputs[True].count("M117")
+        same = compare_gcode(outputs[False], outputs[True]) or "DIFFERENT"
+        print(label + ": " + str(passes) + " passes, moves: loop " + str(round(plan_times[False]*1000, 2)) + "ms planner "
+              + str(round(plan_times[True]*1000, 2)) + "ms, G-code: loop " + str(round(write_times[False]*1000, 2)) + "ms planner "
+              + str(round(write_times[True]*1000, 2)) + "ms, output " + same)
+
+
+"""
+    compares G-code from the loop and the planner
+    @return "identical", "last digit" when numbers are at most one apart in the last written digit, otherwise None
+"""
+def compare_gcode(loop, planner, tolerance = .0011):
+    if loop == planner:
+        return "identical"
+    loop_lines = loop.splitlines()
+    planner_lines = planner.splitlines()
+    if len(loop_lines) != len(planner_lines):
+        return None
+    for a, b in zip(loop_lines, planner_lines):
+        if a == b:
+            continue
+        a_words = a.split()
+        b_words = b.split()
+        if len(a_words) != len(b_words):
+            return None
+        for x, y in zip(a_words, b_words):
+            if x == y:
+                continue
+            try:
+                if x[0] != y[0] or abs(float(x[1:]) - float(y[1:])) > tolerance:
+                    return None
+            except ValueError:
+                return None
+    return "last digit"
+
+
+"""
+    checks the planner writes the same G-code as the loop, on a few known jobs and on random ones
+    @param count: number of random configurations
+    @return number of jobs that came out different
+"""
+def check(count = 300, seed = 1):
+    import random
+    from WindJob import WindJob
+
+    jobs = [("default", {}), ("4in x 30in", {"tube": {"od": 4, "length": 30}}),
+            ("solved pattern", {"tube": {"od": 4, "length": 30}, "wrap": {"pattern": "solve"}}), ("fine filament", {"wrap": {"filament_width": .02}})]
+    rng = random.Random(seed)
+    for i in range(count):
+        rows = [{"layers": 1, "angle": round(rng.uniform(15, 75), 2), "rpm": rng.choice((10, 20, 40))} for row in range(rng.randint(1, 3))]
+        jobs.append(("random " + str(i + 1), {"tube": {"od": round(rng.uniform(.5, 24), 3), "length": round(rng.uniform(2, 120), 2)},
+                                              "wrap": {"filament_width": round(rng.uniform(.02, .5), 3), "filament_overlap": round(rng.uniform(.5, 1), 3),
+                                                       "extension": round(rng.uniform(.5, 3), 2), "pattern": rng.choice(("heuristic", "solve")),
+                                                       "rows": rows}}))
+    different = 0
+    last_digit = 0
+    settled = 0
+    for label, data in jobs:
+        job = WindJob.from_dict(data)
+        outputs = {}
+        reports = []
+        for vectorized in (False, True):
+            winder = job.create_winder(on_report = lambda name, value: reports.append(name))
+            text = []
+            for name, method, args in job.stages():
+                records = getattr(winder, method)(*args, vectorized = vectorized) if method == "iter_wrap" else getattr(winder, method)(*args)
+                text.extend(record.gcode() for record in records)
+            outputs[vectorized] = "".join(text)
+        settles = reports.count("Settled from pass")
+        settled += settles > 0
+        same = compare_gcode(outputs[False], outputs[True])
+        if same is None:
+            different += 1
+            print(label + ": DIFFERENT " + json.dumps(data))
+        else:
+            last_digit += same == "last digit"
+            if label[:6] != "random":
+                print(label + ": " + same + ", " + str(outputs[True].count("M117 Pass")) + " passes" + (", settled" if settles else ""))
+    print(str(len(jobs)) + " jobs, " + str(different) + " different, " + str(last_digit) + " one apart in the last digit, "
+          + str(settled) + " settled one pass at a time")
+    return different
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--check":
+        sys.exit(1 if check(int(sys.argv[2]) if len(sys.argv) > 2 else 300) else 0)
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 3)